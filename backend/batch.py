@@ -0,0 +1,123 @@
+"""Running several GET requests in one: POST /batch.
+
+Pages often need several resources at once (e.g. after logging in, the home timeline, the
+user's profile and who to follow), and fetching them separately costs a round trip each.
+/batch takes a list of GET requests to the other routes, runs them at the same time on a
+pool of threads, and returns all of their responses at once.
+
+Each sub-request is dispatched through the app like any other request, with the batch's
+Authorization header, so it behaves exactly as it would on its own, and has its own metrics.
+Authenticating them is cheap, as the user is cached from authenticating the batch. They
+don't share a database connection, as they run at the same time, but take connections from
+the process's pool as usual.
+
+The request body is a JSON list of {"path": "/profile/someone?limit=3"} objects, and the
+response a JSON list of {"status": 200, "headers": {...}, "body": ...} in the same order.
+Bodies are JSON where the sub-response was JSON, and text otherwise.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+from typing import Any, List, Optional, Tuple, Union
+
+from data.connection import add_to_query_count, query_count
+from flask import Flask, Response, current_app, make_response, request
+from flask_jwt_extended import jwt_required
+from werkzeug.test import EnvironBuilder
+
+MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "10"))
+WORKERS = int(os.getenv("BATCH_WORKERS", "8"))
+
+# The sub-responses' headers which are passed on; the rest describe the body, which is
+# re-encoded, or are the same for every response.
+RESPONSE_HEADERS = ["Cache-Control", "ETag", "Last-Modified", "X-Next-Cursor"]
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """get_executor returns the process-wide pool of threads running sub-requests,
+    creating it on first use."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=WORKERS, thread_name_prefix="batch"
+                )
+    return _executor
+
+
+@jwt_required(optional=True)
+def batch():
+    paths = parse_batch(request.get_json(silent=True))
+    if isinstance(paths, Response):
+        return paths
+
+    app = current_app._get_current_object()
+    authorization = request.headers.get("Authorization")
+    results = list(
+        get_executor().map(lambda path: run_subrequest(app, path, authorization), paths)
+    )
+    add_to_query_count(sum(queries for _, queries in results))
+
+    # Bodies are spliced in as they are, rather than decoded and encoded again.
+    items = []
+    for response, _ in results:
+        headers = {
+            name: response.headers[name]
+            for name in RESPONSE_HEADERS
+            if name in response.headers
+        }
+        if response.is_json:
+            body = response.get_data()
+        else:
+            body = json.dumps(response.get_data(as_text=True)).encode("utf-8")
+        items.append(
+            b'{"status": %d, "headers": %s, "body": %s}'
+            % (response.status_code, json.dumps(headers).encode("utf-8"), body)
+        )
+    return Response(b"[" + b", ".join(items) + b"]", content_type="application/json")
+
+
+def parse_batch(body: Any) -> Union[List[str], Response]:
+    """parse_batch returns the paths of the sub-requests in a batch, or an error response."""
+    if not isinstance(body, list) or not all(
+        isinstance(item, dict) and isinstance(item.get("path"), str) for item in body
+    ):
+        return make_response(
+            ('Batch must be a JSON list of {"path": "/..."} objects', 400)
+        )
+    if len(body) > MAX_REQUESTS:
+        return make_response(
+            (f"Batch must contain at most {MAX_REQUESTS} requests", 400)
+        )
+    paths = []
+    for item in body:
+        if item.get("method", "GET") != "GET":
+            return make_response(("Batches can only contain GET requests", 400))
+        path = item["path"]
+        if not path.startswith("/") or path.startswith("//"):
+            return make_response((f"Invalid path: {path}", 400))
+        paths.append(path)
+    return paths
+
+
+def run_subrequest(
+    app: Flask, path: str, authorization: Optional[str]
+) -> Tuple[Response, int]:
+    """run_subrequest dispatches a GET request for path, and returns its response and how
+    many statements it ran."""
+    headers = {"Authorization": authorization} if authorization else {}
+    environ = EnvironBuilder(path=path, method="GET", headers=headers).get_environ()
+    with app.request_context(environ):
+        try:
+            response = app.full_dispatch_request()
+        except Exception as error:
+            response = app.handle_exception(error)
+        # Read the whole body while the request is still active, for views which stream.
+        response.get_data()
+        return response, query_count() or 0
@@ -0,0 +1,109 @@
+import json
+import threading
+import unittest
+from unittest.mock import ANY
+
+from batch import batch
+from flask import Flask, jsonify, make_response, request
+from flask_jwt_extended import (
+    JWTManager,
+    create_access_token,
+    get_jwt_identity,
+    jwt_required,
+)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask("Dummy")
+        self.app.config["JWT_SECRET_KEY"] = "secret for tests, at least 32 bytes long"
+        JWTManager(self.app)
+        self.barrier = threading.Barrier(2, timeout=5)
+
+        def echo(name):
+            response = jsonify({"name": name, "limit": request.args.get("limit")})
+            response.headers["X-Next-Cursor"] = "next"
+            return response
+
+        @jwt_required()
+        def whoami():
+            return jsonify(get_jwt_identity())
+
+        def together():
+            # Only returns if another request is running at the same time.
+            self.barrier.wait()
+            return jsonify(True)
+
+        self.app.add_url_rule("/echo/<name>", view_func=echo)
+        self.app.add_url_rule("/whoami", view_func=whoami)
+        self.app.add_url_rule("/together", view_func=together)
+        self.app.add_url_rule("/text", view_func=lambda: make_response(("Nope", 400)))
+        self.app.add_url_rule("/batch", methods=["POST"], view_func=batch)
+        self.client = self.app.test_client()
+
+    def test_batch(self):
+        response = self.client.post(
+            "/batch",
+            json=[
+                {"path": "/echo/a?limit=3"},
+                {"path": "/text"},
+                {"path": "/missing"},
+                {"path": "/echo/b"},
+            ],
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            json.loads(response.get_data()),
+            [
+                {
+                    "status": 200,
+                    "headers": {"X-Next-Cursor": "next"},
+                    "body": {"name": "a", "limit": "3"},
+                },
+                {"status": 400, "headers": {}, "body": "Nope"},
+                {"status": 404, "headers": {}, "body": ANY},
+                {
+                    "status": 200,
+                    "headers": {"X-Next-Cursor": "next"},
+                    "body": {"name": "b", "limit": None},
+                },
+            ],
+        )
+
+    def test_runs_requests_concurrently(self):
+        response = self.client.post(
+            "/batch", json=[{"path": "/together"}, {"path": "/together"}]
+        )
+        self.assertEqual(
+            [item["body"] for item in json.loads(response.get_data())], [True, True]
+        )
+
+    def test_passes_on_authorization(self):
+        with self.app.app_context():
+            token = create_access_token(identity="sample")
+        response = self.client.post(
+            "/batch",
+            json=[{"path": "/whoami"}],
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        self.assertEqual(
+            json.loads(response.get_data()),
+            [{"status": 200, "headers": {}, "body": "sample"}],
+        )
+        response = self.client.post("/batch", json=[{"path": "/whoami"}])
+        self.assertEqual(json.loads(response.get_data())[0]["status"], 401)
+
+    def test_invalid_batches(self):
+        for body in [
+            {"path": "/echo/a"},
+            ["/echo/a"],
+            [{"path": "/echo/a", "method": "POST"}],
+            [{"path": "echo/a"}],
+            [{"path": "/echo/a"}] * 11,
+        ]:
+            with self.subTest(body=body):
+                self.assertEqual(self.client.post("/batch", json=body).status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+"""Measures the memory used to turn query rows into blooms.
+
+Compares the current Bloom (slots, built in bulk with starmap) against the previous
+representation (a plain dataclass with a __dict__, built one row at a time) and a
+tuple-backed one (a NamedTuple, built with _make as psycopg2's NamedTupleCursor does),
+reporting how many allocations each makes and how much memory they hold per 100k blooms.
+Keeping the rows themselves, which every representation is built from, is the floor.
+
+Run from the backend directory: python -m benchmarks.bloom_memory [--blooms N]
+"""
+
+import argparse
+import datetime
+import gc
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Callable, List, NamedTuple, Tuple
+
+from data.blooms import rows_to_blooms
+
+
+@dataclass
+class DictBloom:
+    id: int
+    sender: str
+    content: str
+    sent_timestamp: datetime.datetime
+
+
+class TupleBloom(NamedTuple):
+    id: int
+    sender: str
+    content: str
+    sent_timestamp: datetime.datetime
+
+
+def rows_to_tuple_blooms(rows: List[Tuple[Any, ...]]) -> List[TupleBloom]:
+    return list(map(TupleBloom._make, rows))
+
+
+def rows_to_dict_blooms(rows: List[Tuple[Any, ...]]) -> List[DictBloom]:
+    blooms = []
+    for row in rows:
+        bloom_id, sender_username, content, timestamp = row
+        blooms.append(
+            DictBloom(
+                id=bloom_id,
+                sender=sender_username,
+                content=content,
+                sent_timestamp=timestamp,
+            )
+        )
+    return blooms
+
+
+def make_rows(count: int) -> List[Tuple[Any, ...]]:
+    start = datetime.datetime(2024, 1, 1)
+    return [
+        (
+            370068687526014976 + i,
+            f"user{i % 1000}",
+            f"Bloom number {i} #tag{i % 100}",
+            start + datetime.timedelta(seconds=i),
+        )
+        for i in range(count)
+    ]
+
+
+def measure(convert: Callable[[List[Tuple[Any, ...]]], List[Any]], rows) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    start = time.perf_counter()
+    blooms = convert(rows)
+    elapsed = time.perf_counter() - start
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Only count what is still alive, i.e. the blooms and the list holding them.
+    stats = after.compare_to(before, "filename")
+    allocations = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    assert len(blooms) == len(rows)
+    return {
+        "allocations": allocations,
+        "bytes": size,
+        "peak_bytes": peak,
+        "seconds": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--blooms", type=int, default=100_000)
+    args = parser.parse_args()
+
+    rows = make_rows(args.blooms)
+    scale = 100_000 / args.blooms
+    results = [
+        (
+            "before (dataclass with __dict__, per-row loop)",
+            measure(rows_to_dict_blooms, rows),
+        ),
+        ("after (slots dataclass, starmap)", measure(rows_to_blooms, rows)),
+        ("tuple-backed (NamedTuple, map _make)", measure(rows_to_tuple_blooms, rows)),
+        ("floor (the rows themselves)", measure(list, rows)),
+    ]
+    print(f"Per 100k blooms (measured with {args.blooms}):")
+    for name, result in results:
+        print(
+            f"  {name}: {result['allocations'] * scale:,.0f} allocations, "
+            f"{result['bytes'] * scale / 1024 / 1024:.2f} MiB held, "
+            f"{result['peak_bytes'] * scale / 1024 / 1024:.2f} MiB peak, "
+            f"{result['seconds'] * scale * 1000:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Measures how long serialising a page of blooms into a JSON response takes.
+
+Compares CustomJsonProvider, which uses orjson if it is installed, against the same
+provider using only the standard library.
+
+Run from the backend directory: python -m benchmarks.json_serialisation [--blooms N]
+"""
+
+import argparse
+import datetime
+import time
+from typing import List
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from custom_json_provider import CustomJsonProvider, orjson
+from data.blooms import Bloom
+
+
+class StandardLibraryJsonProvider(CustomJsonProvider):
+    def response(self, *args, **kwargs):
+        return DefaultJSONProvider.response(self, *args, **kwargs)
+
+
+def make_blooms(count: int) -> List[Bloom]:
+    start = datetime.datetime(2020, 3, 4, 14, 15, 16, 123456)
+    return [
+        Bloom(
+            id=370068687526014976 + i,
+            sender=f"user{i % 7}",
+            content=f"Bloom number {i} about #topic{i % 3}",
+            sent_timestamp=start + datetime.timedelta(seconds=i),
+        )
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--blooms", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    app = Flask("Benchmark")
+    blooms = make_blooms(args.blooms)
+    providers = [
+        ("standard library", StandardLibraryJsonProvider(app)),
+        (
+            f"custom (orjson {'enabled' if orjson else 'not installed'})",
+            CustomJsonProvider(app),
+        ),
+    ]
+    print(f"To serialise {args.blooms} blooms:")
+    with app.app_context():
+        for name, provider in providers:
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                provider.response(blooms)
+            elapsed = (time.perf_counter() - start) / args.repeats
+            print(f"  {name}: {elapsed * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,460 @@
+"""Load-tests a running server with a mix of requests from many concurrent virtual users.
+
+Each virtual user logs in to an account of its own, so it has a real JWT, and then until
+the run is over repeatedly picks an operation from the traffic mix and sends it, on its own
+keep-alive connection. Requests which finish during the warm-up aren't counted. For each
+operation, and in total, it reports requests per second, the error rate, latency
+percentiles and (if the server runs with EXPOSE_QUERY_COUNT=1) database queries per request.
+
+Accounts are named <prefix>0, <prefix>1, ... like those made by generate_dataset, which is
+the best way to get a realistic database to test against:
+    python3 -m generate_dataset --users 10000 --blooms 1000000
+    EXPOSE_QUERY_COUNT=1 python3 main.py
+    python3 -m benchmarks.load_test --users 50 --accounts 10000 --output before.json
+Pass --register to create any missing accounts instead. Then, to check a change:
+    python3 -m benchmarks.load_test --users 50 --accounts 10000 --baseline before.json
+which exits with status 1 if any result got worse than the baseline by more than
+--threshold.
+
+Run it from the backend directory. The client is plain threads, so for high request rates
+run it on a different machine from the server, or check it isn't the bottleneck.
+"""
+
+import argparse
+from collections import Counter
+from dataclasses import dataclass, field
+import datetime
+import http.client
+import json
+import math
+import random
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import urllib.parse
+
+OPERATIONS = ("home", "profile", "hashtag", "bloom", "follow", "login")
+DEFAULT_MIX = "home=40,profile=20,hashtag=15,bloom=10,follow=10,login=5"
+
+# An operation makes a request: (method, path, JSON body or None).
+Request = Tuple[str, str, Optional[Dict[str, Any]]]
+
+
+@dataclass
+class Samples:
+    """Samples holds the results of one operation's requests."""
+
+    latencies: List[float] = field(default_factory=list)
+    # Keyed by HTTP status, or "error" if no response came back.
+    statuses: Counter = field(default_factory=Counter)
+    query_counts: List[int] = field(default_factory=list)
+
+    def merge(self, other: "Samples") -> None:
+        self.latencies.extend(other.latencies)
+        self.statuses.update(other.statuses)
+        self.query_counts.extend(other.query_counts)
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """parse_mix parses a traffic mix like "home=3,login=1" into weights by operation."""
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(
+                f"Unknown operation {name!r}; expected one of {', '.join(OPERATIONS)}"
+            )
+        weights[name] = float(weight or 1)
+        if weights[name] < 0:
+            raise ValueError(f"Weight for {name} must not be negative")
+    if not any(weights.values()):
+        raise ValueError("The traffic mix must have some weight")
+    return weights
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """percentile returns the p-th percentile (nearest rank) of some sorted values."""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarise(samples: Samples, seconds: float) -> Dict[str, Any]:
+    """summarise returns the statistics reported for some samples taken over seconds."""
+    latencies = sorted(samples.latencies)
+    requests = sum(samples.statuses.values())
+    errors = sum(
+        count
+        for status, count in samples.statuses.items()
+        if status == "error" or int(status) >= 400
+    )
+    return {
+        "requests": requests,
+        "requests_per_second": requests / seconds if seconds else 0.0,
+        "errors": errors,
+        "error_rate": errors / requests if requests else 0.0,
+        "statuses": {str(status): count for status, count in samples.statuses.items()},
+        "latency_ms": {
+            "mean": 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+            "p50": 1000 * percentile(latencies, 50),
+            "p95": 1000 * percentile(latencies, 95),
+            "p99": 1000 * percentile(latencies, 99),
+            "max": 1000 * latencies[-1] if latencies else 0.0,
+        },
+        "queries_per_request": (
+            sum(samples.query_counts) / len(samples.query_counts)
+            if samples.query_counts
+            else None
+        ),
+    }
+
+
+def compare(
+    baseline: Dict[str, Any],
+    current: Dict[str, Any],
+    *,
+    threshold: float,
+    min_latency_change_ms: float,
+    max_error_rate_increase: float,
+) -> List[str]:
+    """compare returns a description of each way in which current results are worse than
+    baseline results by more than the given margins."""
+    regressions = []
+    names = ["total"] + [
+        name for name in current["operations"] if name in baseline["operations"]
+    ]
+    for name in names:
+        before = baseline["total"] if name == "total" else baseline["operations"][name]
+        after = current["total"] if name == "total" else current["operations"][name]
+
+        for key in ("p50", "p95", "p99"):
+            old, new = before["latency_ms"][key], after["latency_ms"][key]
+            # Small absolute changes are noise, however large they are relatively.
+            if new > old * (1 + threshold) and new - old > min_latency_change_ms:
+                regressions.append(
+                    f"{name}: {key} latency rose from {old:.1f}ms to {new:.1f}ms"
+                )
+
+        old, new = before["requests_per_second"], after["requests_per_second"]
+        if new < old * (1 - threshold):
+            regressions.append(
+                f"{name}: throughput fell from {old:.1f} to {new:.1f} requests/s"
+            )
+
+        old, new = before["error_rate"], after["error_rate"]
+        if new > old + max_error_rate_increase:
+            regressions.append(f"{name}: error rate rose from {old:.2%} to {new:.2%}")
+
+        old, new = before["queries_per_request"], after["queries_per_request"]
+        if old is not None and new is not None and new > old * (1 + threshold):
+            regressions.append(
+                f"{name}: queries per request rose from {old:.2f} to {new:.2f}"
+            )
+    return regressions
+
+
+class VirtualUser:
+    """VirtualUser sends requests as one account, on one connection."""
+
+    def __init__(self, args: argparse.Namespace, index: int):
+        self.args = args
+        self.username = f"{args.username_prefix}{index}"
+        self.random = random.Random(args.seed * 1_000_003 + index)
+        self.connection = http.client.HTTPConnection(
+            args.host, args.port, timeout=args.timeout
+        )
+        self.token: Optional[str] = None
+        self.sent = 0
+        self.samples: Dict[str, Samples] = {}
+        self.error: Optional[BaseException] = None
+
+    def send(
+        self, method: str, path: str, body: Optional[Dict[str, Any]]
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        headers = {"Accept": "application/json"}
+        if self.token is not None:
+            headers["Authorization"] = f"Bearer {self.token}"
+        encoded = None
+        if body is not None:
+            encoded = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        for attempt in range(2):
+            try:
+                self.connection.request(method, path, body=encoded, headers=headers)
+                response = self.connection.getresponse()
+                return response.status, dict(response.getheaders()), response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError):
+                # The server closed an idle keep-alive connection; reconnect once.
+                self.connection.close()
+                if attempt == 1:
+                    raise
+        raise AssertionError("unreachable")
+
+    def log_in(self, deadline: float) -> None:
+        """log_in gets a token, registering the account first if asked to, and retrying
+        while the server is too busy to hash passwords."""
+        credentials = {"username": self.username, "password": self.args.password}
+        path = "/login"
+        while True:
+            status, headers, body = self.send("POST", path, credentials)
+            if status == 200:
+                self.token = json.loads(body)["token"]
+                return
+            if status == 503 and time.monotonic() < deadline:
+                time.sleep(
+                    float(headers.get("Retry-After", "1")) * self.random.random()
+                )
+                continue
+            if status == 403 and self.args.register and path == "/login":
+                path = "/register"
+                continue
+            raise RuntimeError(
+                f"Couldn't log in as {self.username}: {status} {body[:200]!r}"
+            )
+
+    def request(self, operation: str) -> Request:
+        args = self.args
+        if operation == "home":
+            return "GET", "/home", None
+        if operation == "profile":
+            return "GET", f"/profile/{self.other_username()}", None
+        if operation == "hashtag":
+            tag = self.random.choice(args.hashtags)
+            return "GET", f"/hashtag/{urllib.parse.quote(tag)}", None
+        if operation == "bloom":
+            self.sent += 1
+            tag = self.random.choice(args.hashtags)
+            content = f"Load testing, bloom {self.sent} from {self.username} #{tag}"
+            return "POST", "/bloom", {"content": content}
+        if operation == "follow":
+            return "POST", "/follow", {"follow_username": self.other_username()}
+        if operation == "login":
+            credentials = {"username": self.username, "password": args.password}
+            return "POST", "/login", credentials
+        raise ValueError(f"Unknown operation {operation}")
+
+    def other_username(self) -> str:
+        return f"{self.args.username_prefix}{self.random.randrange(self.args.accounts)}"
+
+    def run(
+        self,
+        weights: Dict[str, float],
+        ready: threading.Barrier,
+        timing: Dict[str, float],
+    ) -> None:
+        try:
+            self.log_in(time.monotonic() + self.args.login_timeout)
+        except BaseException as error:
+            self.error = error
+            ready.abort()
+            return
+        try:
+            ready.wait()
+        except threading.BrokenBarrierError:
+            return
+
+        operations = list(weights)
+        operation_weights = list(weights.values())
+        measure_from, end = timing["measure_from"], timing["end"]
+        while True:
+            operation = self.random.choices(operations, weights=operation_weights)[0]
+            method, path, body = self.request(operation)
+            started = time.monotonic()
+            if started >= end:
+                break
+            try:
+                status, headers, response_body = self.send(method, path, body)
+            except (OSError, http.client.HTTPException):
+                status, headers, response_body = "error", {}, b""
+                self.connection.close()
+            finished = time.monotonic()
+            if operation == "login" and status == 200:
+                self.token = json.loads(response_body)["token"]
+
+            if started >= measure_from and finished <= end:
+                samples = self.samples.setdefault(operation, Samples())
+                samples.latencies.append(finished - started)
+                samples.statuses[status] += 1
+                if "X-Query-Count" in headers:
+                    samples.query_counts.append(int(headers["X-Query-Count"]))
+
+            if self.args.think_time:
+                time.sleep(self.random.expovariate(1 / self.args.think_time))
+        self.connection.close()
+
+
+def run_load_test(args: argparse.Namespace) -> Dict[str, Any]:
+    """run_load_test runs the configured load and returns its results."""
+    weights = parse_mix(args.mix)
+    users = [VirtualUser(args, index) for index in range(args.users)]
+    timing: Dict[str, float] = {}
+
+    def start_clock():
+        now = time.monotonic()
+        timing["measure_from"] = now + args.warmup
+        timing["end"] = timing["measure_from"] + args.duration
+
+    # Everyone logs in first, and only then does the clock start.
+    ready = threading.Barrier(args.users + 1, action=start_clock)
+    threads = [
+        threading.Thread(target=user.run, args=(weights, ready, timing), daemon=True)
+        for user in users
+    ]
+    print(f"Logging in {args.users} virtual users...", file=sys.stderr)
+    for thread in threads:
+        thread.start()
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        ready.wait()
+    except threading.BrokenBarrierError:
+        errors = [user.error for user in users if user.error is not None]
+        raise SystemExit(f"Setup failed: {errors[0] if errors else 'interrupted'}")
+    print(
+        f"Running for {args.warmup}s of warm-up and {args.duration}s measured...",
+        file=sys.stderr,
+    )
+    for thread in threads:
+        thread.join()
+
+    samples: Dict[str, Samples] = {name: Samples() for name in weights if weights[name]}
+    total = Samples()
+    for user in users:
+        for name, user_samples in user.samples.items():
+            samples[name].merge(user_samples)
+            total.merge(user_samples)
+
+    config = vars(args).copy()
+    for key in ("password", "baseline", "output"):
+        config.pop(key)
+    return {
+        "started_at": started_at.isoformat(),
+        "config": config,
+        "duration_seconds": args.duration,
+        "total": summarise(total, args.duration),
+        "operations": {
+            name: summarise(operation_samples, args.duration)
+            for name, operation_samples in samples.items()
+        },
+    }
+
+
+def print_results(results: Dict[str, Any]) -> None:
+    print(
+        f"{'operation':<10} {'requests':>9} {'req/s':>8} {'errors':>7} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'queries':>8}"
+    )
+    rows = list(results["operations"].items()) + [("total", results["total"])]
+    for name, summary in rows:
+        latency = summary["latency_ms"]
+        queries = summary["queries_per_request"]
+        print(
+            f"{name:<10} {summary['requests']:>9} "
+            f"{summary['requests_per_second']:>8.1f} {summary['error_rate']:>7.2%} "
+            f"{latency['p50']:>8.1f} {latency['p95']:>8.1f} {latency['p99']:>8.1f} "
+            f"{latency['max']:>8.1f} {'-' if queries is None else f'{queries:.2f}':>8}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument(
+        "--users", type=int, default=50, help="How many virtual users to run at once."
+    )
+    parser.add_argument(
+        "--accounts",
+        type=int,
+        help="How many accounts exist, to view and follow (default: --users).",
+    )
+    parser.add_argument("--username-prefix", default="gen")
+    parser.add_argument("--password", default="password")
+    parser.add_argument(
+        "--register",
+        action="store_true",
+        help="Register virtual users' accounts which don't exist yet.",
+    )
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help=f"Relative weights of each operation (default: {DEFAULT_MIX}).",
+    )
+    parser.add_argument(
+        "--hashtags",
+        default="loadtest,benchmark,purple",
+        type=lambda value: value.split(","),
+        help="Hashtags to view, and to put in the blooms sent.",
+    )
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument(
+        "--think-time",
+        type=float,
+        default=0.0,
+        help="Mean seconds each virtual user waits between requests.",
+    )
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument(
+        "--login-timeout",
+        type=float,
+        default=120.0,
+        help="How long to keep retrying logins while the server is busy.",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument(
+        "--baseline", help="Compare the results to those in this JSON file."
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="The fraction by which latency, throughput or queries per request may get "
+        "worse than the baseline before it counts as a regression.",
+    )
+    parser.add_argument("--min-latency-change-ms", type=float, default=1.0)
+    parser.add_argument("--max-error-rate-increase", type=float, default=0.01)
+    args = parser.parse_args()
+    if args.accounts is None:
+        args.accounts = args.users
+    if args.accounts < args.users:
+        parser.error("--accounts must be at least --users")
+
+    results = run_load_test(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline["config"]["mix"] != args.mix:
+            print(
+                f"\nWarning: the baseline used a different mix ({baseline['config']['mix']}), "
+                "so the totals aren't comparable.",
+                file=sys.stderr,
+            )
+        regressions = compare(
+            baseline,
+            results,
+            threshold=args.threshold,
+            min_latency_change_ms=args.min_latency_change_ms,
+            max_error_rate_increase=args.max_error_rate_increase,
+        )
+        if regressions:
+            print(f"\n{len(regressions)} regressions against {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline}.")
+
+
+if __name__ == "__main__":
+    main()
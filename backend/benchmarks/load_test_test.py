@@ -0,0 +1,68 @@
+from collections import Counter
+import unittest
+
+from benchmarks.load_test import Samples, compare, parse_mix, percentile, summarise
+
+
+class TestLoadTest(unittest.TestCase):
+    def test_parse_mix(self):
+        self.assertEqual(parse_mix("home=3, login"), {"home": 3.0, "login": 1.0})
+        with self.assertRaises(ValueError):
+            parse_mix("home=1,timeline=2")
+        with self.assertRaises(ValueError):
+            parse_mix("home=0")
+
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual(percentile(values, 50), 50.0)
+        self.assertEqual(percentile(values, 99), 99.0)
+        self.assertEqual(percentile(values, 100), 100.0)
+        self.assertEqual(percentile([7.0], 95), 7.0)
+        self.assertEqual(percentile([], 95), 0.0)
+
+    def test_summarise(self):
+        samples = Samples(
+            latencies=[0.001 * i for i in range(1, 11)],
+            statuses=Counter({200: 8, 503: 1, "error": 1}),
+            query_counts=[2, 3],
+        )
+        summary = summarise(samples, seconds=2)
+        self.assertEqual(summary["requests"], 10)
+        self.assertEqual(summary["requests_per_second"], 5)
+        self.assertEqual(summary["error_rate"], 0.2)
+        self.assertEqual(summary["statuses"], {"200": 8, "503": 1, "error": 1})
+        self.assertAlmostEqual(summary["latency_ms"]["p50"], 5)
+        self.assertAlmostEqual(summary["latency_ms"]["max"], 10)
+        self.assertEqual(summary["queries_per_request"], 2.5)
+
+    def test_compare(self):
+        def results(p95, requests_per_second, error_rate, queries):
+            summary = {
+                "latency_ms": {"p50": 10.0, "p95": p95, "p99": 50.0},
+                "requests_per_second": requests_per_second,
+                "error_rate": error_rate,
+                "queries_per_request": queries,
+            }
+            return {"total": summary, "operations": {"home": summary}}
+
+        baseline = results(20.0, 100.0, 0.0, 3.0)
+        margins = dict(
+            threshold=0.1, min_latency_change_ms=1.0, max_error_rate_increase=0.01
+        )
+        self.assertEqual(
+            compare(baseline, results(21.0, 95.0, 0.005, 3.2), **margins), []
+        )
+
+        regressions = compare(baseline, results(30.0, 80.0, 0.05, 4.0), **margins)
+        self.assertEqual(len(regressions), 8)
+        self.assertIn("home: p95 latency rose from 20.0ms to 30.0ms", regressions)
+
+        # Small latencies can double without it counting.
+        baseline = results(0.5, 100.0, 0.0, None)
+        self.assertEqual(
+            compare(baseline, results(1.0, 100.0, 0.0, 9.0), **margins), []
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+from cache import MISSING, LRUCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_and_set(self):
+        cache = LRUCache(2)
+        self.assertIs(cache.get("a"), MISSING)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        stats = cache.stats()
+        self.assertEqual((stats.hits, stats.misses, stats.size), (1, 1, 1))
+
+    def test_caches_none(self):
+        cache = LRUCache(2)
+        cache.set("a", None)
+        self.assertIsNone(cache.get("a"))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIs(cache.get("b"), MISSING)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats().evictions, 1)
+
+    def test_expires_after_ttl(self):
+        clock = FakeClock()
+        cache = LRUCache(2, ttl=10, clock=clock)
+        cache.set("a", 1)
+        clock.now = 9
+        self.assertEqual(cache.get("a"), 1)
+        clock.now = 11
+        self.assertIs(cache.get("a"), MISSING)
+        self.assertEqual(cache.stats().size, 0)
+
+    def test_invalidate(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.invalidate("a")
+        cache.invalidate("never set")
+        self.assertIs(cache.get("a"), MISSING)
+
+    def test_invalidate_where(self):
+        cache = LRUCache(3)
+        cache.set(("user", "a"), 1)
+        cache.set(("user", "b"), 2)
+        cache.set(("hashtag", "a"), 3)
+        cache.invalidate_where(lambda key: key[0] == "user")
+        self.assertIs(cache.get(("user", "a")), MISSING)
+        self.assertIs(cache.get(("user", "b")), MISSING)
+        self.assertEqual(cache.get(("hashtag", "a")), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
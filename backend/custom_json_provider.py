@@ -1,11 +1,105 @@
 from datetime import datetime
+from typing import Any, Callable, Dict
+
+from flask import Response
 from flask.json.provider import DefaultJSONProvider
 
+from data.blooms import Bloom
+from data.users import User
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson writes datetimes and dataclasses itself unless told to pass them to default,
+# and its formatting of them isn't quite the same as ours.
+ORJSON_OPTIONS = (
+    orjson.OPT_SORT_KEYS
+    | orjson.OPT_PASSTHROUGH_DATETIME
+    | orjson.OPT_PASSTHROUGH_DATACLASS
+    if orjson is not None
+    else 0
+)
+
 
 class CustomJsonProvider(DefaultJSONProvider):
+    """CustomJsonProvider knows how to serialise blooms, users and datetimes.
+
+    Compact responses are written with orjson, if it is installed. Its output differs from
+    the standard library's in that it doesn't escape non-ASCII characters, and formats
+    floats differently (e.g. 1e-7 rather than 1e-07, and null for NaN), so we fall back to
+    the standard library whenever the response contains floats or the output isn't ASCII,
+    or when orjson can't encode something (like integers over 64 bits).
+    """
+
     def __init__(self, *args, **kwargs):
         DefaultJSONProvider.__init__(self, *args, **kwargs)
         original_default = self.default
-        self.default = lambda x: (
-            x.isoformat() if isinstance(x, datetime) else original_default(x)
-        )
+
+        def default(x):
+            encoder = ENCODERS.get(type(x))
+            if encoder is not None:
+                return encoder(x)
+            if isinstance(x, datetime):
+                return x.isoformat()
+            return original_default(x)
+
+        self.default = default
+
+    def response(self, *args, **kwargs) -> Response:
+        if orjson is None or not self.ensure_ascii or not self.sort_keys:
+            return super().response(*args, **kwargs)
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        if may_contain_floats(obj):
+            return super().response(*args, **kwargs)
+        try:
+            serialised = orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            serialised = None
+        if serialised is None or not serialised.isascii():
+            return super().response(*args, **kwargs)
+        return self._app.response_class(serialised + b"\n", mimetype=self.mimetype)
+
+
+def encode_bloom(bloom: Bloom) -> Dict[str, Any]:
+    # Bloom ids use all 64 bits, but JavaScript numbers can only represent integers up
+    # to 2**53 exactly, so ids are sent as strings.
+    return {
+        "id": str(bloom.id),
+        "sender": bloom.sender,
+        "content": bloom.content,
+        "sent_timestamp": bloom.sent_timestamp.isoformat(),
+    }
+
+
+def encode_user(user: User) -> Dict[str, Any]:
+    # Never send password hashes or salts to clients.
+    return {"id": user.id, "username": user.username}
+
+
+# Encoders by exact type, which is quicker to look up than a chain of isinstance checks.
+ENCODERS: Dict[type, Callable[[Any], Any]] = {
+    Bloom: encode_bloom,
+    User: encode_user,
+    datetime: datetime.isoformat,
+}
+
+# Types which never contain floats: none of ENCODERS' encodings do.
+FLOATLESS_TYPES = frozenset([str, int, bool, type(None), *ENCODERS])
+
+
+def may_contain_floats(obj: Any) -> bool:
+    """may_contain_floats returns whether obj contains floats, or objects (like dataclasses)
+    which might."""
+    obj_type = type(obj)
+    if obj_type in FLOATLESS_TYPES:
+        return False
+    if obj_type is list or obj_type is tuple:
+        return any(map(may_contain_floats, obj))
+    if obj_type is dict:
+        return any(map(may_contain_floats, obj.values()))
+    return True
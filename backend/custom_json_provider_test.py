@@ -2,13 +2,50 @@ import datetime
 import unittest
 
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 
 from custom_json_provider import CustomJsonProvider
+from data.blooms import Bloom
+from data.users import ScryptParams, User
+
+
+class ReferenceJsonProvider(CustomJsonProvider):
+    """ReferenceJsonProvider is CustomJsonProvider without its fast path: it always uses the
+    standard library."""
+
+    def response(self, *args, **kwargs):
+        return DefaultJSONProvider.response(self, *args, **kwargs)
+
+
+def make_blooms(count):
+    start = datetime.datetime(2020, 3, 4, 14, 15, 16, 123456)
+    return [
+        Bloom(
+            id=370068687526014976 + i,
+            sender=f"user{i % 7}",
+            content=f"Bloom number {i} about #topic{i % 3}",
+            sent_timestamp=start + datetime.timedelta(seconds=i),
+        )
+        for i in range(count)
+    ]
 
 
 class TestCustomJsonProvider(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask("Dummy")
+        self.provider = CustomJsonProvider(self.app)
+        self.reference = ReferenceJsonProvider(self.app)
+
+    def assertSameResponse(self, obj):
+        self.assertEqual(self.provider.dumps(obj), self.reference.dumps(obj))
+        with self.app.app_context():
+            self.assertEqual(
+                self.provider.response(obj).get_data(),
+                self.reference.response(obj).get_data(),
+            )
+
     def test_datetime(self):
-        serialised = CustomJsonProvider(Flask("Dummy")).dumps(
+        serialised = self.provider.dumps(
             {
                 "timestamp": datetime.datetime(
                     year=2020,
@@ -23,6 +60,127 @@ class TestCustomJsonProvider(unittest.TestCase):
         )
         self.assertEqual(serialised, """{"timestamp": "2020-03-04T14:15:16+00:00"}""")
 
+    def test_bloom_id_is_a_string(self):
+        serialised = self.provider.dumps(
+            Bloom(
+                id=370068687526014976,
+                sender="sample",
+                content="Hi there",
+                sent_timestamp=datetime.datetime(2020, 3, 4, 14, 15, 16),
+            )
+        )
+        self.assertEqual(
+            serialised,
+            """{"content": "Hi there", "id": "370068687526014976", "sender": "sample", "sent_timestamp": "2020-03-04T14:15:16"}""",
+        )
+
+    def test_user_has_no_password(self):
+        user = User(
+            id=1,
+            username="sample",
+            password_salt=b"salt",
+            password_scrypt=b"hash",
+            scrypt_params=ScryptParams(n=8, r=8, p=1),
+        )
+        self.assertEqual(
+            self.provider.dumps(user), """{"id": 1, "username": "sample"}"""
+        )
+
+    def test_responses_match_reference(self):
+        blooms = make_blooms(20)
+        cases = [
+            blooms,
+            blooms[0],
+            [],
+            {
+                "username": "sample",
+                "recent_blooms": blooms[:3],
+                "follows": ["a", "b"],
+                "follower_count": 2,
+                "is_following": False,
+                "last_seen": datetime.datetime(2020, 1, 1, tzinfo=datetime.UTC),
+            },
+            {"success": True, "message": 'Quote " and backslash \\ and\ttab\n'},
+            {"z": None, "a": [1, 2, {"c": 3, "b": 4}]},
+        ]
+        for obj in cases:
+            with self.subTest(obj=obj):
+                self.assertSameResponse(obj)
+
+    def test_non_ascii_matches_reference(self):
+        bloom = make_blooms(1)[0]
+        bloom.content = "Grüße 🌸"
+        self.assertSameResponse([bloom])
+
+    def test_floats_match_reference(self):
+        self.assertSameResponse(
+            {
+                "score": 1e-07,
+                "expected": 2.5e-05,
+                "count": 1e16,
+                "ratio": 0.5,
+                "unknown": [float("nan"), float("inf")],
+            }
+        )
+
+    def test_fixtures(self):
+        # Written by the provider before orjson, which responses must match byte for byte.
+        blooms = [
+            Bloom(
+                id=370068687526014976,
+                sender="zoë",
+                content="Grüße 🌸 #blümchen",
+                sent_timestamp=datetime.datetime(2020, 3, 4, 14, 15, 16, 123456),
+            ),
+            Bloom(
+                id=370068687526014977,
+                sender="sample",
+                content="Hi",
+                sent_timestamp=datetime.datetime(
+                    2020, 3, 4, 14, 15, 17, tzinfo=datetime.UTC
+                ),
+            ),
+        ]
+        fixtures = [
+            (
+                blooms,
+                r'[{"content": "Gr\u00fc\u00dfe \ud83c\udf38 #bl\u00fcmchen", "id": "370068687526014976", "sender": "zo\u00eb", "sent_timestamp": "2020-03-04T14:15:16.123456"}, {"content": "Hi", "id": "370068687526014977", "sender": "sample", "sent_timestamp": "2020-03-04T14:15:17+00:00"}]',
+                rb'[{"content":"Gr\u00fc\u00dfe \ud83c\udf38 #bl\u00fcmchen","id":"370068687526014976","sender":"zo\u00eb","sent_timestamp":"2020-03-04T14:15:16.123456"},{"content":"Hi","id":"370068687526014977","sender":"sample","sent_timestamp":"2020-03-04T14:15:17+00:00"}]'
+                + b"\n",
+            ),
+            (
+                {
+                    "username": "sample",
+                    "follower_count": 2,
+                    "last_seen": datetime.datetime(2020, 1, 1, tzinfo=datetime.UTC),
+                },
+                '{"follower_count": 2, "last_seen": "2020-01-01T00:00:00+00:00", "username": "sample"}',
+                b'{"follower_count":2,"last_seen":"2020-01-01T00:00:00+00:00","username":"sample"}\n',
+            ),
+            (
+                {
+                    "score": 1e-07,
+                    "ratio": 0.5,
+                    "count": 1e16,
+                    "unknown": [float("nan"), float("inf")],
+                },
+                '{"count": 1e+16, "ratio": 0.5, "score": 1e-07, "unknown": [NaN, Infinity]}',
+                b'{"count":1e+16,"ratio":0.5,"score":1e-07,"unknown":[NaN,Infinity]}\n',
+            ),
+        ]
+        for obj, dumped, response in fixtures:
+            with self.subTest(obj=obj):
+                self.assertEqual(self.provider.dumps(obj), dumped)
+                with self.app.app_context():
+                    self.assertEqual(self.provider.response(obj).get_data(), response)
+
+    def test_huge_integers_match_reference(self):
+        self.assertSameResponse({"big": 2**70})
+
+    def test_pretty_printed_in_debug(self):
+        self.app.debug = True
+        self.assertSameResponse(make_blooms(2))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,136 +1,473 @@
+import base64
+import binascii
 import datetime
+import re
+import unicodedata
 
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from itertools import starmap
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple
 
+from data import notifications
 from data.connection import db_cursor
+from data.hashtags import add_to_dictionary, normalize_hashtag
+from data.ids import next_ids
+from data.recent_writers import record_write
+from data.timelines import fan_out_blooms
+from data.trending import count_hashtags
 from data.users import User
+from psycopg2.extras import execute_values
 
 
-@dataclass
+# Blooms are made in bulk from query rows, so they have slots rather than a __dict__ to
+# keep them small. Fields are in the same order as the columns we select, so a row can
+# be passed straight to the constructor.
+@dataclass(slots=True)
 class Bloom:
     id: int
-    sender: User
+    sender: str
     content: str
     sent_timestamp: datetime.datetime
 
 
+@dataclass(frozen=True)
+class Cursor:
+    """Cursor identifies a position in a newest-first list of blooms."""
+
+    send_timestamp: datetime.datetime
+    id: int
+
+
+# A # which doesn't follow a letter, digit or underscore (so not C# or issue#3), and the
+# letters, digits and underscores after it. \w doesn't match combining marks, which many
+# scripts (e.g. Devanagari) need in their words, so find_hashtags carries tags on past them.
+HASHTAG_PATTERN = re.compile(r"(?<!\w)#(\w+)")
+WORD_PATTERN = re.compile(r"\w*")
+
+# How many blooms stream_blooms fetches from the database at a time.
+STREAM_CHUNK_SIZE = 500
+
+# add_blooms notifies this channel of new blooms, with payloads of the sender's id and the
+# blooms' ids, separated by spaces.
+BLOOMS_CHANNEL = "blooms"
+# Payloads must be under 8000 bytes, and ids have at most 20 characters with the space.
+IDS_PER_NOTIFICATION = 300
+
+# Called with the new blooms after add_blooms commits them.
+_bloom_listeners: List[Callable[[List[Bloom]], None]] = []
+
+
+def add_bloom_listener(listener: Callable[[List[Bloom]], None]) -> None:
+    _bloom_listeners.append(listener)
+
+
 def add_bloom(*, sender: User, content: str) -> Bloom:
-    hashtags = [word[1:] for word in content.split(" ") if word.startswith("#")]
+    return add_blooms(sender=sender, contents=[content])[0]
 
+
+def add_blooms(*, sender: User, contents: List[str]) -> List[Bloom]:
+    """add_blooms sends many blooms from one sender in a single transaction, using
+    multi-row inserts for the blooms and their hashtags."""
     now = datetime.datetime.now(tz=datetime.UTC)
-    bloom_id = int(now.timestamp() * 1000000)
+    new_blooms = [
+        Bloom(
+            id=bloom_id,
+            sender=sender.username,
+            content=content,
+            sent_timestamp=now,
+        )
+        for bloom_id, content in zip(next_ids(len(contents)), contents)
+    ]
+    if not new_blooms:
+        return new_blooms
+
     with db_cursor() as cur:
+        execute_values(
+            cur,
+            "INSERT INTO blooms (id, sender_id, content, send_timestamp) VALUES %s",
+            [(bloom.id, sender.id, bloom.content, now) for bloom in new_blooms],
+        )
+        hashtags = {
+            (hashtag, bloom.id)
+            for bloom in new_blooms
+            for hashtag in extract_hashtags(bloom.content)
+        }
+        insert_hashtags(cur, list(hashtags))
         cur.execute(
-            "INSERT INTO blooms (id, sender_id, content, send_timestamp) VALUES (%(bloom_id)s, %(sender_id)s, %(content)s, %(timestamp)s)",
-            dict(
-                bloom_id=bloom_id,
-                sender_id=sender.id,
-                content=content,
-                timestamp=datetime.datetime.now(datetime.UTC),
-            ),
+            "UPDATE users SET bloom_count = bloom_count + %(count)s, last_bloom_at = %(timestamp)s WHERE id = %(sender_id)s",
+            dict(sender_id=sender.id, count=len(new_blooms), timestamp=now),
         )
-        for hashtag in hashtags:
-            cur.execute(
-                "INSERT INTO hashtags (hashtag, bloom_id) VALUES (%(hashtag)s, %(bloom_id)s)",
-                dict(hashtag=hashtag, bloom_id=bloom_id),
+        fan_out_blooms(
+            cur, sender_id=sender.id, blooms=[(bloom.id, now) for bloom in new_blooms]
+        )
+        add_to_dictionary(cur, [hashtag for hashtag, _ in hashtags])
+        count_hashtags(cur, now, [hashtag for hashtag, _ in hashtags])
+        for start in range(0, len(new_blooms), IDS_PER_NOTIFICATION):
+            ids = " ".join(
+                str(bloom.id)
+                for bloom in new_blooms[start : start + IDS_PER_NOTIFICATION]
             )
+            notifications.notify(cur, BLOOMS_CHANNEL, f"{sender.id} {ids}")
+        record_write(cur, sender.username)
+    for listener in _bloom_listeners:
+        listener(new_blooms)
+    return new_blooms
+
+
+def extract_hashtags(content: str) -> List[str]:
+    """extract_hashtags returns the normalized hashtags in content, in order, with repeats."""
+    # Compose accented letters first, where they can be.
+    return [
+        normalize_hashtag(hashtag)
+        for hashtag in find_hashtags(unicodedata.normalize("NFKC", content))
+    ]
+
+
+def find_hashtags(content: str) -> List[str]:
+    """find_hashtags returns the hashtags in content as they are written, in order."""
+    hashtags = []
+    for match in HASHTAG_PATTERN.finditer(content):
+        start = match.start()
+        if start > 0 and is_mark(content[start - 1]):
+            continue
+        end = match.end()
+        while end < len(content) and is_mark(content[end]):
+            end = WORD_PATTERN.match(content, end + 1).end()
+        hashtags.append(content[start + 1 : end])
+    return hashtags
+
+
+def is_mark(character: str) -> bool:
+    return unicodedata.category(character).startswith("M")
+
+
+def insert_hashtags(cur, hashtags: List[Tuple[str, int]]) -> None:
+    """insert_hashtags inserts (hashtag, bloom id) pairs with multi-row INSERTs."""
+    if not hashtags:
+        return
+    execute_values(
+        cur,
+        "INSERT INTO hashtags (hashtag, bloom_id) VALUES %s ON CONFLICT DO NOTHING",
+        hashtags,
+    )
+
+
+def reindex_hashtags(cur, blooms: List[Tuple[int, str]]) -> int:
+    """reindex_hashtags makes the stored hashtags of blooms, given as (id, content), match
+    what extract_hashtags finds in them now, and returns how many blooms it changed.
+
+    It doesn't update the hashtag dictionary or trend counts; rebuild them afterwards.
+    """
+    expected = {
+        (hashtag, bloom_id)
+        for bloom_id, content in blooms
+        for hashtag in extract_hashtags(content)
+    }
+    cur.execute(
+        "SELECT hashtag, bloom_id FROM hashtags WHERE bloom_id = ANY(%s)",
+        ([bloom_id for bloom_id, _ in blooms],),
+    )
+    stored = set(cur.fetchall())
+    stale = stored - expected
+    missing = expected - stored
+    if stale:
+        execute_values(
+            cur,
+            "DELETE FROM hashtags WHERE (hashtag, bloom_id) IN (VALUES %s)",
+            sorted(stale),
+        )
+    insert_hashtags(cur, sorted(missing))
+    return len({bloom_id for _, bloom_id in stale | missing})
 
 
 def get_blooms_for_user(
-    username: str, *, before: Optional[int] = None, limit: Optional[int] = None
+    username: str, *, before: Optional[Cursor] = None, limit: Optional[int] = None
 ) -> List[Bloom]:
-    with db_cursor() as cur:
-        kwargs = {
-            "sender_username": username,
-        }
-        if before is not None:
-            before_clause = "AND send_timestamp < %(before_limit)s"
-            kwargs["before_limit"] = before
-        else:
-            before_clause = ""
+    query, kwargs = blooms_for_user_query(username, before=before, limit=limit)
+    with db_cursor(readonly=True) as cur:
+        cur.execute(query, kwargs)
+        return rows_to_blooms(cur.fetchall())
+
+
+def stream_blooms_for_user(
+    username: str, *, before: Optional[Cursor] = None, limit: Optional[int] = None
+) -> Generator[Bloom, None, None]:
+    """stream_blooms_for_user is like get_blooms_for_user, but yields the blooms as they are read."""
+    return stream_blooms(
+        lambda before, limit: blooms_for_user_query(
+            username, before=before, limit=limit
+        ),
+        before=before,
+        limit=limit,
+    )
+
+
+def blooms_for_user_query(
+    username: str, *, before: Optional[Cursor], limit: Optional[int]
+) -> Tuple[str, Dict[str, Any]]:
+    kwargs = {
+        "sender_username": username,
+    }
+    before_clause = make_before_clause(
+        before, kwargs, timestamp_column="send_timestamp", id_column="blooms.id"
+    )
+    limit_clause = make_limit_clause(limit, kwargs)
+    query = f"""SELECT
+      blooms.id, users.username, content, send_timestamp
+    FROM
+      blooms INNER JOIN users ON users.id = blooms.sender_id
+    WHERE
+      username = %(sender_username)s
+      {before_clause}
+    ORDER BY send_timestamp DESC, blooms.id DESC
+    {limit_clause}
+    """
+    return query, kwargs
+
 
-        limit_clause = make_limit_clause(limit, kwargs)
+def get_home_timeline(
+    user: User,
+    *,
+    before: Optional[Cursor] = None,
+    after: Optional[Cursor] = None,
+    limit: int,
+) -> List[Bloom]:
+    """get_home_timeline returns the newest blooms from user and the users they follow,
+    optionally only those before and/or after a cursor.
 
+    Most blooms are read from the user's materialized timeline; blooms from followed
+    celebrities were never fanned out, so they are merged in from the blooms table.
+    """
+    kwargs = {"user_id": user.id}
+    timeline_cursor_clauses = make_before_clause(
+        before, kwargs, timestamp_column="send_timestamp", id_column="bloom_id"
+    ) + make_after_clause(
+        after, kwargs, timestamp_column="send_timestamp", id_column="bloom_id"
+    )
+    celebrity_cursor_clauses = make_before_clause(
+        before, kwargs, timestamp_column="send_timestamp", id_column="id"
+    ) + make_after_clause(
+        after, kwargs, timestamp_column="send_timestamp", id_column="id"
+    )
+    limit_clause = make_limit_clause(limit, kwargs)
+    with db_cursor(readonly=True) as cur:
         cur.execute(
             f"""SELECT
-              blooms.id, users.username, content, send_timestamp
+              blooms.id, users.username, content, blooms.send_timestamp
             FROM
-              blooms INNER JOIN users ON users.id = blooms.sender_id
-            WHERE
-              username = %(sender_username)s
-              {before_clause}
-            ORDER BY send_timestamp DESC
+              (
+                (
+                  SELECT bloom_id FROM timelines
+                  WHERE user_id = %(user_id)s
+                  {timeline_cursor_clauses}
+                  ORDER BY send_timestamp DESC, bloom_id DESC
+                  {limit_clause}
+                )
+                UNION
+                (
+                  SELECT id FROM blooms
+                  WHERE sender_id IN (
+                    SELECT followee FROM follows
+                    INNER JOIN celebrities ON celebrities.user_id = follows.followee
+                    WHERE follower = %(user_id)s
+                  )
+                  {celebrity_cursor_clauses}
+                  ORDER BY send_timestamp DESC, id DESC
+                  {limit_clause}
+                )
+              ) AS timeline
+              INNER JOIN blooms ON blooms.id = timeline.bloom_id
+              INNER JOIN users ON users.id = blooms.sender_id
+            ORDER BY blooms.send_timestamp DESC, blooms.id DESC
             {limit_clause}
             """,
             kwargs,
         )
-        rows = cur.fetchall()
-        blooms = []
-        for row in rows:
-            bloom_id, sender_username, content, timestamp = row
-            blooms.append(
-                Bloom(
-                    id=bloom_id,
-                    sender=sender_username,
-                    content=content,
-                    sent_timestamp=timestamp,
-                )
-            )
-    return blooms
+        return rows_to_blooms(cur.fetchall())
 
 
 def get_bloom(bloom_id: int) -> Optional[Bloom]:
+    # Blooms too new to have reached a replica yet are looked up on the primary.
+    for readonly in [True, False]:
+        with db_cursor(readonly=readonly) as cur:
+            cur.execute(
+                "SELECT blooms.id, users.username, content, send_timestamp FROM blooms INNER JOIN users ON users.id = blooms.sender_id WHERE blooms.id = %s",
+                (bloom_id,),
+            )
+            row = cur.fetchone()
+        if row is not None:
+            break
+    if row is None:
+        return None
+    bloom_id, sender_username, content, timestamp = row
+    return Bloom(
+        id=bloom_id,
+        sender=sender_username,
+        content=content,
+        sent_timestamp=timestamp,
+    )
+
+
+def get_blooms(bloom_ids: List[int]) -> List[Bloom]:
+    """get_blooms returns the blooms with the given ids which exist, oldest first. It reads
+    from the primary, as it is used to fetch blooms which have only just been sent."""
     with db_cursor() as cur:
         cur.execute(
-            "SELECT blooms.id, users.username, content, send_timestamp FROM blooms INNER JOIN users ON users.id = blooms.sender_id WHERE blooms.id = %s",
-            (bloom_id,),
-        )
-        row = cur.fetchone()
-        if row is None:
-            return None
-        bloom_id, sender_username, content, timestamp = row
-        return Bloom(
-            id=bloom_id,
-            sender=sender_username,
-            content=content,
-            sent_timestamp=timestamp,
+            """SELECT blooms.id, users.username, content, send_timestamp
+            FROM blooms INNER JOIN users ON users.id = blooms.sender_id
+            WHERE blooms.id = ANY(%s)
+            ORDER BY send_timestamp, blooms.id""",
+            (bloom_ids,),
         )
+        return rows_to_blooms(cur.fetchall())
 
 
 def get_blooms_with_hashtag(
-    hashtag_without_leading_hash: str, *, limit: int = None
+    hashtag_without_leading_hash: str,
+    *,
+    before: Optional[Cursor] = None,
+    limit: Optional[int] = None,
 ) -> List[Bloom]:
+    query, kwargs = blooms_with_hashtag_query(
+        hashtag_without_leading_hash, before=before, limit=limit
+    )
+    with db_cursor(readonly=True) as cur:
+        cur.execute(query, kwargs)
+        return rows_to_blooms(cur.fetchall())
+
+
+def stream_blooms_with_hashtag(
+    hashtag_without_leading_hash: str,
+    *,
+    before: Optional[Cursor] = None,
+    limit: Optional[int] = None,
+) -> Generator[Bloom, None, None]:
+    """stream_blooms_with_hashtag is like get_blooms_with_hashtag, but yields the blooms as they are read."""
+    return stream_blooms(
+        lambda before, limit: blooms_with_hashtag_query(
+            hashtag_without_leading_hash, before=before, limit=limit
+        ),
+        before=before,
+        limit=limit,
+    )
+
+
+def blooms_with_hashtag_query(
+    hashtag_without_leading_hash: str,
+    *,
+    before: Optional[Cursor],
+    limit: Optional[int],
+) -> Tuple[str, Dict[str, Any]]:
     kwargs = {
         "hashtag_without_leading_hash": hashtag_without_leading_hash,
     }
+    before_clause = make_before_clause(
+        before, kwargs, timestamp_column="send_timestamp", id_column="blooms.id"
+    )
     limit_clause = make_limit_clause(limit, kwargs)
-    with db_cursor() as cur:
-        cur.execute(
-            f"""SELECT
-              blooms.id, users.username, content, send_timestamp
-            FROM
-              blooms INNER JOIN hashtags ON blooms.id = hashtags.bloom_id INNER JOIN users ON blooms.sender_id = users.id
-            WHERE
-              hashtag = %(hashtag_without_leading_hash)s
-            ORDER BY send_timestamp DESC
-            {limit_clause}
-            """,
-            kwargs,
+    query = f"""SELECT
+      blooms.id, users.username, content, send_timestamp
+    FROM
+      blooms INNER JOIN hashtags ON blooms.id = hashtags.bloom_id INNER JOIN users ON blooms.sender_id = users.id
+    WHERE
+      hashtag = %(hashtag_without_leading_hash)s
+      {before_clause}
+    ORDER BY send_timestamp DESC, blooms.id DESC
+    {limit_clause}
+    """
+    return query, kwargs
+
+
+def stream_blooms(
+    make_query: Callable[[Optional[Cursor], Optional[int]], Tuple[str, Dict[str, Any]]],
+    *,
+    before: Optional[Cursor],
+    limit: Optional[int],
+) -> Generator[Bloom, None, None]:
+    """stream_blooms yields the blooms make_query(before, limit) selects, newest first,
+    fetching STREAM_CHUNK_SIZE of them at a time, so memory use doesn't grow with the
+    number of blooms.
+
+    Each chunk is its own keyset query starting before the last bloom of the one before, and
+    the connection goes back to the pool between chunks, so a slow client doesn't hold one
+    while it downloads.
+    """
+    while limit is None or limit > 0:
+        chunk_size = (
+            STREAM_CHUNK_SIZE if limit is None else min(limit, STREAM_CHUNK_SIZE)
         )
-        rows = cur.fetchall()
-        blooms = []
-        for row in rows:
-            bloom_id, sender_username, content, timestamp = row
-            blooms.append(
-                Bloom(
-                    id=bloom_id,
-                    sender=sender_username,
-                    content=content,
-                    sent_timestamp=timestamp,
-                )
-            )
-    return blooms
+        query, kwargs = make_query(before, chunk_size)
+        with db_cursor(readonly=True) as cur:
+            cur.execute(query, kwargs)
+            chunk = rows_to_blooms(cur.fetchall())
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        before = Cursor(send_timestamp=chunk[-1].sent_timestamp, id=chunk[-1].id)
+        if limit is not None:
+            limit -= chunk_size
+
+
+def rows_to_blooms(rows: List[Tuple[Any, ...]]) -> List[Bloom]:
+    """rows_to_blooms makes blooms from rows of (id, sender username, content, send_timestamp).
+
+    This still calls Bloom once per row: psycopg2 has no row factory which builds anything
+    but its own tuples without a Python call per row (NamedTupleCursor calls _make), and a
+    tuple-backed Bloom built that way is bigger and slower than this one (see
+    benchmarks.bloom_memory). Only using the rows themselves would be cheaper.
+    """
+    return list(starmap(Bloom, rows))
+
+
+def encode_cursor(bloom: Bloom) -> str:
+    """encode_cursor returns an opaque cursor for fetching the blooms sent before bloom."""
+    raw = f"{bloom.sent_timestamp.isoformat()}|{bloom.id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Cursor:
+    """decode_cursor parses a cursor made by encode_cursor, raising ValueError if it is invalid."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, bloom_id = raw.decode("utf-8").split("|")
+        return Cursor(
+            send_timestamp=datetime.datetime.fromisoformat(timestamp),
+            id=int(bloom_id),
+        )
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def make_before_clause(
+    before: Optional[Cursor],
+    kwargs: Dict[Any, Any],
+    *,
+    timestamp_column: str,
+    id_column: str,
+) -> str:
+    if before is not None:
+        before_clause = f"AND ({timestamp_column}, {id_column}) < (%(before_timestamp)s, %(before_id)s)"
+        kwargs["before_timestamp"] = before.send_timestamp
+        kwargs["before_id"] = before.id
+    else:
+        before_clause = ""
+    return before_clause
+
+
+def make_after_clause(
+    after: Optional[Cursor],
+    kwargs: Dict[Any, Any],
+    *,
+    timestamp_column: str,
+    id_column: str,
+) -> str:
+    if after is not None:
+        after_clause = f"AND ({timestamp_column}, {id_column}) > (%(after_timestamp)s, %(after_id)s)"
+        kwargs["after_timestamp"] = after.send_timestamp
+        kwargs["after_id"] = after.id
+    else:
+        after_clause = ""
+    return after_clause
 
 
 def make_limit_clause(limit: Optional[int], kwargs: Dict[Any, Any]) -> str:
@@ -0,0 +1,134 @@
+import datetime
+import unittest
+from contextlib import contextmanager
+from unittest import mock
+
+from data.blooms import (
+    Bloom,
+    Cursor,
+    decode_cursor,
+    encode_cursor,
+    extract_hashtags,
+    stream_blooms,
+)
+from data.hashtags import normalize_hashtag
+
+
+class TestCursor(unittest.TestCase):
+    def test_round_trip(self):
+        bloom = Bloom(
+            id=1234,
+            sender="sample",
+            content="Hi there",
+            sent_timestamp=datetime.datetime(2020, 3, 4, 14, 15, 16, 170000),
+        )
+        self.assertEqual(
+            decode_cursor(encode_cursor(bloom)),
+            Cursor(send_timestamp=bloom.sent_timestamp, id=1234),
+        )
+
+    def test_invalid(self):
+        for cursor in ["", "not a cursor", "bm90fGFuaWQ"]:
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+
+class TestExtractHashtags(unittest.TestCase):
+    def test_extract_hashtags(self):
+        self.assertEqual(
+            extract_hashtags("Go #SwizBiz!! and\n#Tabs\t#one,#two (#three) #"),
+            ["swizbiz", "tabs", "one", "two", "three"],
+        )
+
+    def test_only_hashtags_starting_words(self):
+        self.assertEqual(extract_hashtags("C# and issue#3, ##tag"), ["tag"])
+
+    def test_normalizes_hashtags(self):
+        self.assertEqual(
+            extract_hashtags("#Straße #ＳｗｉｚＢｉｚ #cafe\u0301"),
+            ["strasse", "swizbiz", "caf\u00e9"],
+        )
+
+    def test_normalize_hashtag_matches_extracted_hashtags(self):
+        for hashtag in ["ℌello", "ＳｗｉｚＢｉｚ", "Straße", "ﬁx"]:
+            with self.subTest(hashtag=hashtag):
+                self.assertEqual(
+                    [normalize_hashtag(hashtag)], extract_hashtags(f"#{hashtag}")
+                )
+
+    def test_combining_marks(self):
+        # Devanagari vowel signs and viramas are combining marks, within words.
+        self.assertEqual(extract_hashtags("#हिन्दी #தமிழ் क#no"), ["हिन्दी", "தமிழ்"])
+
+
+class TestStreamBlooms(unittest.TestCase):
+    def setUp(self):
+        start = datetime.datetime(2020, 3, 4)
+        # Newest first, with two blooms in the same second to check ids break ties.
+        self.rows = [
+            (
+                bloom_id,
+                "sample",
+                f"Bloom {bloom_id}",
+                start + datetime.timedelta(seconds=bloom_id // 2),
+            )
+            for bloom_id in range(11, 0, -1)
+        ]
+        self.connections_held = 0
+        self.queries = []
+
+    @contextmanager
+    def fake_db_cursor(self, readonly):
+        self.assertTrue(readonly)
+        self.connections_held += 1
+        cur = mock.Mock()
+
+        def execute(query, kwargs):
+            self.queries.append(kwargs)
+            before = kwargs["before"]
+            rows = [
+                row
+                for row in self.rows
+                if before is None
+                or (row[3], row[0]) < (before.send_timestamp, before.id)
+            ]
+            cur.fetchall.return_value = rows[: kwargs["limit"]]
+
+        cur.execute.side_effect = execute
+        try:
+            yield cur
+        finally:
+            self.connections_held -= 1
+
+    def stream(self, **kwargs):
+        with mock.patch("data.blooms.db_cursor", self.fake_db_cursor), mock.patch(
+            "data.blooms.STREAM_CHUNK_SIZE", 4
+        ):
+            for bloom in stream_blooms(
+                lambda before, limit: ("", {"before": before, "limit": limit}),
+                **kwargs,
+            ):
+                # The connection is back in the pool while blooms are sent.
+                self.assertEqual(self.connections_held, 0)
+                yield bloom.id
+
+    def test_streams_every_bloom_a_chunk_at_a_time(self):
+        self.assertEqual(
+            list(self.stream(before=None, limit=None)), list(range(11, 0, -1))
+        )
+        self.assertEqual([query["limit"] for query in self.queries], [4, 4, 4])
+
+    def test_limit_and_before(self):
+        before = Cursor(send_timestamp=self.rows[1][3], id=self.rows[1][0])
+        self.assertEqual(list(self.stream(before=before, limit=6)), [9, 8, 7, 6, 5, 4])
+        self.assertEqual([query["limit"] for query in self.queries], [4, 2])
+
+    def test_stops_after_an_exact_limit(self):
+        self.assertEqual(
+            list(self.stream(before=None, limit=8)), list(range(11, 3, -1))
+        )
+        self.assertEqual(len(self.queries), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
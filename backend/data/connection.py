@@ -1,16 +1,543 @@
+"""Connections to the database: a pool of them to the primary, and one to each replica.
+
+Cursors run on the primary unless they ask for db_cursor(readonly=True), in which case
+they may run on any replica in POSTGRES_REPLICAS which isn't more than
+POSTGRES_REPLICA_MAX_LAG_SECONDS behind. Each process checks how far behind its replicas
+are every POSTGRES_REPLICA_CHECK_SECONDS, from a thread of its own; until a replica has
+been checked, and whenever it can't be, it isn't read from.
+
+Reads from a replica may not include writes made moments ago, so contexts which need to
+see them (e.g. requests by users who just wrote something) call read_from_primary.
+"""
+
 from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+import logging
+import math
 import os
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
 import psycopg2
 
+logger = logging.getLogger(__name__)
 
-@contextmanager
-def db_cursor():
-    with psycopg2.connect(
+# Replicas to read from, as comma-separated host:port addresses. They are connected to
+# with the same database name, user and password as the primary.
+REPLICAS = [
+    address.strip()
+    for address in os.getenv("POSTGRES_REPLICAS", "").split(",")
+    if address.strip()
+]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("POSTGRES_REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_CHECK_SECONDS = float(os.getenv("POSTGRES_REPLICA_CHECK_SECONDS", "2"))
+
+# How many seconds of the primary's transactions a replica is yet to replay. It has
+# replayed everything it has received if the primary is quiet, so that's no lag, unless it
+# isn't receiving anything: then it isn't a replica, or has lost the primary. Just after a
+# quiet spell, this overestimates until the first new transaction is replayed.
+REPLICATION_LAG_QUERY = """SELECT CASE
+  WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver) THEN NULL
+  WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+  ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END"""
+
+
+class PoolTimeoutError(Exception):
+    """PoolTimeoutError is raised when no connection could be checked out in time."""
+
+
+@dataclass
+class PoolStats:
+    in_use: int
+    idle: int
+    max_size: int
+    checkouts: int
+    waits: int
+    total_wait_seconds: float
+    max_wait_seconds: float
+    connections_opened: int
+    connections_discarded: int
+
+
+class _PooledConnection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+
+
+class ConnectionPool:
+    """ConnectionPool is a bounded, thread-safe pool of database connections.
+
+    Connections which have sat idle for longer than check_after_idle are health-checked
+    when they are checked out, and connections are closed and replaced once they are
+    older than max_lifetime or have been idle for longer than max_idle.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], object],
+        *,
+        min_size: int = 1,
+        max_size: int = 10,
+        timeout: float = 10.0,
+        max_lifetime: float = 30 * 60,
+        max_idle: float = 5 * 60,
+        check_after_idle: float = 30.0,
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(
+                f"Invalid pool size: min_size={min_size}, max_size={max_size}"
+            )
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_after_idle = check_after_idle
+
+        self._lock = threading.Condition()
+        self._idle: List[_PooledConnection] = []
+        self._in_use = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._waits = 0
+        self._total_wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._connections_opened = 0
+        self._connections_discarded = 0
+
+        for _ in range(min_size):
+            self._idle.append(self._open())
+
+    def _open(self) -> _PooledConnection:
+        pooled = _PooledConnection(self._connect())
+        with self._lock:
+            self._connections_opened += 1
+        return pooled
+
+    def _discard(self, pooled: _PooledConnection) -> None:
+        with self._lock:
+            self._connections_discarded += 1
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
+
+    def _is_stale(self, pooled: _PooledConnection, now: float) -> bool:
+        return (
+            now - pooled.created_at > self.max_lifetime
+            or now - pooled.last_used_at > self.max_idle
+        )
+
+    def _is_healthy(self, pooled: _PooledConnection, now: float) -> bool:
+        conn = pooled.conn
+        if conn.closed:
+            return False
+        if now - pooled.last_used_at < self.check_after_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self) -> _PooledConnection:
+        """getconn checks out a healthy connection, waiting up to timeout for one to be free."""
+        started_at = time.monotonic()
+        deadline = started_at + self.timeout
+        waited = False
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise PoolTimeoutError("Connection pool is closed")
+                if self._idle:
+                    pooled = self._idle.pop()
+                    break
+                if self._in_use < self.max_size:
+                    pooled = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError(
+                        f"Timed out after {self.timeout}s waiting for a database connection"
+                    )
+                waited = True
+                self._lock.wait(remaining)
+            # Reserve the slot before doing any I/O outside the lock.
+            self._in_use += 1
+            self._checkouts += 1
+            wait_seconds = time.monotonic() - started_at
+            if waited:
+                self._waits += 1
+            self._total_wait_seconds += wait_seconds
+            self._max_wait_seconds = max(self._max_wait_seconds, wait_seconds)
+
+        try:
+            now = time.monotonic()
+            if pooled is not None and (
+                self._is_stale(pooled, now) or not self._is_healthy(pooled, now)
+            ):
+                self._discard(pooled)
+                pooled = None
+            if pooled is None:
+                pooled = self._open()
+        except BaseException:
+            with self._lock:
+                self._in_use -= 1
+                self._lock.notify()
+            raise
+        return pooled
+
+    def putconn(self, pooled: _PooledConnection, *, discard: bool = False) -> None:
+        """putconn returns a checked-out connection to the pool, or closes it if discard is set."""
+        pooled.last_used_at = time.monotonic()
+        with self._lock:
+            self._in_use -= 1
+            keep = not discard and not self._closed and not pooled.conn.closed
+            if keep:
+                self._idle.append(pooled)
+            self._lock.notify()
+        if not keep:
+            self._discard(pooled)
+
+    def close(self) -> None:
+        """close closes all idle connections and refuses further checkouts."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._lock.notify_all()
+        for pooled in idle:
+            self._discard(pooled)
+
+    def stats(self) -> PoolStats:
+        with self._lock:
+            return PoolStats(
+                in_use=self._in_use,
+                idle=len(self._idle),
+                max_size=self.max_size,
+                checkouts=self._checkouts,
+                waits=self._waits,
+                total_wait_seconds=self._total_wait_seconds,
+                max_wait_seconds=self._max_wait_seconds,
+                connections_opened=self._connections_opened,
+                connections_discarded=self._connections_discarded,
+            )
+
+
+# The number of statements run so far in the current context, e.g. the current request. It
+# is held in a list so that contexts copied from this one (e.g. for a thread) share it.
+_query_count: ContextVar[Optional[List[int]]] = ContextVar("query_count", default=None)
+
+
+def start_query_count() -> None:
+    """start_query_count starts counting the statements run in the current context."""
+    _query_count.set([0])
+
+
+def query_count() -> Optional[int]:
+    """query_count returns how many statements have run since start_query_count, or None if
+    nothing is being counted."""
+    count = _query_count.get()
+    return None if count is None else count[0]
+
+
+def add_to_query_count(count: int) -> None:
+    """add_to_query_count counts statements run on behalf of the current context elsewhere,
+    e.g. on other threads."""
+    counter = _query_count.get()
+    if counter is not None:
+        counter[0] += count
+
+
+def _count_query() -> None:
+    count = _query_count.get()
+    if count is not None:
+        count[0] += 1
+
+
+# QueryObserver is called after each statement runs, with the cursor which ran it, the
+# statement and how many seconds it took.
+QueryObserver = Callable[[psycopg2.extensions.cursor, Any, float], None]
+
+_query_observer: Optional[QueryObserver] = None
+
+
+def set_query_observer(observer: Optional[QueryObserver]) -> None:
+    """set_query_observer sets a function to call after every statement, or None to stop
+    timing statements at all."""
+    global _query_observer
+    _query_observer = observer
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """InstrumentedCursor is a cursor which counts the statements it runs (see query_count),
+    and times them if there is a query observer."""
+
+    def execute(self, query, vars=None):
+        return self._run(super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._run(super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._run(super().copy_expert, sql, file, size)
+
+    def _run(self, run, query, *args):
+        _count_query()
+        observer = _query_observer
+        if observer is None:
+            return run(query, *args)
+        started_at = time.perf_counter()
+        try:
+            return run(query, *args)
+        finally:
+            observer(self, query, time.perf_counter() - started_at)
+
+
+def connect(host: Optional[str] = None, port: Optional[str] = None):
+    """connect opens a connection to the primary, or to another host and port."""
+    return psycopg2.connect(
+        cursor_factory=InstrumentedCursor,
         dbname=os.getenv("POSTGRES_DB"),
         user=os.getenv("POSTGRES_USER"),
         password=os.environ["POSTGRES_PASSWORD"],
-        host=os.getenv("POSTGRES_HOST", "127.0.0.1"),
-        port=os.getenv("POSTGRES_PORT"),
-    ) as conn:
-        with conn.cursor() as cur:
-            yield cur
+        host=host or os.getenv("POSTGRES_HOST", "127.0.0.1"),
+        port=port or os.getenv("POSTGRES_PORT"),
+    )
+
+
+def _new_pool(connect: Callable[[], object], *, min_size: int) -> ConnectionPool:
+    return ConnectionPool(
+        connect,
+        min_size=min_size,
+        max_size=int(os.getenv("POSTGRES_POOL_MAX_SIZE", "10")),
+        timeout=float(os.getenv("POSTGRES_POOL_TIMEOUT", "10")),
+        max_lifetime=float(os.getenv("POSTGRES_POOL_MAX_LIFETIME", "1800")),
+        max_idle=float(os.getenv("POSTGRES_POOL_MAX_IDLE", "300")),
+        check_after_idle=float(os.getenv("POSTGRES_POOL_CHECK_AFTER_IDLE", "30")),
+    )
+
+
+@dataclass
+class ReplicaStats:
+    # Infinite if it couldn't be checked.
+    lag_seconds: float
+    in_rotation: bool
+    pool: PoolStats
+
+
+class Replica:
+    """Replica is a read-only copy of the database, with its own pool of connections."""
+
+    def __init__(self, address: str):
+        host, separator, port = address.rpartition(":")
+        if not separator:
+            host, port = address, None
+        self.address = address
+        # Replicas may be down, so don't connect to them until they are needed.
+        self.pool = _new_pool(lambda: connect(host, port), min_size=0)
+        # How far behind the primary it was when last checked, or None if it couldn't be
+        # checked.
+        self.lag_seconds: Optional[float] = None
+
+    @property
+    def in_rotation(self) -> bool:
+        return (
+            self.lag_seconds is not None and self.lag_seconds <= REPLICA_MAX_LAG_SECONDS
+        )
+
+    def check(self) -> None:
+        """check measures how far behind the primary the replica is."""
+        try:
+            pooled = self.pool.getconn()
+            with _transaction(self.pool, pooled, name=None, readonly=True) as cur:
+                cur.execute(REPLICATION_LAG_QUERY)
+                (lag,) = cur.fetchone()
+            self.lag_seconds = None if lag is None else float(lag)
+        except Exception:
+            if self.lag_seconds is not None:
+                logger.exception("Taking replica %s out of rotation", self.address)
+            self.lag_seconds = None
+
+    def stats(self) -> ReplicaStats:
+        lag = self.lag_seconds
+        return ReplicaStats(
+            lag_seconds=math.inf if lag is None else lag,
+            in_rotation=self.in_rotation,
+            pool=self.pool.stats(),
+        )
+
+
+_pool: Optional[ConnectionPool] = None
+_replicas: Optional[List[Replica]] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """get_pool returns the process-wide connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _new_pool(
+                    connect, min_size=int(os.getenv("POSTGRES_POOL_MIN_SIZE", "1"))
+                )
+    return _pool
+
+
+def get_replicas() -> List[Replica]:
+    """get_replicas returns this process's replicas, starting to check them on first use."""
+    global _replicas
+    if _replicas is None:
+        with _pool_lock:
+            if _replicas is None:
+                _replicas = [Replica(address) for address in REPLICAS]
+                if _replicas:
+                    threading.Thread(
+                        target=_check_replicas,
+                        args=(_replicas,),
+                        name="replica-checks",
+                        daemon=True,
+                    ).start()
+    return _replicas
+
+
+def _check_replicas(replicas: List[Replica]) -> None:
+    # Stop once the replicas are reset or closed.
+    while _replicas is replicas:
+        for replica in replicas:
+            replica.check()
+        time.sleep(REPLICA_CHECK_SECONDS)
+
+
+def choose_replica(replicas: List[Replica]) -> Optional[Replica]:
+    """choose_replica returns a random replica of those in rotation, or None if none are."""
+    in_rotation = [replica for replica in replicas if replica.in_rotation]
+    return random.choice(in_rotation) if in_rotation else None
+
+
+def reset_pool() -> None:
+    """reset_pool forgets the process-wide pools without closing their connections, so that
+    a forked worker opens its own connections rather than sharing its parent's sockets.
+    """
+    global _pool, _replicas, _pool_lock
+    _pool = None
+    _replicas = None
+    _pool_lock = threading.Lock()
+
+
+def close_pool() -> None:
+    """close_pool closes the process-wide pools' connections, e.g. when a worker exits."""
+    global _pool, _replicas
+    with _pool_lock:
+        pool, _pool = _pool, None
+        replicas, _replicas = _replicas, None
+    for pool in [pool] + [replica.pool for replica in replicas or []]:
+        if pool is not None:
+            pool.close()
+
+
+def pool_stats() -> PoolStats:
+    return get_pool().stats()
+
+
+def replica_stats() -> Dict[str, ReplicaStats]:
+    """replica_stats returns the state of each replica, by address."""
+    return {replica.address: replica.stats() for replica in get_replicas()}
+
+
+# Whether read-only cursors in the current context must run on the primary.
+_read_from_primary: ContextVar[bool] = ContextVar("read_from_primary", default=False)
+# Whether a cursor in the current context has run on a replica since read_from_replicas.
+_used_replica: ContextVar[bool] = ContextVar("used_replica", default=False)
+
+
+def read_from_primary() -> None:
+    """read_from_primary runs read-only cursors in the current context on the primary, e.g.
+    for the rest of a request by someone who has just written something."""
+    _read_from_primary.set(True)
+
+
+def read_from_replicas() -> None:
+    """read_from_replicas lets read-only cursors in the current context run on replicas
+    again, e.g. at the start of each request."""
+    _read_from_primary.set(False)
+    _used_replica.set(False)
+
+
+def reading_from_primary() -> bool:
+    """reading_from_primary returns whether read_from_primary has been called in the
+    current context, since read_from_replicas."""
+    return _read_from_primary.get()
+
+
+def used_replica() -> bool:
+    """used_replica returns whether anything has been read from a replica in the current
+    context since read_from_replicas, so may be behind the primary."""
+    return _used_replica.get()
+
+
+@contextmanager
+def db_cursor(name: Optional[str] = None, *, readonly: bool = False):
+    """db_cursor yields a cursor on a pooled connection, in a transaction which is
+    committed when the block exits normally and rolled back otherwise.
+
+    If name is given, the cursor is a server-side cursor: iterating over it fetches rows
+    from the database itersize at a time, rather than all at once.
+
+    If readonly is set, the transaction is read-only, and runs on a replica if one is in
+    rotation (unless the context must read from the primary).
+    """
+    replica = None
+    if readonly and not _read_from_primary.get():
+        replica = choose_replica(get_replicas())
+    if replica is not None:
+        try:
+            pooled = replica.pool.getconn()
+        except psycopg2.OperationalError:
+            # Read from the primary until the replica is next checked.
+            replica.lag_seconds = None
+        except PoolTimeoutError:
+            # The replica is busy rather than broken: only this read goes to the primary.
+            pass
+        else:
+            _used_replica.set(True)
+            with _transaction(replica.pool, pooled, name=name, readonly=True) as cur:
+                yield cur
+            return
+    pool = get_pool()
+    with _transaction(pool, pool.getconn(), name=name, readonly=readonly) as cur:
+        yield cur
+
+
+@contextmanager
+def _transaction(
+    pool: ConnectionPool,
+    pooled: _PooledConnection,
+    *,
+    name: Optional[str],
+    readonly: bool,
+):
+    discard = False
+    try:
+        # Leave the server's default (read-write) unless asked for read-only, as replicas
+        # refuse to begin read-write transactions.
+        pooled.conn.readonly = True if readonly else None
+        # Using the connection as a context manager commits on success and rolls back on error.
+        with pooled.conn as conn:
+            with conn.cursor(name=name) as cur:
+                yield cur
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    finally:
+        pool.putconn(pooled, discard=discard)
@@ -0,0 +1,196 @@
+import contextvars
+import threading
+import time
+import unittest
+from unittest import mock
+
+import psycopg2
+
+from data.connection import (
+    ConnectionPool,
+    PoolTimeoutError,
+    REPLICA_MAX_LAG_SECONDS,
+    Replica,
+    _count_query,
+    choose_replica,
+    db_cursor,
+    query_count,
+    start_query_count,
+)
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        if self.conn.broken:
+            raise psycopg2.OperationalError("server closed the connection")
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_reuses_connections(self):
+        pool = ConnectionPool(FakeConnection, min_size=0, max_size=2)
+        first = pool.getconn()
+        pool.putconn(first)
+        second = pool.getconn()
+        self.assertIs(first, second)
+        self.assertEqual(pool.stats().connections_opened, 1)
+
+    def test_stats(self):
+        pool = ConnectionPool(FakeConnection, min_size=2, max_size=3)
+        checked_out = pool.getconn()
+        stats = pool.stats()
+        self.assertEqual(stats.in_use, 1)
+        self.assertEqual(stats.idle, 1)
+        self.assertEqual(stats.checkouts, 1)
+        pool.putconn(checked_out)
+        self.assertEqual(pool.stats().in_use, 0)
+        self.assertEqual(pool.stats().idle, 2)
+
+    def test_checkout_times_out_when_exhausted(self):
+        pool = ConnectionPool(FakeConnection, min_size=0, max_size=1, timeout=0.05)
+        pool.getconn()
+        with self.assertRaises(PoolTimeoutError):
+            pool.getconn()
+
+    def test_waiter_gets_returned_connection(self):
+        pool = ConnectionPool(FakeConnection, min_size=0, max_size=1, timeout=5)
+        held = pool.getconn()
+        threading.Timer(0.05, pool.putconn, args=(held,)).start()
+        self.assertIs(pool.getconn(), held)
+        stats = pool.stats()
+        self.assertEqual(stats.waits, 1)
+        self.assertGreater(stats.max_wait_seconds, 0)
+
+    def test_replaces_unhealthy_connections(self):
+        pool = ConnectionPool(
+            FakeConnection, min_size=0, max_size=1, check_after_idle=0
+        )
+        first = pool.getconn()
+        pool.putconn(first)
+        first.conn.broken = True
+        second = pool.getconn()
+        self.assertIsNot(first, second)
+        self.assertTrue(first.conn.closed)
+
+    def test_recycles_stale_connections(self):
+        pool = ConnectionPool(FakeConnection, min_size=0, max_size=1, max_lifetime=0.01)
+        first = pool.getconn()
+        pool.putconn(first)
+        time.sleep(0.02)
+        second = pool.getconn()
+        self.assertIsNot(first, second)
+        self.assertEqual(pool.stats().connections_discarded, 1)
+
+    def test_discarded_connection_frees_slot(self):
+        pool = ConnectionPool(FakeConnection, min_size=0, max_size=1, timeout=0.05)
+        pool.putconn(pool.getconn(), discard=True)
+        self.assertIsNotNone(pool.getconn())
+
+    def test_bounded_under_concurrency(self):
+        pool = ConnectionPool(FakeConnection, min_size=0, max_size=3, timeout=5)
+        peak = 0
+        lock = threading.Lock()
+
+        def worker():
+            nonlocal peak
+            for _ in range(50):
+                pooled = pool.getconn()
+                with lock:
+                    peak = max(peak, pool.stats().in_use)
+                pool.putconn(pooled)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(peak, 3)
+        self.assertLessEqual(pool.stats().connections_opened, 3)
+
+
+class TestReplicas(unittest.TestCase):
+    def test_chooses_replicas_in_rotation(self):
+        behind, unreachable, caught_up = (
+            Replica("behind:5433"),
+            Replica("unreachable:5433"),
+            Replica("caught-up:5433"),
+        )
+        behind.lag_seconds = REPLICA_MAX_LAG_SECONDS + 1
+        caught_up.lag_seconds = 0.0
+        self.assertEqual(
+            [r.in_rotation for r in [behind, unreachable, caught_up]],
+            [False, False, True],
+        )
+        for _ in range(10):
+            self.assertIs(choose_replica([behind, unreachable, caught_up]), caught_up)
+        self.assertIsNone(choose_replica([behind, unreachable]))
+        self.assertEqual(unreachable.stats().lag_seconds, float("inf"))
+
+    def test_reads_from_the_primary_when_the_replica_is_busy(self):
+        replica = Replica("busy:5433")
+        replica.lag_seconds = 0.0
+        replica.pool = ConnectionPool(
+            FakeConnection, min_size=0, max_size=1, timeout=0.01
+        )
+        replica.pool.getconn()
+        primary = ConnectionPool(FakeConnection, min_size=0, max_size=1)
+
+        def read():
+            with db_cursor(readonly=True) as cur:
+                return cur.conn
+
+        with mock.patch(
+            "data.connection.get_replicas", return_value=[replica]
+        ), mock.patch("data.connection.get_pool", return_value=primary):
+            conn = contextvars.Context().run(read)
+        self.assertIs(conn, primary.getconn().conn)
+        self.assertTrue(replica.in_rotation)
+
+
+class TestQueryCount(unittest.TestCase):
+    def test_counts_per_context(self):
+        def run():
+            self.assertIsNone(query_count())
+            _count_query()
+            start_query_count()
+            _count_query()
+            _count_query()
+            # Copies of the context, e.g. for other threads, add to the same count.
+            contextvars.copy_context().run(_count_query)
+            return query_count()
+
+        self.assertEqual(contextvars.Context().run(run), 3)
+        self.assertIsNone(contextvars.Context().run(query_count))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,43 +1,167 @@
-from typing import List
+"""Who follows whom.
 
+Each process caches the follow graph around the users it has seen recently: the ids each
+of them follows and is followed by, as IdSets. Sets are loaded as they are needed, and
+updated in place as people follow each other: follow notifies the FOLLOWS_CHANNEL, and
+every process adds the new follow to the sets it has cached. If a process can't listen for
+notifications, it reads from the database instead.
+"""
+
+from array import array
+from itertools import islice
+import os
+import threading
+from typing import List, Optional, Tuple
+
+from cache import LRUCache
+from data import notifications
 from data.connection import db_cursor
-from data.users import User
+from data.recent_writers import record_write
+from data.suggestions import update_suggestions_after_follow
+from data.timelines import backfill_timeline
+from data.users import User, get_usernames
+from id_set import IdSet
 
-from psycopg2.errors import UniqueViolation
+FOLLOWS_CHANNEL = "follows"
 
+FOLLOWING = "following"
+FOLLOWERS = "followers"
 
-def follow(follower: User, followee: User):
-    with db_cursor() as cur:
-        try:
-            cur.execute(
-                "INSERT INTO follows (follower, followee) VALUES (%(follower_id)s, %(followee_id)s)",
-                dict(
-                    follower_id=follower.id,
-                    followee_id=followee.id,
-                ),
-            )
-        except UniqueViolation:
-            # Already following - treat as idempotent request.
-            pass
+# Sets by (FOLLOWING or FOLLOWERS, user id).
+_follow_cache = LRUCache(int(os.getenv("FOLLOW_CACHE_MAX_SIZE", "10000")))
 
+# A set loaded from the database may have missed a follow made while it was loading, so it
+# is only cached if no follow of its user was applied meanwhile. Follows are counted in
+# stripes of users by id, and _epoch counts resets, which affect everyone.
+_GENERATION_STRIPES = 1024
+_generations = array("Q", bytes(8 * _GENERATION_STRIPES))
+_epoch = 0
+# Held while changing cached sets or the generations, so that changes aren't lost to each
+# other or to sets being cached.
+_cache_lock = threading.Lock()
 
-def get_followed_usernames(follower: User) -> List[str]:
-    """get_followed_usernames returns a list of usernames followee follows."""
+
+def follow(follower: User, followee: User):
     with db_cursor() as cur:
         cur.execute(
-            "SELECT users.username FROM follows INNER JOIN users ON follows.followee = users.id WHERE follower = %s",
-            (follower.id,),
+            "INSERT INTO follows (follower, followee) VALUES (%(follower_id)s, %(followee_id)s) ON CONFLICT DO NOTHING RETURNING id",
+            dict(
+                follower_id=follower.id,
+                followee_id=followee.id,
+            ),
         )
-        rows = cur.fetchall()
-        return [row[0] for row in rows]
+        if cur.fetchone() is None:
+            # Already following - treat as idempotent request.
+            return
+        cur.execute(
+            """UPDATE users SET
+              following_count = following_count + CASE WHEN id = %(follower_id)s THEN 1 ELSE 0 END,
+              follower_count = follower_count + CASE WHEN id = %(followee_id)s THEN 1 ELSE 0 END
+            WHERE id IN (%(follower_id)s, %(followee_id)s)""",
+            dict(
+                follower_id=follower.id,
+                followee_id=followee.id,
+            ),
+        )
+        backfill_timeline(cur, follower_id=follower.id, followee_id=followee.id)
+        update_suggestions_after_follow(
+            cur, follower_id=follower.id, followee_id=followee.id
+        )
+        notifications.notify(cur, FOLLOWS_CHANNEL, f"{follower.id} {followee.id}")
+        record_write(cur, follower.username)
+    # Don't wait for the notification, so that the follower sees their follow at once.
+    _apply_follow(follower.id, followee.id)
+
+
+def get_followed_usernames(follower: User, limit: Optional[int] = None) -> List[str]:
+    """get_followed_usernames returns up to limit usernames follower follows, oldest
+    users first."""
+    return get_usernames(list(islice(get_follow_set(FOLLOWING, follower.id), limit)))
+
+
+def get_inverse_followed_usernames(
+    followee: User, limit: Optional[int] = None
+) -> List[str]:
+    """get_inverse_followed_usernames returns up to limit usernames following followee,
+    oldest users first."""
+    return get_usernames(list(islice(get_follow_set(FOLLOWERS, followee.id), limit)))
+
+
+def is_following(follower: User, followee: User) -> bool:
+    return followee.id in get_follow_set(FOLLOWING, follower.id)
 
 
-def get_inverse_followed_usernames(followee: User) -> List[str]:
-    """get_followed_usernames returns a list of usernames followed by follower."""
+def get_followers_followed_by(viewer: User, user: User, limit: int) -> List[str]:
+    """get_followers_followed_by returns up to limit usernames of user's followers whom
+    viewer follows."""
+    common = get_follow_set(FOLLOWING, viewer.id).intersection(
+        get_follow_set(FOLLOWERS, user.id)
+    )
+    return get_usernames(common[:limit])
+
+
+def get_follow_set(direction: str, user_id: int) -> IdSet:
+    """get_follow_set returns the ids user_id follows (FOLLOWING) or is followed by
+    (FOLLOWERS)."""
+    key = (direction, user_id)
+    listening = notifications.is_listening(FOLLOWS_CHANNEL)
+    if listening:
+        ids = _follow_cache.get(key, None)
+        if ids is not None:
+            return ids
+    generation = _generation(user_id)
+    ids = load_follow_set(direction, user_id)
+    if listening:
+        with _cache_lock:
+            if _generation(user_id) == generation:
+                _follow_cache.set(key, ids)
+    return ids
+
+
+def load_follow_set(direction: str, user_id: int) -> IdSet:
+    # Sets are cached until they are evicted, and only follows notified after they are
+    # loaded are applied to them, so they can't be loaded from a replica which may not
+    # have the follows notified before.
+    if direction == FOLLOWING:
+        query = "SELECT followee FROM follows WHERE follower = %s ORDER BY followee"
+    else:
+        query = "SELECT follower FROM follows WHERE followee = %s ORDER BY follower"
     with db_cursor() as cur:
-        cur.execute(
-            "SELECT users.username FROM follows INNER JOIN users ON follows.follower = users.id WHERE followee = %s",
-            (followee.id,),
-        )
-        rows = cur.fetchall()
-        return [row[0] for row in rows]
+        cur.execute(query, (user_id,))
+        return IdSet(row[0] for row in cur.fetchall())
+
+
+def _generation(user_id: int) -> Tuple[int, int]:
+    return _epoch, _generations[user_id % _GENERATION_STRIPES]
+
+
+def _apply_follow(follower_id: int, followee_id: int) -> None:
+    with _cache_lock:
+        for direction, user_id, other_id in [
+            (FOLLOWING, follower_id, followee_id),
+            (FOLLOWERS, followee_id, follower_id),
+        ]:
+            _generations[user_id % _GENERATION_STRIPES] += 1
+            key = (direction, user_id)
+            ids = _follow_cache.get(key, None)
+            if ids is not None:
+                # IdSets are shared by the threads reading them, so replace rather than
+                # change them.
+                _follow_cache.set(key, ids.with_id(other_id))
+
+
+def _on_follow_message(payload: str) -> None:
+    follower_id, followee_id = map(int, payload.split())
+    _apply_follow(follower_id, followee_id)
+
+
+def _reset_follow_cache() -> None:
+    global _epoch
+    with _cache_lock:
+        _epoch += 1
+        _follow_cache.clear()
+
+
+notifications.subscribe(
+    FOLLOWS_CHANNEL, on_message=_on_follow_message, on_reset=_reset_follow_cache
+)
@@ -0,0 +1,133 @@
+"""The hashtag dictionary, and suggesting hashtags as people type them.
+
+hashtag_dictionary holds every distinct hashtag and how many blooms use it, kept up to date
+by add_blooms. Each process loads it into a PrefixIndex, which finds the most used hashtags
+starting with a prefix without querying the database, and reloads it in the background
+every HASHTAG_SUGGESTIONS_REFRESH_SECONDS, so new hashtags are suggested within that long.
+"""
+
+from collections import Counter
+import logging
+import os
+import threading
+import time
+import unicodedata
+from typing import Iterable, List, Optional, Tuple
+
+from data.connection import db_cursor
+from prefix_index import PrefixIndex
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+MAX_SUGGESTIONS = 20
+REFRESH_SECONDS = float(os.getenv("HASHTAG_SUGGESTIONS_REFRESH_SECONDS", "300"))
+# How many rows loading the dictionary fetches from the database at a time.
+LOAD_CHUNK_SIZE = 10_000
+
+_index: Optional[PrefixIndex] = None
+_index_loaded_at = 0.0
+# Held while the index is being loaded, so that only one load runs at a time.
+_loading = threading.Lock()
+
+
+def normalize_hashtag(hashtag: str) -> str:
+    """normalize_hashtag returns the form hashtags are stored and looked up in, case-folded
+    and NFKC-normalized, so that e.g. #SwizBiz, #swizbiz and #ＳｗｉｚＢｉｚ are the same."""
+    # Normalizing can make characters which case-fold (e.g. ℌ to H), and case-folding
+    # characters which normalize, so normalize on both sides, like NFKC_Casefold.
+    return unicodedata.normalize(
+        "NFKC", unicodedata.normalize("NFKC", hashtag).casefold()
+    )
+
+
+def add_to_dictionary(cur, hashtags: Iterable[str]) -> None:
+    """add_to_dictionary counts a bloom's use of each of hashtags, adding new hashtags to
+    the dictionary.
+
+    Popular hashtags' rows are updated by many transactions at once, so call this late in
+    a transaction, to hold their row locks as briefly as possible.
+    """
+    counts = Counter(hashtags)
+    if not counts:
+        return
+    # Lock rows in the same order in every transaction, so that they can't deadlock.
+    execute_values(
+        cur,
+        """INSERT INTO hashtag_dictionary (hashtag, bloom_count)
+        VALUES %s
+        ON CONFLICT (hashtag)
+        DO UPDATE SET bloom_count = hashtag_dictionary.bloom_count + EXCLUDED.bloom_count""",
+        sorted(counts.items()),
+    )
+
+
+def suggest_hashtags(prefix: str, limit: int) -> List[Tuple[str, int]]:
+    """suggest_hashtags returns up to limit (at most MAX_SUGGESTIONS) of the most used
+    hashtags starting with prefix, and how many blooms use each."""
+    return get_suggestion_index().top(normalize_hashtag(prefix), limit)
+
+
+def get_suggestion_index() -> PrefixIndex:
+    """get_suggestion_index returns this process's index of the hashtag dictionary.
+
+    The first call loads it. After that, once it is older than REFRESH_SECONDS, it is
+    reloaded on another thread, and the old index is used until the new one is ready.
+    """
+    if _index is None:
+        with _loading:
+            if _index is None:
+                _reload()
+    elif time.monotonic() - _index_loaded_at > REFRESH_SECONDS and _loading.acquire(
+        blocking=False
+    ):
+
+        def reload_in_background():
+            try:
+                _reload()
+            except Exception:
+                logger.exception("Couldn't reload the hashtag suggestion index")
+            finally:
+                _loading.release()
+
+        threading.Thread(
+            target=reload_in_background, name="hashtag-suggestions", daemon=True
+        ).start()
+    return _index
+
+
+def _reload() -> None:
+    global _index, _index_loaded_at
+    started_at = time.monotonic()
+    _index = load_suggestion_index()
+    _index_loaded_at = started_at
+
+
+def load_suggestion_index() -> PrefixIndex:
+    with db_cursor(name="hashtag_dictionary") as cur:
+        cur.itersize = LOAD_CHUNK_SIZE
+        cur.execute(
+            "SELECT hashtag, bloom_count FROM hashtag_dictionary WHERE bloom_count > 0 ORDER BY hashtag"
+        )
+        return PrefixIndex(cur, max_results=MAX_SUGGESTIONS)
+
+
+def rebuild_hashtag_dictionary() -> None:
+    """rebuild_hashtag_dictionary recounts every hashtag's uses from the hashtags table,
+    and removes hashtags which are no longer used."""
+    with db_cursor() as cur:
+        cur.execute("""WITH
+              counts AS (
+                SELECT hashtag, COUNT(*) AS bloom_count FROM hashtags GROUP BY hashtag
+              ),
+              removed AS (
+                DELETE FROM hashtag_dictionary
+                WHERE NOT EXISTS (
+                  SELECT 1 FROM hashtags
+                  WHERE hashtags.hashtag COLLATE "C" = hashtag_dictionary.hashtag
+                )
+              )
+            INSERT INTO hashtag_dictionary (hashtag, bloom_count)
+            SELECT hashtag, bloom_count FROM counts
+            ON CONFLICT (hashtag) DO UPDATE SET bloom_count = EXCLUDED.bloom_count
+            WHERE hashtag_dictionary.bloom_count <> EXCLUDED.bloom_count""")
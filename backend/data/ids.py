@@ -0,0 +1,250 @@
+"""Snowflake-style 64-bit ids for blooms.
+
+An id is made of (from most to least significant bits):
+  * 41 bits: milliseconds since EPOCH_MS, so ids sort in the order they were made,
+  * 10 bits: the id of the worker which made it,
+  * 12 bits: a sequence number, for ids made by the same worker in the same millisecond.
+
+Workers never need to talk to each other to make unique ids, as long as each worker has
+its own worker id. Each process leases one from the database (see WorkerIdLease), which no
+other live process, on this host or any other, holds at the same time.
+"""
+
+import datetime
+import os
+import select
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+from data.connection import connect
+
+# 2024-01-01T00:00:00Z
+EPOCH_MS = 1704067200000
+
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# How far the clock may go backwards before we refuse to make ids rather than wait.
+MAX_CLOCK_ROLLBACK_MS = 1000
+
+# The first key of the advisory locks which lease worker ids; the second is the worker id.
+WORKER_ID_LOCK_CLASS = 0x626C6F6F
+# How often a process checks that the connection holding its worker id is still open, if the
+# server doesn't close it first.
+LEASE_CHECK_SECONDS = 1.0
+
+
+class ClockRollbackError(Exception):
+    """ClockRollbackError is raised when the clock goes back further than we are willing to wait out."""
+
+
+class NoWorkerIdError(Exception):
+    """NoWorkerIdError is raised when every worker id is leased by another process."""
+
+
+def wall_clock_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+class IdGenerator:
+    """IdGenerator makes unique, time-ordered ids for one worker. It is thread-safe."""
+
+    def __init__(
+        self,
+        worker_id: int,
+        *,
+        clock: Callable[[], int] = wall_clock_ms,
+        sleep: Callable[[float], None] = time.sleep,
+        max_clock_rollback_ms: int = MAX_CLOCK_ROLLBACK_MS,
+    ):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(
+                f"worker_id must be between 0 and {MAX_WORKER_ID}, got {worker_id}"
+            )
+        self.worker_id = worker_id
+        self._clock = clock
+        self._sleep = sleep
+        self._max_clock_rollback_ms = max_clock_rollback_ms
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self) -> int:
+        return self.next_ids(1)[0]
+
+    def next_ids(self, count: int) -> List[int]:
+        ids = []
+        with self._lock:
+            for _ in range(count):
+                now = self._clock()
+                if now < self._last_ms:
+                    if self._last_ms - now > self._max_clock_rollback_ms:
+                        raise ClockRollbackError(
+                            f"Clock moved backwards by {self._last_ms - now}ms"
+                        )
+                    # Keep making ids as if time had stood still; if we run out of
+                    # sequence numbers, we wait below for the clock to catch up.
+                    now = self._last_ms
+                if now == self._last_ms:
+                    self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                    if self._sequence == 0:
+                        now = self._wait_until_after(self._last_ms)
+                else:
+                    self._sequence = 0
+                self._last_ms = now
+                ids.append(
+                    ((now - EPOCH_MS) << (WORKER_ID_BITS + SEQUENCE_BITS))
+                    | (self.worker_id << SEQUENCE_BITS)
+                    | self._sequence
+                )
+        return ids
+
+    def _wait_until_after(self, last_ms: int) -> int:
+        now = self._clock()
+        while now <= last_ms:
+            self._sleep(max(last_ms - now, 0.1) / 1000)
+            now = self._clock()
+        return now
+
+
+def timestamp_from_id(bloom_id: int) -> datetime.datetime:
+    """timestamp_from_id returns when an id was made, to the millisecond."""
+    ms = (bloom_id >> (WORKER_ID_BITS + SEQUENCE_BITS)) + EPOCH_MS
+    return datetime.datetime.fromtimestamp(ms / 1000, tz=datetime.UTC)
+
+
+class WorkerIdLease:
+    """WorkerIdLease leases a worker id which no other process holds, with a Postgres
+    advisory lock on a connection of its own. The lock lasts as long as the connection, so
+    the ids of processes which exit, however they exit, can be leased again.
+
+    If the connection is lost, so is the lock. A thread watches the connection: it wakes as
+    soon as the server closes it, and otherwise checks it every LEASE_CHECK_SECONDS. Once it
+    has failed, worker_id leases an id again (the same one if it can) before returning one,
+    and raises if it can't. worker_id is not thread-safe.
+    """
+
+    def __init__(self, connect: Callable[[], Any]):
+        self._connect = connect
+        self._conn = None
+        self._worker_id: Optional[int] = None
+        # Set when the connection has failed or been closed.
+        self._lost = threading.Event()
+
+    def worker_id(self) -> int:
+        """worker_id returns the leased worker id, leasing one first if needed."""
+        if self._lost.is_set():
+            self.close()
+        if self._conn is None:
+            self._lease()
+        return self._worker_id
+
+    def close(self) -> None:
+        """close gives up the leased worker id."""
+        self._lost.set()
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def _lease(self) -> None:
+        conn = self._connect()
+        conn.autocommit = True
+        self._conn = conn
+        try:
+            with self._cursor() as cur:
+                # Try each worker id in turn, starting from the one we had, and stop at the
+                # first we lock, so we hold exactly one.
+                cur.execute(
+                    """SELECT (%(start)s + n) %% %(ids)s
+                    FROM generate_series(0, %(ids)s - 1) AS n
+                    WHERE pg_try_advisory_lock(%(lock_class)s, (%(start)s + n) %% %(ids)s)
+                    LIMIT 1""",
+                    {
+                        "start": self._worker_id or 0,
+                        "ids": MAX_WORKER_ID + 1,
+                        "lock_class": WORKER_ID_LOCK_CLASS,
+                    },
+                )
+                row = cur.fetchone()
+        except BaseException:
+            self.close()
+            raise
+        if row is None:
+            self.close()
+            raise NoWorkerIdError(f"All {MAX_WORKER_ID + 1} worker ids are leased")
+        self._worker_id = row[0]
+        self._lost = threading.Event()
+        # Watch a duplicate of the connection's socket, which stays open (though its
+        # connection may not) until the watcher closes it.
+        fd = os.dup(conn.fileno())
+        threading.Thread(
+            target=self._watch,
+            args=(conn, fd, self._lost),
+            name="worker-id-lease",
+            daemon=True,
+        ).start()
+
+    @staticmethod
+    def _watch(conn, fd: int, lost: threading.Event) -> None:
+        try:
+            while not lost.is_set():
+                # Nothing is sent on the connection unless the server closes it.
+                select.select([fd], [], [], LEASE_CHECK_SECONDS)
+                if lost.is_set():
+                    return
+                with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                    cur.execute("SELECT 1")
+        except (psycopg2.Error, OSError):
+            pass
+        finally:
+            lost.set()
+            os.close(fd)
+
+    def _cursor(self):
+        # A plain cursor, so that leasing isn't counted as one of a request's queries.
+        return self._conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+
+
+_lease: Optional[WorkerIdLease] = None
+_generator: Optional[IdGenerator] = None
+_generator_lock = threading.Lock()
+# Leases inherited from parent processes, which must never be closed (see _reset_after_fork).
+_inherited_leases: List[WorkerIdLease] = []
+
+
+def next_ids(count: int) -> List[int]:
+    """next_ids returns count new ids from this process' generator."""
+    global _lease, _generator
+    with _generator_lock:
+        if _lease is None:
+            _lease = WorkerIdLease(connect)
+        worker_id = _lease.worker_id()
+        # Keep the generator while the worker id is the same, so ids stay in order.
+        if _generator is None or _generator.worker_id != worker_id:
+            _generator = IdGenerator(worker_id)
+        generator = _generator
+    return generator.next_ids(count)
+
+
+def _reset_after_fork() -> None:
+    # A forked child must lease its own worker id, not carry on with its parent's. Closing
+    # the parent's lease's connection, even by letting it be garbage collected, would end
+    # the parent's session, and so release its worker id while the parent still uses it.
+    global _lease, _generator, _generator_lock
+    if _lease is not None:
+        _inherited_leases.append(_lease)
+    _lease = None
+    _generator = None
+    _generator_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
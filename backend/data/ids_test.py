@@ -0,0 +1,255 @@
+import fcntl
+import multiprocessing
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import psycopg2
+from data import ids as process_ids
+from data.ids import (
+    EPOCH_MS,
+    MAX_SEQUENCE,
+    MAX_WORKER_ID,
+    SEQUENCE_BITS,
+    ClockRollbackError,
+    IdGenerator,
+    timestamp_from_id,
+)
+
+# Total ids made by each stress test; raise it to stress harder.
+STRESS_IDS = int(os.getenv("ID_STRESS_IDS", "1000000"))
+STRESS_WORKERS = 4
+
+
+class FakeClock:
+    def __init__(self, now: int):
+        self.now = now
+        self.sleeps = 0
+
+    def __call__(self) -> int:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        # Sleeping lets time pass by a millisecond.
+        self.sleeps += 1
+        self.now += 1
+
+
+def make_ids(worker_id: int, count: int):
+    return worker_id, IdGenerator(worker_id).next_ids(count)
+
+
+def worker_id_of(bloom_id: int) -> int:
+    return (bloom_id >> SEQUENCE_BITS) & MAX_WORKER_ID
+
+
+class FakeLockingConnection:
+    """FakeLockingConnection leases worker ids like Postgres advisory locks, with a locked
+    file for each: only one process can lock each file, until it exits."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.locked = []
+        self.params = None
+        self.closed = False
+        # Stands in for the connection's socket, which the server closes with the write end.
+        self.read_fd, self.write_fd = os.pipe()
+
+    def fileno(self):
+        return self.read_fd
+
+    def cursor(self, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        if self.closed:
+            raise psycopg2.InterfaceError("connection already closed")
+        self.params = params
+
+    def fetchone(self):
+        if self.params is None:
+            return (1,)
+        for n in range(MAX_WORKER_ID + 1):
+            worker_id = (self.params["start"] + n) % (MAX_WORKER_ID + 1)
+            lock = open(os.path.join(self.directory, str(worker_id)), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+            self.locked.append(lock)
+            return (worker_id,)
+        return None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for lock in self.locked:
+            lock.close()
+        os.close(self.write_fd)
+        os.close(self.read_fd)
+
+
+def send_worker_id(results, barrier):
+    results.put(worker_id_of(process_ids.next_ids(1)[0]))
+    # Stay alive, holding the worker id, until every process has one.
+    barrier.wait()
+
+
+class TestIdGenerator(unittest.TestCase):
+    def test_layout(self):
+        clock = FakeClock(EPOCH_MS + 5)
+        generator = IdGenerator(3, clock=clock)
+        self.assertEqual(generator.next_id(), (5 << 22) | (3 << 12) | 0)
+        self.assertEqual(generator.next_id(), (5 << 22) | (3 << 12) | 1)
+        clock.now += 1
+        self.assertEqual(generator.next_id(), (6 << 22) | (3 << 12) | 0)
+
+    def test_timestamp_from_id(self):
+        clock = FakeClock(EPOCH_MS + 1500)
+        bloom_id = IdGenerator(1, clock=clock).next_id()
+        self.assertEqual(
+            timestamp_from_id(bloom_id).timestamp() * 1000, EPOCH_MS + 1500
+        )
+
+    def test_waits_for_next_millisecond_when_sequence_exhausted(self):
+        clock = FakeClock(EPOCH_MS)
+        generator = IdGenerator(0, clock=clock, sleep=clock.sleep)
+        ids = generator.next_ids(MAX_SEQUENCE + 2)
+        self.assertEqual(clock.sleeps, 1)
+        self.assertEqual(ids[-1], 1 << 22)
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_small_clock_rollback_stays_monotonic(self):
+        clock = FakeClock(EPOCH_MS + 100)
+        generator = IdGenerator(0, clock=clock, sleep=clock.sleep)
+        before = generator.next_id()
+        clock.now -= 10
+        after = generator.next_id()
+        self.assertGreater(after, before)
+
+    def test_large_clock_rollback_raises(self):
+        clock = FakeClock(EPOCH_MS + 10_000)
+        generator = IdGenerator(0, clock=clock, max_clock_rollback_ms=100)
+        generator.next_id()
+        clock.now -= 101
+        with self.assertRaises(ClockRollbackError):
+            generator.next_id()
+
+    def test_rejects_invalid_worker_ids(self):
+        for worker_id in [-1, 1024]:
+            with self.assertRaises(ValueError):
+                IdGenerator(worker_id)
+
+
+class TestIdGeneratorStress(unittest.TestCase):
+    def test_threads_sharing_a_generator(self):
+        generator = IdGenerator(7)
+        results = {}
+
+        def worker(thread_number):
+            ids = []
+            for _ in range(STRESS_IDS // STRESS_WORKERS // 100):
+                ids.extend(generator.next_ids(100))
+            results[thread_number] = ids
+
+        threads = [
+            threading.Thread(target=worker, args=(n,)) for n in range(STRESS_WORKERS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        all_ids = [bloom_id for ids in results.values() for bloom_id in ids]
+        self.assertEqual(len(set(all_ids)), len(all_ids))
+        for ids in results.values():
+            self.assertEqual(ids, sorted(ids))
+
+    def test_processes_with_distinct_worker_ids(self):
+        with multiprocessing.Pool(STRESS_WORKERS) as pool:
+            results = pool.starmap(
+                make_ids,
+                [
+                    (worker_id, STRESS_IDS // STRESS_WORKERS)
+                    for worker_id in range(STRESS_WORKERS)
+                ],
+            )
+
+        all_ids = [bloom_id for _, ids in results for bloom_id in ids]
+        self.assertEqual(len(set(all_ids)), len(all_ids))
+        for worker_id, ids in results:
+            self.assertEqual(ids, sorted(ids))
+            self.assertTrue(
+                all((i >> SEQUENCE_BITS) & MAX_WORKER_ID == worker_id for i in ids)
+            )
+
+
+class TestWorkerIdLease(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.connections = []
+        self.database_down = False
+
+        def connect():
+            if self.database_down:
+                raise psycopg2.OperationalError("connection refused")
+            self.connections.append(FakeLockingConnection(directory.name))
+            return self.connections[-1]
+
+        patcher = mock.patch("data.ids.connect", connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(process_ids._reset_after_fork)
+        process_ids._reset_after_fork()
+
+    def test_forked_processes_lease_distinct_worker_ids(self):
+        parent = worker_id_of(process_ids.next_ids(1)[0])
+
+        context = multiprocessing.get_context("fork")
+        results, barrier = context.Queue(), context.Barrier(STRESS_WORKERS)
+        children = [
+            context.Process(target=send_worker_id, args=(results, barrier))
+            for _ in range(STRESS_WORKERS)
+        ]
+        for child in children:
+            child.start()
+        worker_ids = [parent] + [results.get(timeout=10) for _ in children]
+        for child in children:
+            child.join()
+
+        self.assertEqual(len(set(worker_ids)), len(worker_ids))
+        # The parent keeps its worker id.
+        self.assertEqual(worker_id_of(process_ids.next_ids(1)[0]), parent)
+
+    def test_stops_making_ids_once_the_connection_fails(self):
+        # So that the watcher only notices the connection closing, not its next check.
+        patcher = mock.patch("data.ids.LEASE_CHECK_SECONDS", 60)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        worker_id = worker_id_of(process_ids.next_ids(1)[0])
+
+        self.connections[0].close()
+        self.assertTrue(process_ids._lease._lost.wait(5))
+        self.database_down = True
+        with self.assertRaises(psycopg2.OperationalError):
+            process_ids.next_ids(1)
+
+        # Once the database is back, the same worker id is leased again.
+        self.database_down = False
+        self.assertEqual(worker_id_of(process_ids.next_ids(1)[0]), worker_id)
+        self.assertEqual(len(self.connections), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
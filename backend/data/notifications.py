@@ -0,0 +1,138 @@
+"""Telling every process about changes, with Postgres LISTEN/NOTIFY.
+
+Caches of data which other processes change subscribe to a channel, and whoever changes the
+data notifies the channel in the same transaction, so the message is sent when (and only
+if) it commits. Each process runs one listener thread, on its own connection, which calls
+the subscribers of each message's channel.
+
+Messages sent while the listener is disconnected are lost, so subscribers are reset each
+time it (re)connects, and should only cache anything while is_listening says they will
+hear about changes to it.
+"""
+
+from dataclasses import dataclass
+import logging
+import os
+import select
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+from data.connection import connect
+
+logger = logging.getLogger(__name__)
+
+# How long the listener waits for messages before checking for new channels.
+POLL_SECONDS = 1.0
+# How long the listener waits before reconnecting, doubling after each failure up to the max.
+RECONNECT_SECONDS = 1.0
+MAX_RECONNECT_SECONDS = 30.0
+
+
+@dataclass
+class Subscription:
+    # Called on the listener thread with each message's payload, in the order they were
+    # committed.
+    on_message: Callable[[str], None]
+    # Called on the listener thread after it (re)connects, as messages may have been missed.
+    on_reset: Callable[[], None]
+
+
+_subscriptions: Dict[str, List[Subscription]] = {}
+_lock = threading.Lock()
+# The process the listener thread was started in; after a fork, the child starts its own.
+_listener_pid: Optional[int] = None
+# The channels the listener is listening to now; empty while it is disconnected.
+_listening: Set[str] = set()
+
+
+def notify(cur, channel: str, payload: str) -> None:
+    """notify sends payload to channel's subscribers in every process once the transaction
+    cur is in commits."""
+    cur.execute("SELECT pg_notify(%s, %s)", (channel, payload))
+
+
+def subscribe(
+    channel: str,
+    *,
+    on_message: Callable[[str], None],
+    on_reset: Callable[[], None],
+) -> None:
+    """subscribe calls on_message with every message sent to channel. It doesn't start
+    listening: call is_listening when the subscription is needed."""
+    with _lock:
+        _subscriptions.setdefault(channel, []).append(
+            Subscription(on_message=on_message, on_reset=on_reset)
+        )
+
+
+def is_listening(channel: str) -> bool:
+    """is_listening returns whether this process is listening to channel, starting the
+    listener if it isn't running. The first call after the process starts returns False,
+    while the listener connects."""
+    global _listener_pid
+    pid = os.getpid()
+    if _listener_pid != pid:
+        with _lock:
+            if _listener_pid != pid:
+                _listener_pid = pid
+                _listening.clear()
+                threading.Thread(
+                    target=_listen, name="notifications", daemon=True
+                ).start()
+    return channel in _listening
+
+
+def _listen() -> None:
+    delay = RECONNECT_SECONDS
+    while True:
+        try:
+            conn = connect()
+        except Exception:
+            logger.exception("Couldn't connect to listen for notifications")
+        else:
+            try:
+                conn.autocommit = True
+                _listen_on(conn)
+            except Exception:
+                logger.exception("Stopped listening for notifications")
+                # We connected, so start backing off afresh.
+                delay = RECONNECT_SECONDS
+            finally:
+                _listening.clear()
+                conn.close()
+        time.sleep(delay)
+        delay = min(delay * 2, MAX_RECONNECT_SECONDS)
+
+
+def _listen_on(conn) -> None:
+    with conn.cursor() as cur:
+        while True:
+            with _lock:
+                channels = {
+                    channel: list(subscriptions)
+                    for channel, subscriptions in _subscriptions.items()
+                }
+            new_channels = channels.keys() - _listening
+            for channel in new_channels:
+                cur.execute(f'LISTEN "{channel}"')
+            if new_channels:
+                # Anything cached before we were listening may have missed changes.
+                for channel in new_channels:
+                    for subscription in channels[channel]:
+                        _call(subscription.on_reset)
+                _listening.update(new_channels)
+
+            if select.select([conn], [], [], POLL_SECONDS)[0]:
+                conn.poll()
+                while conn.notifies:
+                    message = conn.notifies.pop(0)
+                    for subscription in channels.get(message.channel, []):
+                        _call(subscription.on_message, message.payload)
+
+
+def _call(callback: Callable, *args) -> None:
+    try:
+        callback(*args)
+    except Exception:
+        logger.exception("Notification subscriber %r failed", callback)
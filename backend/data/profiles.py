@@ -0,0 +1,94 @@
+import datetime
+from dataclasses import dataclass
+from typing import List, Optional
+
+from data.blooms import Bloom
+from data.connection import db_cursor
+
+
+@dataclass
+class Profile:
+    username: str
+    recent_blooms: List[Bloom]
+    follower_count: int
+    following_count: int
+    total_blooms: int
+
+
+def get_profile(username: str, *, recent_blooms: int) -> Optional[Profile]:
+    """get_profile loads a user's counters and recent blooms in a single query. Who they
+    follow and are followed by come from data.follows."""
+    with db_cursor(readonly=True) as cur:
+        cur.execute(
+            """SELECT
+              users.follower_count,
+              users.following_count,
+              users.bloom_count,
+              (
+                SELECT COALESCE(json_agg(json_build_array(id, content, send_timestamp)), '[]')
+                FROM (
+                  SELECT id, content, send_timestamp FROM blooms
+                  WHERE sender_id = users.id
+                  ORDER BY send_timestamp DESC, id DESC
+                  LIMIT %(recent_blooms)s
+                ) AS recent
+              )
+            FROM users
+            WHERE username = %(username)s
+            """,
+            dict(
+                username=username,
+                recent_blooms=recent_blooms,
+            ),
+        )
+        row = cur.fetchone()
+    if row is None:
+        return None
+    (
+        follower_count,
+        following_count,
+        bloom_count,
+        recent_rows,
+    ) = row
+    return Profile(
+        username=username,
+        recent_blooms=[
+            Bloom(
+                id=bloom_id,
+                sender=username,
+                content=content,
+                sent_timestamp=datetime.datetime.fromisoformat(timestamp),
+            )
+            for bloom_id, content, timestamp in recent_rows
+        ],
+        follower_count=follower_count,
+        following_count=following_count,
+        total_blooms=bloom_count,
+    )
+
+
+def reconcile_counters() -> int:
+    """reconcile_counters recomputes every user's counters, repairing any which have
+    drifted, and returns how many users needed repairing."""
+    with db_cursor() as cur:
+        cur.execute("""UPDATE users SET
+              follower_count = actual.follower_count,
+              following_count = actual.following_count,
+              bloom_count = actual.bloom_count
+            FROM (
+              SELECT
+                users.id,
+                (SELECT COUNT(*) FROM follows WHERE followee = users.id) AS follower_count,
+                (SELECT COUNT(*) FROM follows WHERE follower = users.id) AS following_count,
+                (SELECT COUNT(*) FROM blooms WHERE sender_id = users.id) AS bloom_count
+              FROM users
+            ) AS actual
+            WHERE
+              users.id = actual.id
+              AND (
+                users.follower_count <> actual.follower_count
+                OR users.following_count <> actual.following_count
+                OR users.bloom_count <> actual.bloom_count
+              )
+            """)
+        return cur.rowcount
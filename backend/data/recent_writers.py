@@ -0,0 +1,77 @@
+"""Who has written something recently, so should read from the primary to see it.
+
+Replicas lag a little behind the primary, so for a moment after someone sends a bloom or
+follows someone, reads from a replica may not include it. Writes which users expect to
+see at once call record_write, and for READ_YOUR_WRITES_SECONDS after that, lookup_user
+sends the writer's reads to the primary (see data.connection.read_from_primary).
+
+record_write notifies WRITES_CHANNEL, so that every process knows who wrote recently,
+however their requests are spread between them. A process which isn't listening can't
+know, so everyone reads from the primary until it is, and for READ_YOUR_WRITES_SECONDS
+after it (re)connects, as it may have missed some writes.
+
+Without replicas, everything is read from the primary anyway, so nothing is recorded.
+"""
+
+from collections import deque
+import os
+import threading
+import time
+from typing import Deque, Dict, Tuple
+
+from data import notifications
+from data.connection import REPLICAS
+
+WRITES_CHANNEL = "writes"
+
+WINDOW_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "10"))
+
+_lock = threading.Lock()
+# When each recent writer's window ends, by username, and the same in the order they end.
+_window_ends: Dict[str, float] = {}
+_ends: Deque[Tuple[float, str]] = deque()
+# When everyone's window ends, after the listener (re)connects.
+_everyone_until = 0.0
+
+
+def record_write(cur, username: str) -> None:
+    """record_write sends username's reads to the primary for a while, in every process
+    once the transaction cur is in commits."""
+    if not REPLICAS:
+        return
+    notifications.notify(cur, WRITES_CHANNEL, username)
+    # Don't wait for the notification, in case the writer's next request comes here.
+    _open_window(username)
+
+
+def wrote_recently(username: str) -> bool:
+    """wrote_recently returns whether username should read from the primary, to see their
+    recent writes."""
+    if not REPLICAS:
+        return False
+    if not notifications.is_listening(WRITES_CHANNEL):
+        return True
+    now = time.monotonic()
+    return now < _everyone_until or now < _window_ends.get(username, 0.0)
+
+
+def _open_window(username: str) -> None:
+    now = time.monotonic()
+    end = now + WINDOW_SECONDS
+    with _lock:
+        while _ends and _ends[0][0] <= now:
+            ended_at, ended = _ends.popleft()
+            if _window_ends.get(ended) == ended_at:
+                del _window_ends[ended]
+        _window_ends[username] = end
+        _ends.append((end, username))
+
+
+def _open_everyones_window() -> None:
+    global _everyone_until
+    _everyone_until = time.monotonic() + WINDOW_SECONDS
+
+
+notifications.subscribe(
+    WRITES_CHANNEL, on_message=_open_window, on_reset=_open_everyones_window
+)
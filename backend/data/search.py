@@ -0,0 +1,211 @@
+"""Full-text search over bloom content.
+
+blooms.search_vector holds each bloom's words, generated from its content with the
+'simple' text search configuration, and is indexed with GIN. Searches are parsed into a
+tsquery here rather than by Postgres, so that we can support prefixes as well as phrases.
+
+Ranking every bloom which matches a common word would mean reading every one of them, so
+results are ranked among the newest SEARCH_MAX_RANKED_MATCHES matches only. Postgres
+finds those either from the GIN index (for rare words) or by walking blooms newest first
+until it has enough (for common ones), so a search reads a bounded number of blooms
+however many match.
+"""
+
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from data.blooms import (
+    Bloom,
+    Cursor,
+    make_before_clause,
+    make_limit_clause,
+    rows_to_blooms,
+)
+from data.connection import db_cursor
+
+SORT_RELEVANCE = "relevance"
+SORT_RECENT = "recent"
+SORTS = (SORT_RELEVANCE, SORT_RECENT)
+
+MAX_RANKED_MATCHES = int(os.getenv("SEARCH_MAX_RANKED_MATCHES", "1000"))
+MAX_TERMS = 16
+# Shorter prefixes match so many words that searching for them is as slow as a scan.
+MIN_PREFIX_LENGTH = 2
+
+# A "quoted phrase" (which may be missing its closing quote), or a single word, either of
+# which may be excluded with a leading -.
+_TERM = re.compile(r'(-?)(?:"([^"]*)"?|(\S+))')
+_WORD_CHARACTER = re.compile(r"\w")
+# The runs of letters and digits Postgres splits a word into (roughly: it keeps some, like
+# host names, whole), each of which becomes a prefix in a prefix search.
+_LEXEME = re.compile(r"[^\W_]+")
+
+
+def parse_search_query(text: str) -> str:
+    """parse_search_query turns a search into a tsquery, raising ValueError if it has
+    nothing to search for.
+
+    Blooms must contain every word, "quoted phrase" and prefix* in the search, and none
+    of the -excluded words or phrases.
+    """
+    terms = []
+    has_match = False
+    for match in _TERM.finditer(text):
+        exclude, phrase, word = match.groups()
+        words = [
+            lexeme
+            for lexeme in map(
+                parse_word, phrase.split() if phrase is not None else [word]
+            )
+            if lexeme is not None
+        ]
+        if not words:
+            continue
+        term = " <-> ".join(words)
+        if exclude:
+            terms.append(f"!({term})")
+        else:
+            terms.append(f"({term})")
+            has_match = True
+    if not has_match:
+        raise ValueError("Search must contain at least one word")
+    if len(terms) > MAX_TERMS:
+        raise ValueError(f"Search must contain at most {MAX_TERMS} words or phrases")
+    return " & ".join(terms)
+
+
+def parse_word(word: str) -> Optional[str]:
+    """parse_word quotes a word for a tsquery, returning None if it has no letters or
+    digits. Postgres splits it into lexemes the same way as it split bloom content."""
+    prefix = word.endswith("*")
+    word = word.rstrip("*")
+    if not _WORD_CHARACTER.search(word):
+        return None
+    if prefix and any(
+        len(lexeme) < MIN_PREFIX_LENGTH for lexeme in _LEXEME.findall(word)
+    ):
+        raise ValueError(
+            f"Prefix searches need at least {MIN_PREFIX_LENGTH} letters or digits in"
+            f" each part of the word: {word}*"
+        )
+    quoted = "'" + word.replace("\\", "\\\\").replace("'", "''") + "'"
+    return quoted + ":*" if prefix else quoted
+
+
+def search_blooms(
+    tsquery: str,
+    *,
+    author: Optional[str] = None,
+    sort: str = SORT_RELEVANCE,
+    before: Optional[Cursor] = None,
+    limit: Optional[int] = None,
+) -> List[Bloom]:
+    """search_blooms returns the blooms matching tsquery (made by parse_search_query),
+    optionally only those sent by author.
+
+    Blooms are sorted most relevant first, or newest first. Either way, before is the last
+    bloom of the previous page.
+    """
+    if sort == SORT_RELEVANCE:
+        query, kwargs = relevant_blooms_query(
+            tsquery, author=author, before=before, limit=limit
+        )
+    else:
+        query, kwargs = recent_blooms_query(
+            tsquery, author=author, before=before, limit=limit
+        )
+    with db_cursor(readonly=True) as cur:
+        cur.execute(query, kwargs)
+        return rows_to_blooms(cur.fetchall())
+
+
+def make_author_clause(author: Optional[str], kwargs: Dict[str, Any]) -> str:
+    if author is None:
+        return ""
+    kwargs["author"] = author
+    return "AND sender_id = (SELECT id FROM users WHERE username = %(author)s)"
+
+
+def recent_blooms_query(
+    tsquery: str,
+    *,
+    author: Optional[str],
+    before: Optional[Cursor],
+    limit: Optional[int],
+) -> Tuple[str, Dict[str, Any]]:
+    kwargs: Dict[str, Any] = {"tsquery": tsquery}
+    author_clause = make_author_clause(author, kwargs)
+    before_clause = make_before_clause(
+        before, kwargs, timestamp_column="send_timestamp", id_column="id"
+    )
+    limit_clause = make_limit_clause(limit, kwargs)
+    # Only the page is joined to users: Postgres can't tell how many blooms match, and
+    # may otherwise plan to join every user.
+    query = f"""SELECT
+      page.id, users.username, page.content, page.send_timestamp
+    FROM
+      (
+        SELECT id, sender_id, content, send_timestamp
+        FROM blooms
+        WHERE
+          search_vector @@ to_tsquery('simple', %(tsquery)s)
+          {author_clause}
+          {before_clause}
+        ORDER BY send_timestamp DESC, id DESC
+        {limit_clause}
+      ) AS page
+      INNER JOIN users ON users.id = page.sender_id
+    ORDER BY page.send_timestamp DESC, page.id DESC
+    """
+    return query, kwargs
+
+
+def relevant_blooms_query(
+    tsquery: str,
+    *,
+    author: Optional[str],
+    before: Optional[Cursor],
+    limit: Optional[int],
+) -> Tuple[str, Dict[str, Any]]:
+    kwargs: Dict[str, Any] = {"tsquery": tsquery, "max_matches": MAX_RANKED_MATCHES}
+    author_clause = make_author_clause(author, kwargs)
+    if before is not None:
+        # The cursor's rank is looked up rather than sent to the client, so cursors look
+        # the same however blooms are sorted.
+        before_clause = """WHERE (rank, send_timestamp, id) < (
+          (SELECT ts_rank(search_vector, to_tsquery('simple', %(tsquery)s)) FROM blooms WHERE id = %(before_id)s),
+          %(before_timestamp)s,
+          %(before_id)s
+        )"""
+        kwargs["before_timestamp"] = before.send_timestamp
+        kwargs["before_id"] = before.id
+    else:
+        before_clause = ""
+    limit_clause = make_limit_clause(limit, kwargs)
+    # Only the newest matches are ranked, and only the page of them is joined to users.
+    query = f"""SELECT
+      page.id, users.username, page.content, page.send_timestamp
+    FROM
+      (
+        SELECT id, sender_id, content, send_timestamp, rank
+        FROM (
+          SELECT
+            newest.*, ts_rank(search_vector, to_tsquery('simple', %(tsquery)s)) AS rank
+          FROM (
+            SELECT id, sender_id, content, send_timestamp, search_vector
+            FROM blooms
+            WHERE search_vector @@ to_tsquery('simple', %(tsquery)s)
+              {author_clause}
+            ORDER BY send_timestamp DESC, id DESC
+            LIMIT %(max_matches)s
+          ) AS newest
+        ) AS ranked
+        {before_clause}
+        ORDER BY rank DESC, send_timestamp DESC, id DESC
+        {limit_clause}
+      ) AS page
+      INNER JOIN users ON users.id = page.sender_id
+    ORDER BY page.rank DESC, page.send_timestamp DESC, page.id DESC
+    """
+    return query, kwargs
@@ -0,0 +1,44 @@
+import unittest
+
+from data.search import parse_search_query
+
+
+class TestSearch(unittest.TestCase):
+    def test_parse_search_query(self):
+        self.assertEqual(parse_search_query("cats  dogs"), "('cats') & ('dogs')")
+        self.assertEqual(
+            parse_search_query('"big red" dog'), "('big' <-> 'red') & ('dog')"
+        )
+        self.assertEqual(parse_search_query("photo*"), "('photo':*)")
+        self.assertEqual(
+            parse_search_query('cats -dogs -"hot dog"'),
+            "('cats') & !('dogs') & !('hot' <-> 'dog')",
+        )
+        # An unfinished phrase runs to the end.
+        self.assertEqual(parse_search_query('"big red'), "('big' <-> 'red')")
+        # Words without letters or digits are ignored.
+        self.assertEqual(parse_search_query("cats & !!"), "('cats')")
+
+    def test_parse_search_query_escapes_quotes(self):
+        self.assertEqual(
+            parse_search_query("it's back\\slash"),
+            "('it''s') & ('back\\\\slash')",
+        )
+
+    def test_parse_search_query_rejects_empty_searches(self):
+        for text in ["", "   ", "!!", '""', "-cats", "a*"]:
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                parse_search_query(text)
+        with self.assertRaises(ValueError):
+            parse_search_query(" ".join(["word"] * 17))
+
+    def test_prefixes_are_checked_per_lexeme(self):
+        # Postgres splits these into several lexemes, each a prefix: 'can':* <-> 't':*.
+        for text in ["a:*", "can't*", "a_bc*", "x-ray*"]:
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                parse_search_query(text)
+        self.assertEqual(parse_search_query("well-known*"), "('well-known':*)")
+
+
+if __name__ == "__main__":
+    unittest.main()
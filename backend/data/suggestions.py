@@ -0,0 +1,110 @@
+"""Precomputed follow suggestions.
+
+Each user's top SUGGESTIONS_PER_USER candidates are scored from the follow graph and
+stored in follow_suggestions, so serving /suggested-follows is an indexed read:
+  * each user followed by someone they follow scores MUTUAL_WEIGHT,
+  * each follower they don't follow back scores FOLLOW_BACK_WEIGHT,
+  * each user followed by one of their followers scores FOLLOWER_OVERLAP_WEIGHT,
+and candidates who have sent a bloom in the last ACTIVE_DAYS get ACTIVE_BOOST times
+their score. Every hop through the graph looks at no more than GRAPH_FANOUT users, so
+refreshing one user's suggestions stays cheap however well-connected they are.
+"""
+
+SUGGESTIONS_PER_USER = 20
+GRAPH_FANOUT = 200
+MUTUAL_WEIGHT = 1.0
+FOLLOW_BACK_WEIGHT = 2.0
+FOLLOWER_OVERLAP_WEIGHT = 0.5
+ACTIVE_DAYS = 7
+ACTIVE_BOOST = 1.5
+
+
+def refresh_suggestions(cur, user_id: int) -> None:
+    """refresh_suggestions recomputes user_id's suggestions from scratch."""
+    cur.execute("DELETE FROM follow_suggestions WHERE user_id = %s", (user_id,))
+    cur.execute(
+        """WITH
+          followees AS (
+            SELECT followee AS id FROM follows WHERE follower = %(user_id)s LIMIT %(fanout)s
+          ),
+          followers AS (
+            SELECT follower AS id FROM follows WHERE followee = %(user_id)s LIMIT %(fanout)s
+          ),
+          candidates AS (
+            SELECT second_hop.followee AS id, %(mutual_weight)s AS weight
+            FROM followees CROSS JOIN LATERAL (
+              SELECT followee FROM follows WHERE follower = followees.id LIMIT %(fanout)s
+            ) AS second_hop
+            UNION ALL
+            SELECT id, %(follow_back_weight)s FROM followers
+            UNION ALL
+            SELECT second_hop.followee, %(follower_overlap_weight)s
+            FROM followers CROSS JOIN LATERAL (
+              SELECT followee FROM follows WHERE follower = followers.id LIMIT %(fanout)s
+            ) AS second_hop
+          )
+        INSERT INTO follow_suggestions (user_id, suggested_user_id, score)
+        SELECT
+          %(user_id)s,
+          candidates.id,
+          SUM(candidates.weight) * CASE
+            WHEN users.last_bloom_at > now() - make_interval(days => %(active_days)s) THEN %(active_boost)s
+            ELSE 1
+          END AS score
+        FROM candidates INNER JOIN users ON users.id = candidates.id
+        WHERE
+          candidates.id <> %(user_id)s
+          AND NOT EXISTS (
+            SELECT 1 FROM follows WHERE follower = %(user_id)s AND followee = candidates.id
+          )
+        GROUP BY candidates.id, users.last_bloom_at
+        ORDER BY score DESC
+        LIMIT %(limit)s
+        """,
+        dict(
+            user_id=user_id,
+            fanout=GRAPH_FANOUT,
+            mutual_weight=MUTUAL_WEIGHT,
+            follow_back_weight=FOLLOW_BACK_WEIGHT,
+            follower_overlap_weight=FOLLOWER_OVERLAP_WEIGHT,
+            active_days=ACTIVE_DAYS,
+            active_boost=ACTIVE_BOOST,
+            limit=SUGGESTIONS_PER_USER,
+        ),
+    )
+
+
+def update_suggestions_after_follow(cur, *, follower_id: int, followee_id: int) -> None:
+    """update_suggestions_after_follow updates the suggestions affected by a new follow.
+
+    The follower's suggestions are recomputed, as their neighbourhood in the graph has
+    changed. The followee just gains the follower as a follow-back candidate.
+    """
+    refresh_suggestions(cur, follower_id)
+    cur.execute(
+        """INSERT INTO follow_suggestions (user_id, suggested_user_id, score)
+        SELECT %(followee_id)s, %(follower_id)s, %(follow_back_weight)s
+        WHERE NOT EXISTS (
+          SELECT 1 FROM follows WHERE follower = %(followee_id)s AND followee = %(follower_id)s
+        )
+        ON CONFLICT (user_id, suggested_user_id) DO UPDATE
+        SET score = follow_suggestions.score + EXCLUDED.score
+        """,
+        dict(
+            follower_id=follower_id,
+            followee_id=followee_id,
+            follow_back_weight=FOLLOW_BACK_WEIGHT,
+        ),
+    )
+    # Keep only the followee's top suggestions.
+    cur.execute(
+        """DELETE FROM follow_suggestions
+        WHERE user_id = %(followee_id)s AND suggested_user_id NOT IN (
+          SELECT suggested_user_id FROM follow_suggestions
+          WHERE user_id = %(followee_id)s
+          ORDER BY score DESC
+          LIMIT %(limit)s
+        )
+        """,
+        dict(followee_id=followee_id, limit=SUGGESTIONS_PER_USER),
+    )
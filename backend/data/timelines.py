@@ -0,0 +1,74 @@
+"""Materialized home timelines.
+
+Blooms are pushed into each follower's timeline when they are sent (fan-out-on-write),
+so reading /home is a single range read. Senders with more than FANOUT_MAX_FOLLOWERS
+followers are recorded as celebrities and are not fanned out - their blooms are merged
+into the timeline when it is read instead (fan-out-on-read).
+"""
+
+import datetime
+import os
+from typing import List, Tuple
+
+FANOUT_MAX_FOLLOWERS = int(os.getenv("TIMELINE_FANOUT_MAX_FOLLOWERS", "10000"))
+BACKFILL_BLOOMS = int(os.getenv("TIMELINE_BACKFILL_BLOOMS", "50"))
+
+
+def is_celebrity(cur, user_id: int) -> bool:
+    cur.execute("SELECT 1 FROM celebrities WHERE user_id = %s", (user_id,))
+    return cur.fetchone() is not None
+
+
+def fan_out_blooms(
+    cur, *, sender_id: int, blooms: List[Tuple[int, datetime.datetime]]
+) -> None:
+    """fan_out_blooms pushes new (bloom id, send timestamp) pairs from one sender into the
+    sender's and their followers' timelines."""
+    kwargs = dict(
+        sender_id=sender_id,
+        bloom_ids=[bloom_id for bloom_id, _ in blooms],
+        send_timestamps=[send_timestamp for _, send_timestamp in blooms],
+    )
+    if not is_celebrity(cur, sender_id):
+        cur.execute("SELECT follower_count FROM users WHERE id = %(sender_id)s", kwargs)
+        if cur.fetchone()[0] > FANOUT_MAX_FOLLOWERS:
+            cur.execute(
+                "INSERT INTO celebrities (user_id) VALUES (%(sender_id)s) ON CONFLICT DO NOTHING",
+                kwargs,
+            )
+        else:
+            cur.execute(
+                """INSERT INTO timelines (user_id, bloom_id, send_timestamp)
+                SELECT follows.follower, new_blooms.id, new_blooms.send_timestamp
+                FROM
+                  follows
+                  CROSS JOIN unnest(%(bloom_ids)s::bigint[], %(send_timestamps)s::timestamp[])
+                    AS new_blooms (id, send_timestamp)
+                WHERE follows.followee = %(sender_id)s
+                ON CONFLICT DO NOTHING""",
+                kwargs,
+            )
+    # Users always see their own blooms, even celebrities.
+    cur.execute(
+        """INSERT INTO timelines (user_id, bloom_id, send_timestamp)
+        SELECT %(sender_id)s, new_blooms.id, new_blooms.send_timestamp
+        FROM unnest(%(bloom_ids)s::bigint[], %(send_timestamps)s::timestamp[])
+          AS new_blooms (id, send_timestamp)
+        ON CONFLICT DO NOTHING""",
+        kwargs,
+    )
+
+
+def backfill_timeline(cur, *, follower_id: int, followee_id: int) -> None:
+    """backfill_timeline copies a newly-followed user's recent blooms into the follower's timeline."""
+    if is_celebrity(cur, followee_id):
+        return
+    cur.execute(
+        """INSERT INTO timelines (user_id, bloom_id, send_timestamp)
+        SELECT %(follower_id)s, id, send_timestamp FROM blooms
+        WHERE sender_id = %(followee_id)s
+        ORDER BY send_timestamp DESC
+        LIMIT %(limit)s
+        ON CONFLICT DO NOTHING""",
+        dict(follower_id=follower_id, followee_id=followee_id, limit=BACKFILL_BLOOMS),
+    )
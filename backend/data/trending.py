@@ -0,0 +1,264 @@
+"""Trending hashtags.
+
+add_blooms counts how many blooms use each hashtag in time buckets (hashtag_counts), so
+finding trends never scans the hashtags table. A hashtag trends when it is used more in a
+window (e.g. the last hour) than its rate over a longer baseline before that (e.g. the day
+before) predicts, so steady, popular hashtags don't crowd out rising ones. It is scored as
+(count - expected) / sqrt(expected + 1): how many standard deviations above its expected
+count it is, if uses were a Poisson process.
+
+Ranking every hashtag is too slow to do on every read, so the top TRENDING_MAX_HASHTAGS
+of each window are stored in trending_hashtags, and re-ranked once they are older than
+TRENDING_REFRESH_SECONDS by whichever request next notices (the others keep reading the old
+ranking meanwhile). Processes also cache the ranking for TRENDING_CACHE_SECONDS. Reading
+the trends therefore costs O(top-K), however many hashtags there are.
+"""
+
+from collections import Counter
+from dataclasses import dataclass
+import datetime
+import os
+from typing import Dict, Iterable, List
+
+from cache import MISSING, LRUCache
+from data.connection import db_cursor
+from psycopg2.extras import execute_values
+
+
+@dataclass(frozen=True)
+class TrendWindow:
+    seconds: int
+    # The size of the buckets counted in the window; migrations make buckets of each size.
+    bucket_seconds: int
+    baseline_seconds: int
+
+
+WINDOWS: Dict[str, TrendWindow] = {
+    "hour": TrendWindow(
+        seconds=60 * 60, bucket_seconds=5 * 60, baseline_seconds=24 * 60 * 60
+    ),
+    "day": TrendWindow(
+        seconds=24 * 60 * 60, bucket_seconds=60 * 60, baseline_seconds=7 * 24 * 60 * 60
+    ),
+}
+DEFAULT_WINDOW = "hour"
+
+# How long to keep buckets of each size: as far back as any window using them looks.
+BUCKET_RETENTION_SECONDS: Dict[int, int] = {}
+for _window in WINDOWS.values():
+    BUCKET_RETENTION_SECONDS[_window.bucket_seconds] = max(
+        BUCKET_RETENTION_SECONDS.get(_window.bucket_seconds, 0),
+        _window.seconds + _window.baseline_seconds,
+    )
+
+MAX_HASHTAGS = int(os.getenv("TRENDING_MAX_HASHTAGS", "50"))
+# Hashtags used fewer times than this in a window never trend in it, however new they are.
+MIN_COUNT = int(os.getenv("TRENDING_MIN_COUNT", "3"))
+REFRESH_SECONDS = float(os.getenv("TRENDING_REFRESH_SECONDS", "60"))
+
+_trending_cache = LRUCache(
+    len(WINDOWS), ttl=float(os.getenv("TRENDING_CACHE_SECONDS", "10"))
+)
+
+
+@dataclass(slots=True)
+class Trend:
+    hashtag: str
+    score: float
+    count: int
+    expected: float
+
+
+def bucket_start(
+    timestamp: datetime.datetime, bucket_seconds: int
+) -> datetime.datetime:
+    """bucket_start returns the start of the bucket of bucket_seconds containing timestamp."""
+    epoch = timestamp.timestamp()
+    return datetime.datetime.fromtimestamp(
+        epoch - epoch % bucket_seconds, tz=datetime.UTC
+    )
+
+
+def count_hashtags(cur, timestamp: datetime.datetime, hashtags: Iterable[str]) -> None:
+    """count_hashtags adds uses of hashtags at timestamp to the bucketed counts.
+
+    Popular hashtags' counts are updated by many transactions at once, so call this last in
+    a transaction, to hold their row locks as briefly as possible.
+    """
+    counts = Counter(hashtags)
+    if not counts:
+        return
+    # Lock rows in the same order in every transaction, so that they can't deadlock.
+    rows = sorted(
+        (bucket_seconds, bucket_start(timestamp, bucket_seconds), hashtag, count)
+        for bucket_seconds in BUCKET_RETENTION_SECONDS
+        for hashtag, count in counts.items()
+    )
+    execute_values(
+        cur,
+        """INSERT INTO hashtag_counts (bucket_seconds, bucket_start, hashtag, count)
+        VALUES %s
+        ON CONFLICT (bucket_seconds, bucket_start, hashtag)
+        DO UPDATE SET count = hashtag_counts.count + EXCLUDED.count""",
+        rows,
+    )
+
+
+def get_trending(window_name: str, limit: int) -> List[Trend]:
+    """get_trending returns the top limit (at most TRENDING_MAX_HASHTAGS) trending hashtags
+    in the named window, most trending first."""
+    trends = _trending_cache.get(window_name)
+    if trends is MISSING:
+        trends = load_trending(window_name)
+        _trending_cache.set(window_name, trends)
+    return trends[:limit]
+
+
+def load_trending(window_name: str) -> List[Trend]:
+    with db_cursor() as cur:
+        if is_stale(cur, window_name) and try_lock_ranking(cur, window_name):
+            # Someone else may have re-ranked it while we were getting the lock.
+            if is_stale(cur, window_name):
+                rank_trending(cur, window_name)
+        cur.execute(
+            """SELECT hashtag, score, recent_count, expected_count
+            FROM trending_hashtags
+            WHERE trend_window = %(window)s
+            ORDER BY rank""",
+            dict(window=window_name),
+        )
+        return [
+            Trend(hashtag=hashtag, score=score, count=count, expected=expected)
+            for hashtag, score, count, expected in cur.fetchall()
+        ]
+
+
+def is_stale(cur, window_name: str) -> bool:
+    cur.execute(
+        """SELECT NOT EXISTS(
+          SELECT 1 FROM trending_refreshes
+          WHERE trend_window = %(window)s
+          AND refreshed_at > now() - make_interval(secs => %(refresh_seconds)s)
+        )""",
+        dict(window=window_name, refresh_seconds=REFRESH_SECONDS),
+    )
+    return cur.fetchone()[0]
+
+
+def try_lock_ranking(cur, window_name: str) -> bool:
+    """try_lock_ranking takes a lock on re-ranking the window until the transaction ends,
+    returning False if someone else holds it."""
+    cur.execute(
+        "SELECT pg_try_advisory_xact_lock(hashtext(%(key)s))",
+        dict(key=f"trending:{window_name}"),
+    )
+    return cur.fetchone()[0]
+
+
+def rank_trending(cur, window_name: str) -> None:
+    """rank_trending re-ranks the window's trending hashtags from the bucketed counts, and
+    forgets counts which no window needs any more."""
+    window = WINDOWS[window_name]
+    now = datetime.datetime.now(tz=datetime.UTC)
+    # The window is made of whole buckets, the last of which is still filling up.
+    window_start = bucket_start(
+        now - datetime.timedelta(seconds=window.seconds - window.bucket_seconds),
+        window.bucket_seconds,
+    )
+    baseline_start = window_start - datetime.timedelta(seconds=window.baseline_seconds)
+    window_elapsed = (now - window_start).total_seconds()
+    cur.execute(
+        "DELETE FROM trending_hashtags WHERE trend_window = %(window)s",
+        dict(window=window_name),
+    )
+    cur.execute(
+        """INSERT INTO trending_hashtags
+          (trend_window, rank, hashtag, score, recent_count, expected_count)
+        SELECT
+          %(window)s, row_number() OVER (ORDER BY score DESC, hashtag), hashtag, score, recent, expected
+        FROM (
+          SELECT hashtag, recent, expected, (recent - expected) / sqrt(expected + 1) AS score
+          FROM (
+            SELECT
+              hashtag,
+              SUM(count) FILTER (WHERE bucket_start >= %(window_start)s) AS recent,
+              COALESCE(SUM(count) FILTER (WHERE bucket_start < %(window_start)s), 0)
+                * %(baseline_scale)s AS expected
+            FROM hashtag_counts
+            WHERE bucket_seconds = %(bucket_seconds)s AND bucket_start >= %(baseline_start)s
+            GROUP BY hashtag
+          ) AS counts
+          WHERE recent >= %(min_count)s
+        ) AS scored
+        WHERE score > 0
+        ORDER BY score DESC, hashtag
+        LIMIT %(max_hashtags)s""",
+        dict(
+            window=window_name,
+            window_start=window_start,
+            baseline_start=baseline_start,
+            baseline_scale=window_elapsed / window.baseline_seconds,
+            bucket_seconds=window.bucket_seconds,
+            min_count=MIN_COUNT,
+            max_hashtags=MAX_HASHTAGS,
+        ),
+    )
+    cur.execute(
+        """INSERT INTO trending_refreshes (trend_window, refreshed_at)
+        VALUES (%(window)s, now())
+        ON CONFLICT (trend_window) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at""",
+        dict(window=window_name),
+    )
+    retention = BUCKET_RETENTION_SECONDS[window.bucket_seconds]
+    cur.execute(
+        """DELETE FROM hashtag_counts
+        WHERE bucket_seconds = %(bucket_seconds)s AND bucket_start < %(oldest)s""",
+        dict(
+            bucket_seconds=window.bucket_seconds,
+            oldest=bucket_start(
+                now - datetime.timedelta(seconds=retention), window.bucket_seconds
+            ),
+        ),
+    )
+
+
+def recount_hashtags() -> None:
+    """recount_hashtags recomputes the bucketed counts still needed by any window from the
+    hashtags table, e.g. after blooms' hashtags have been reindexed."""
+    now = datetime.datetime.now(tz=datetime.UTC)
+    with db_cursor() as cur:
+        for bucket_seconds, retention in BUCKET_RETENTION_SECONDS.items():
+            cur.execute(
+                """WITH
+                  counts AS (
+                    SELECT
+                      date_bin(make_interval(secs => %(bucket_seconds)s), blooms.send_timestamp, TIMESTAMP '1970-01-01') AS bucket_start,
+                      hashtags.hashtag,
+                      COUNT(*) AS count
+                    FROM hashtags
+                    INNER JOIN blooms ON blooms.id = hashtags.bloom_id
+                    WHERE blooms.send_timestamp >= %(oldest)s
+                    GROUP BY 1, 2
+                  ),
+                  removed AS (
+                    DELETE FROM hashtag_counts
+                    WHERE bucket_seconds = %(bucket_seconds)s
+                    AND bucket_start >= %(oldest)s
+                    AND NOT EXISTS (
+                      SELECT 1 FROM counts
+                      WHERE counts.bucket_start = hashtag_counts.bucket_start
+                      AND counts.hashtag = hashtag_counts.hashtag
+                    )
+                  )
+                INSERT INTO hashtag_counts (bucket_seconds, bucket_start, hashtag, count)
+                SELECT %(bucket_seconds)s, bucket_start, hashtag, count FROM counts
+                ON CONFLICT (bucket_seconds, bucket_start, hashtag)
+                DO UPDATE SET count = EXCLUDED.count
+                WHERE hashtag_counts.count <> EXCLUDED.count""",
+                dict(
+                    bucket_seconds=bucket_seconds,
+                    oldest=bucket_start(
+                        now - datetime.timedelta(seconds=retention), bucket_seconds
+                    ),
+                ),
+            )
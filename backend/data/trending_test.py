@@ -0,0 +1,29 @@
+import datetime
+import unittest
+
+from data.trending import BUCKET_RETENTION_SECONDS, bucket_start
+
+
+class TestTrending(unittest.TestCase):
+    def test_bucket_start(self):
+        timestamp = datetime.datetime(2024, 3, 1, 12, 34, 56, tzinfo=datetime.UTC)
+        self.assertEqual(
+            bucket_start(timestamp, 300),
+            datetime.datetime(2024, 3, 1, 12, 30, tzinfo=datetime.UTC),
+        )
+        self.assertEqual(
+            bucket_start(timestamp, 3600),
+            datetime.datetime(2024, 3, 1, 12, tzinfo=datetime.UTC),
+        )
+        start = datetime.datetime(2024, 3, 1, 12, 30, tzinfo=datetime.UTC)
+        self.assertEqual(bucket_start(start, 300), start)
+
+    def test_buckets_are_kept_as_long_as_windows_look_back(self):
+        self.assertEqual(
+            BUCKET_RETENTION_SECONDS,
+            {300: 25 * 60 * 60, 3600: 8 * 24 * 60 * 60},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,26 +1,62 @@
 from dataclasses import dataclass
-from hashlib import scrypt
+import functools
 import hashlib
+import hmac
+import os
 import random
 import string
-from typing import List, Optional
+from typing import Dict, List, Optional, Sequence
 
-from data.connection import db_cursor
+from cache import MISSING, CacheStats, LRUCache
+from data.connection import db_cursor, read_from_primary
+from data.recent_writers import record_write, wrote_recently
+from hashing import run_hash
+from flask import g, has_request_context
 from psycopg2.errors import UniqueViolation
 
 
-@dataclass
+@dataclass(frozen=True)
+class ScryptParams:
+    """ScryptParams are the cost parameters a password was hashed with."""
+
+    n: int
+    r: int
+    p: int
+
+
+# The cost parameters for new password hashes. Existing hashes keep the parameters they
+# were made with, and are rehashed with these the next time their user logs in. n defaults
+# to what passwords have always been hashed with: raising it raises the CPU each login
+# takes in proportion, for every user at once, so raise it deliberately (see README.md).
+SCRYPT_PARAMS = ScryptParams(
+    n=int(os.getenv("SCRYPT_N", "8")),
+    r=int(os.getenv("SCRYPT_R", "8")),
+    p=int(os.getenv("SCRYPT_P", "1")),
+)
+
+
+@dataclass(slots=True)
 class User:
     id: int
     username: str
     password_salt: bytes
     password_scrypt: bytes
+    scrypt_params: ScryptParams
 
     def check_password(self, password_plaintext: str) -> bool:
-        return self.password_scrypt == scrypt(
-            password_plaintext.encode("utf-8"), self.password_salt
+        """check_password hashes password_plaintext on the hashing pool, so may raise HashingSaturatedError."""
+        return hmac.compare_digest(
+            self.password_scrypt,
+            scrypt(
+                password_plaintext.encode("utf-8"),
+                self.password_salt,
+                self.scrypt_params,
+            ),
         )
 
+    def needs_rehash(self) -> bool:
+        return self.scrypt_params != SCRYPT_PARAMS
+
 
 class UserRegistrationError(Exception):
     reason: str
@@ -29,69 +65,240 @@ class UserRegistrationError(Exception):
         self.reason = reason
 
 
+# Users by username. Usernames which don't exist aren't cached: other processes would keep
+# treating them as missing after they were registered, as registering only invalidates the
+# registering process' cache.
+_user_cache = LRUCache(
+    int(os.getenv("USER_CACHE_MAX_SIZE", "10000")),
+    ttl=float(os.getenv("USER_CACHE_TTL_SECONDS", "60")),
+)
+
+
 def get_user(username: str) -> Optional[User]:
-    with db_cursor() as cur:
-        cur.execute(
-            "SELECT id, password_salt, password_scrypt FROM users WHERE username = %s",
-            (username,),
-        )
-        row = cur.fetchone()
-        if row is None:
-            return None
-        user_id, password_salt, password_scrypt = row
-        return User(
-            id=user_id,
-            username=username,
-            password_salt=bytes(password_salt),
-            password_scrypt=bytes(password_scrypt),
-        )
+    """get_user looks up a user, memoized for the current request and cached across requests."""
+    memo = _request_memo()
+    if memo is not None and username in memo:
+        return memo[username]
+    user = _user_cache.get(username)
+    if user is MISSING:
+        user = _get_user_uncached(username)
+        if user is not None:
+            _user_cache.set(username, user)
+    if memo is not None:
+        memo[username] = user
+    return user
+
+
+def invalidate_user(username: str) -> None:
+    _user_cache.invalidate(username)
+    memo = _request_memo()
+    if memo is not None:
+        memo.pop(username, None)
+
+
+def user_cache_stats() -> CacheStats:
+    return _user_cache.stats()
+
+
+# Usernames by user id. Usernames never change, so these never go stale.
+_username_cache = LRUCache(int(os.getenv("USERNAME_CACHE_MAX_SIZE", "100000")))
+
+
+def get_usernames(user_ids: Sequence[int]) -> List[str]:
+    """get_usernames returns the usernames of user_ids, in the same order, looking up any
+    which aren't cached in a single query."""
+    usernames = [_username_cache.get(user_id) for user_id in user_ids]
+    missing = [
+        user_id for user_id, username in zip(user_ids, usernames) if username is MISSING
+    ]
+    if not missing:
+        return usernames
+    found: Dict[int, str] = {}
+    # Users too new to have reached a replica yet are looked up on the primary.
+    for readonly in [True, False]:
+        with db_cursor(readonly=readonly) as cur:
+            cur.execute(
+                "SELECT id, username FROM users WHERE id = ANY(%s)",
+                ([user_id for user_id in missing if user_id not in found],),
+            )
+            found.update(cur.fetchall())
+        if len(found) == len(set(missing)):
+            break
+    for user_id, username in found.items():
+        _username_cache.set(user_id, username)
+    return [
+        found[user_id] if username is MISSING else username
+        for user_id, username in zip(user_ids, usernames)
+    ]
+
+
+def _request_memo() -> Optional[Dict[str, Optional[User]]]:
+    if not has_request_context():
+        return None
+    return g.setdefault("users_by_username", {})
+
+
+def _get_user_uncached(username: str) -> Optional[User]:
+    # Users too new to have reached a replica yet are looked up on the primary.
+    for readonly in [True, False]:
+        with db_cursor(readonly=readonly) as cur:
+            cur.execute(
+                "SELECT id, password_salt, password_scrypt, scrypt_n, scrypt_r, scrypt_p FROM users WHERE username = %s",
+                (username,),
+            )
+            row = cur.fetchone()
+        if row is not None:
+            break
+    if row is None:
+        return None
+    user_id, password_salt, password_scrypt, n, r, p = row
+    return User(
+        id=user_id,
+        username=username,
+        password_salt=bytes(password_salt),
+        password_scrypt=bytes(password_scrypt),
+        scrypt_params=ScryptParams(n=n, r=r, p=p),
+    )
 
 
 def get_suggested_follows(following_user: User, limit: int) -> List[str]:
-    with db_cursor() as cur:
+    """get_suggested_follows returns up to limit usernames following_user might like to follow.
+
+    Suggestions come from the precomputed follow_suggestions table; users who don't have
+    enough of them yet (e.g. because they don't follow anyone) get random users too.
+    """
+    kwargs = dict(following_user_id=following_user.id, limit=limit)
+    with db_cursor(readonly=True) as cur:
         cur.execute(
             """
             SELECT
               users.username
             FROM
-              users
+              follow_suggestions INNER JOIN users ON users.id = follow_suggestions.suggested_user_id
             WHERE
-              users.id <> %(following_user_id)s AND
-              users.id NOT IN (
-                SELECT followee FROM follows WHERE follower = %(following_user_id)s
+              follow_suggestions.user_id = %(following_user_id)s AND
+              NOT EXISTS (
+                SELECT 1 FROM follows
+                WHERE follower = %(following_user_id)s AND followee = follow_suggestions.suggested_user_id
               )
-            ORDER BY RANDOM()
+            ORDER BY follow_suggestions.score DESC
             LIMIT %(limit)s
             """,
-            dict(
-                following_user_id=following_user.id,
-                limit=limit,
-            ),
+            kwargs,
         )
-        rows = cur.fetchall()
-        return [row[0] for row in rows]
+        suggestions = [row[0] for row in cur.fetchall()]
+        if len(suggestions) < limit:
+            suggestions += get_random_users_to_follow(
+                cur, following_user, limit - len(suggestions), exclude=suggestions
+            )
+        return suggestions
+
+
+def get_random_users_to_follow(
+    cur, following_user: User, limit: int, *, exclude: List[str]
+) -> List[str]:
+    """get_random_users_to_follow returns up to limit users not already followed, by
+    reading forwards through the users index from a random id rather than sorting the
+    whole table."""
+    kwargs = dict(
+        following_user_id=following_user.id,
+        exclude=exclude or [""],
+        # Look past limit to allow for skipping users who are already followed or suggested.
+        scan_limit=max(limit * 4, 100) + len(exclude),
+    )
+    cur.execute(
+        "SELECT MIN(id) + floor(random() * (MAX(id) - MIN(id) + 1))::int FROM users"
+    )
+    start_id = cur.fetchone()[0] or 0
+    usernames = []
+    # Wrap around to the start of the table if the random start was near its end.
+    for id_clause in ["users.id >= %(start_id)s", "users.id < %(start_id)s"]:
+        cur.execute(
+            f"""
+            SELECT
+              users.username
+            FROM
+              (
+                SELECT id, username FROM users
+                WHERE {id_clause}
+                ORDER BY id
+                LIMIT %(scan_limit)s
+              ) AS users
+            WHERE
+              users.id <> %(following_user_id)s AND
+              users.username <> ALL(%(exclude)s) AND
+              NOT EXISTS (
+                SELECT 1 FROM follows WHERE follower = %(following_user_id)s AND followee = users.id
+              )
+            ORDER BY users.id
+            """,
+            dict(kwargs, start_id=start_id),
+        )
+        usernames += [row[0] for row in cur.fetchall()][: limit - len(usernames)]
+        if len(usernames) >= limit:
+            break
+    return usernames
 
 
 def register_user(username: str, password_plaintext: str) -> User:
     salt = generate_salt()
-    password_scrypt = scrypt(password_plaintext.encode("utf-8"), salt)
+    password_scrypt = scrypt(password_plaintext.encode("utf-8"), salt, SCRYPT_PARAMS)
 
     with db_cursor() as cur:
         try:
             cur.execute(
-                "INSERT INTO users (username, password_salt, password_scrypt) VALUES (%(username)s, %(password_salt)s, %(password_scrypt)s)",
+                "INSERT INTO users (username, password_salt, password_scrypt, scrypt_n, scrypt_r, scrypt_p) VALUES (%(username)s, %(password_salt)s, %(password_scrypt)s, %(n)s, %(r)s, %(p)s)",
                 dict(
                     username=username,
                     password_salt=salt,
                     password_scrypt=password_scrypt,
+                    n=SCRYPT_PARAMS.n,
+                    r=SCRYPT_PARAMS.r,
+                    p=SCRYPT_PARAMS.p,
                 ),
             )
         except UniqueViolation as err:
             raise UserRegistrationError("user already exists")
+        record_write(cur, username)
+    invalidate_user(username)
 
 
-def scrypt(password_plaintext: bytes, password_salt: bytes) -> bytes:
-    return hashlib.scrypt(password_plaintext, salt=password_salt, n=8, r=8, p=1)
+def rehash_password(user: User, password_plaintext: str) -> None:
+    """rehash_password re-hashes user's (already checked) password with SCRYPT_PARAMS."""
+    salt = generate_salt()
+    password_scrypt = scrypt(password_plaintext.encode("utf-8"), salt, SCRYPT_PARAMS)
+    with db_cursor() as cur:
+        cur.execute(
+            "UPDATE users SET password_salt = %(password_salt)s, password_scrypt = %(password_scrypt)s, scrypt_n = %(n)s, scrypt_r = %(r)s, scrypt_p = %(p)s WHERE id = %(user_id)s",
+            dict(
+                user_id=user.id,
+                password_salt=salt,
+                password_scrypt=password_scrypt,
+                n=SCRYPT_PARAMS.n,
+                r=SCRYPT_PARAMS.r,
+                p=SCRYPT_PARAMS.p,
+            ),
+        )
+    invalidate_user(user.username)
+
+
+def scrypt(
+    password_plaintext: bytes, password_salt: bytes, params: ScryptParams
+) -> bytes:
+    """scrypt hashes a password on the hashing pool, so may raise HashingSaturatedError."""
+    return run_hash(
+        functools.partial(
+            hashlib.scrypt,
+            password_plaintext,
+            salt=password_salt,
+            n=params.n,
+            r=params.r,
+            p=params.p,
+            # scrypt needs about 128 * r * (n + p) bytes, and OpenSSL refuses to use more
+            # than 32MiB unless told to, which would cap how far n can be raised.
+            maxmem=max(32 * 1024 * 1024, 2 * 128 * params.r * (params.n + params.p)),
+        )
+    )
 
 
 SALT_CHARACTERS = string.ascii_uppercase + string.ascii_lowercase + string.digits
@@ -104,5 +311,10 @@ def generate_salt() -> bytes:
 
 
 def lookup_user(header_info, payload_info):
-    """lookup_user is a hook for the jwt middleware to look-up authenticated users."""
-    return get_user(payload_info["sub"])
+    """lookup_user is a hook for the jwt middleware to look-up authenticated users. Users
+    who wrote something recently read from the primary for the rest of the request, so
+    that they see it."""
+    username = payload_info["sub"]
+    if wrote_recently(username):
+        read_from_primary()
+    return get_user(username)
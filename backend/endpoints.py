@@ -1,14 +1,52 @@
-from typing import Dict, Union
+from dataclasses import dataclass
+from typing import Dict, Generator, List, Optional, Union
 from data import blooms
-from data.follows import follow, get_followed_usernames, get_inverse_followed_usernames
+from data.connection import query_count
+from data.follows import (
+    follow,
+    get_followed_usernames,
+    get_followers_followed_by,
+    get_inverse_followed_usernames,
+    is_following,
+)
+from data.hashtags import (
+    MAX_SUGGESTIONS as MAX_HASHTAG_SUGGESTIONS,
+    normalize_hashtag,
+    suggest_hashtags,
+)
+from data.profiles import get_profile
+from data.search import (
+    SORT_RECENT as SEARCH_SORT_RECENT,
+    SORT_RELEVANCE as SEARCH_SORT_RELEVANCE,
+    SORTS as SEARCH_SORTS,
+    parse_search_query,
+    search_blooms,
+)
+from data.trending import (
+    DEFAULT_WINDOW as DEFAULT_TRENDING_WINDOW,
+    MAX_HASHTAGS as MAX_TRENDING_HASHTAGS,
+    WINDOWS as TRENDING_WINDOWS,
+    get_trending,
+)
 from data.users import (
     UserRegistrationError,
     get_suggested_follows,
     get_user,
     register_user,
+    rehash_password,
 )
+from hashing import HashingSaturatedError
+
+from http_cache import cached, conditional_response, set_cache_control
 
-from flask import Response, jsonify, make_response, request
+from flask import (
+    Response,
+    current_app,
+    jsonify,
+    make_response,
+    request,
+    stream_with_context,
+)
 from flask_jwt_extended import (
     create_access_token,
     get_current_user,
@@ -18,6 +56,21 @@ from flask_jwt_extended import (
 from datetime import timedelta
 
 MINIMUM_PASSWORD_LENGTH = 5
+DEFAULT_PAGE_SIZE = 50
+DEFAULT_TRENDING_LIMIT = 10
+DEFAULT_HASHTAG_SUGGESTIONS = 10
+MAX_PAGE_SIZE = 100
+PROFILE_RECENT_BLOOMS = 10
+PROFILE_MAX_FOLLOWS = 100
+MAX_BLOOM_BATCH_SIZE = 1000
+# How many blooms a streamed response sends in each chunk.
+STREAM_BLOOMS_PER_CHUNK = 100
+
+
+@dataclass
+class PageArgs:
+    before: Optional[blooms.Cursor]
+    limit: Optional[int]
 
 
 def login():
@@ -29,6 +82,12 @@ def login():
         return make_response(({"success": False, "message": "Unknown user"}, 403))
     if not user.check_password(request.json["password"]):
         return make_response(({"success": False, "message": "Incorrect password"}, 403))
+    if user.needs_rehash():
+        try:
+            rehash_password(user, request.json["password"])
+        except HashingSaturatedError:
+            # The password was right, so let them in; we'll rehash it another time.
+            pass
     access_token = create_access_token(
         identity=request.json["username"], expires_delta=timedelta(days=1)
     )
@@ -40,6 +99,30 @@ def login():
     )
 
 
+def hashing_saturated(error: HashingSaturatedError):
+    """hashing_saturated handles HashingSaturatedError for every endpoint."""
+    response = make_response(
+        (
+            {
+                "success": False,
+                "message": "The server is busy, please try again shortly",
+            },
+            503,
+        )
+    )
+    response.headers["Retry-After"] = str(error.retry_after_seconds)
+    return response
+
+
+def add_query_count_header(response: Response) -> Response:
+    """add_query_count_header reports how many database queries served the request, for
+    load tests to check."""
+    count = query_count()
+    if count is not None:
+        response.headers["X-Query-Count"] = str(count)
+    return response
+
+
 def register():
     type_check_error = verify_request_fields({"username": str, "password": str})
     if type_check_error is not None:
@@ -97,9 +180,16 @@ def self_profile():
 
 @jwt_required(optional=True)
 def other_profile(profile_username):
-    # Check if the user exists
+    current_user = get_current_user()
+
     profile_user = get_user(profile_username)
-    if profile_user is None:
+    profile = (
+        get_profile(profile_username, recent_blooms=PROFILE_RECENT_BLOOMS)
+        if profile_user is not None
+        else None
+    )
+    # Check if the user exists
+    if profile is None:
         return make_response(
             jsonify(
                 {"success": False, "message": f"User {profile_username} not found"}
@@ -107,22 +197,30 @@ def other_profile(profile_username):
             404,
         )
 
-    current_user = get_current_user()
+    is_self = current_user is not None and current_user.id == profile_user.id
+    if current_user is None or is_self:
+        viewer_follows = False
+        followers_you_follow = []
+    else:
+        viewer_follows = is_following(current_user, profile_user)
+        followers_you_follow = get_followers_followed_by(
+            current_user, profile_user, PROFILE_MAX_FOLLOWS
+        )
 
-    followers = get_inverse_followed_usernames(profile_user)
-    all_blooms = blooms.get_blooms_for_user(profile_username)
-    all_blooms.reverse()
     return jsonify(
         {
             "username": profile_username,
-            "recent_blooms": all_blooms[:10],
-            "follows": get_followed_usernames(profile_user),
-            "followers": list(followers),
-            "is_following": current_user is not None
-            and current_user.username in followers,
-            "is_self": current_user is not None
-            and current_user.username == profile_username,
-            "total_blooms": len(all_blooms),
+            "recent_blooms": profile.recent_blooms,
+            "follows": get_followed_usernames(profile_user, PROFILE_MAX_FOLLOWS),
+            "followers": get_inverse_followed_usernames(
+                profile_user, PROFILE_MAX_FOLLOWS
+            ),
+            "following_count": profile.following_count,
+            "follower_count": profile.follower_count,
+            "is_following": viewer_follows,
+            "followers_you_follow": followers_you_follow,
+            "is_self": is_self,
+            "total_blooms": profile.total_blooms,
         }
     )
 
@@ -167,6 +265,45 @@ def send_bloom():
     )
 
 
+@jwt_required()
+def send_blooms_batch():
+    type_check_error = verify_request_fields({"blooms": list})
+    if type_check_error is not None:
+        return type_check_error
+
+    items = request.json["blooms"]
+    if len(items) > MAX_BLOOM_BATCH_SIZE:
+        return make_response(
+            (f"Cannot send more than {MAX_BLOOM_BATCH_SIZE} blooms at once", 400)
+        )
+
+    user = get_current_user()
+
+    # Validate each item separately, so one bad item doesn't reject the whole batch.
+    results = []
+    valid_contents = []
+    for item in items:
+        if not isinstance(item, dict) or type(item.get("content")) != str:
+            results.append({"error": "Bloom must be an object with a content string"})
+        else:
+            results.append(None)
+            valid_contents.append(item["content"])
+
+    sent = iter(blooms.add_blooms(sender=user, contents=valid_contents))
+    results = [
+        result if result is not None else {"id": str(next(sent).id)}
+        for result in results
+    ]
+
+    return jsonify(
+        {
+            "success": True,
+            "blooms": results,
+        }
+    )
+
+
+@cached(lambda id_str: ("bloom", id_str), immutable=True)
 def get_bloom(id_str):
     try:
         id_int = int(id_str)
@@ -175,41 +312,49 @@ def get_bloom(id_str):
     bloom = blooms.get_bloom(id_int)
     if bloom is None:
         return make_response((f"Bloom not found", 404))
-    return jsonify(bloom)
+    return conditional_response([bloom], lambda: jsonify(bloom))
 
 
 @jwt_required()
 def home_timeline():
     current_user = get_current_user()
 
-    # Get blooms from followed users
-    followed_users = get_followed_usernames(current_user)
-    nested_user_blooms = [
-        blooms.get_blooms_for_user(followed_user, limit=50)
-        for followed_user in followed_users
-    ]
-
-    # Flatten list of blooms from followed users
-    followed_blooms = [bloom for blooms in nested_user_blooms for bloom in blooms]
+    page_args = parse_page_args()
+    if isinstance(page_args, Response):
+        return page_args
 
-    # Get the current user's own blooms
-    own_blooms = blooms.get_blooms_for_user(current_user.username, limit=50)
-
-    # Combine own blooms with followed blooms
-    all_blooms = followed_blooms + own_blooms
-
-    # Sort by timestamp (newest first)
-    sorted_blooms = list(
-        sorted(all_blooms, key=lambda bloom: bloom.sent_timestamp, reverse=True)
+    # Own and followed users' blooms, newest first
+    page = blooms.get_home_timeline(
+        current_user, before=page_args.before, limit=page_args.limit + 1
     )
-
-    return jsonify(sorted_blooms)
+    # Following someone adds their older blooms.
+    return paginated_response(page, page_args.limit, append_only=False)
 
 
+# Tokens are checked, though not needed, so that people who have just sent a bloom read
+# it from the primary (see data.users.lookup_user).
+@jwt_required(optional=True)
+@cached(lambda profile_username: ("user", profile_username))
 def user_blooms(profile_username):
-    user_blooms = blooms.get_blooms_for_user(profile_username)
-    user_blooms.reverse()
-    return jsonify(user_blooms)
+    if is_stream_request():
+        page_args = parse_page_args(default_limit=None, max_limit=None)
+        if isinstance(page_args, Response):
+            return page_args
+        return stream_response(
+            blooms.stream_blooms_for_user(
+                profile_username, before=page_args.before, limit=page_args.limit
+            )
+        )
+
+    page_args = parse_page_args()
+    if isinstance(page_args, Response):
+        return page_args
+
+    # Newest first, like every list of blooms, so that the first page is the latest.
+    page = blooms.get_blooms_for_user(
+        profile_username, before=page_args.before, limit=page_args.limit + 1
+    )
+    return paginated_response(page, page_args.limit)
 
 
 @jwt_required()
@@ -228,8 +373,167 @@ def suggested_follows(limit_str):
     return jsonify(suggestions)
 
 
+@jwt_required(optional=True)
+@cached(lambda hashtag: ("hashtag", normalize_hashtag(hashtag)))
 def hashtag(hashtag):
-    return jsonify(blooms.get_blooms_with_hashtag(hashtag))
+    hashtag = normalize_hashtag(hashtag)
+    if is_stream_request():
+        page_args = parse_page_args(default_limit=None, max_limit=None)
+        if isinstance(page_args, Response):
+            return page_args
+        return stream_response(
+            blooms.stream_blooms_with_hashtag(
+                hashtag, before=page_args.before, limit=page_args.limit
+            )
+        )
+
+    page_args = parse_page_args()
+    if isinstance(page_args, Response):
+        return page_args
+
+    page = blooms.get_blooms_with_hashtag(
+        hashtag, before=page_args.before, limit=page_args.limit + 1
+    )
+    return paginated_response(page, page_args.limit)
+
+
+def trending():
+    window = request.args.get("window", DEFAULT_TRENDING_WINDOW)
+    if window not in TRENDING_WINDOWS:
+        return make_response(
+            (f"Window must be one of: {', '.join(TRENDING_WINDOWS)}", 400)
+        )
+    try:
+        limit = int(request.args.get("limit", DEFAULT_TRENDING_LIMIT))
+    except ValueError:
+        return make_response((f"Invalid limit", 400))
+    if limit < 1 or limit > MAX_TRENDING_HASHTAGS:
+        return make_response(
+            (f"Limit must be between 1 and {MAX_TRENDING_HASHTAGS}", 400)
+        )
+
+    response = jsonify(
+        {
+            "window": window,
+            "hashtags": [
+                {
+                    "hashtag": trend.hashtag,
+                    "score": trend.score,
+                    "count": trend.count,
+                    "expected": trend.expected,
+                }
+                for trend in get_trending(window, limit)
+            ],
+        }
+    )
+    set_cache_control(response, immutable=False)
+    return response
+
+
+def hashtag_suggestions():
+    prefix = normalize_hashtag(request.args.get("prefix", "").removeprefix("#"))
+    try:
+        limit = int(request.args.get("limit", DEFAULT_HASHTAG_SUGGESTIONS))
+    except ValueError:
+        return make_response((f"Invalid limit", 400))
+    if limit < 1 or limit > MAX_HASHTAG_SUGGESTIONS:
+        return make_response(
+            (f"Limit must be between 1 and {MAX_HASHTAG_SUGGESTIONS}", 400)
+        )
+
+    response = jsonify(
+        {
+            "prefix": prefix,
+            "hashtags": [
+                {"hashtag": hashtag, "count": count}
+                for hashtag, count in suggest_hashtags(prefix, limit)
+            ],
+        }
+    )
+    set_cache_control(response, immutable=False)
+    return response
+
+
+@jwt_required(optional=True)
+def search():
+    try:
+        tsquery = parse_search_query(request.args.get("q", ""))
+    except ValueError as error:
+        return make_response((str(error), 400))
+    sort = request.args.get("sort", SEARCH_SORT_RELEVANCE)
+    if sort not in SEARCH_SORTS:
+        return make_response((f"Sort must be one of: {', '.join(SEARCH_SORTS)}", 400))
+
+    page_args = parse_page_args()
+    if isinstance(page_args, Response):
+        return page_args
+
+    page = search_blooms(
+        tsquery,
+        author=request.args.get("author") or None,
+        sort=sort,
+        before=page_args.before,
+        limit=page_args.limit + 1,
+    )
+    if sort == SEARCH_SORT_RECENT:
+        response = paginated_response(page, page_args.limit)
+    else:
+        # The blooms aren't newest first, so they can't be validated by the newest one.
+        response = jsonify(page[: page_args.limit])
+        add_next_cursor(response, page, page_args.limit)
+    set_cache_control(response, immutable=False)
+    return response
+
+
+def parse_page_args(
+    *,
+    default_limit: Optional[int] = DEFAULT_PAGE_SIZE,
+    max_limit: Optional[int] = MAX_PAGE_SIZE,
+) -> Union[PageArgs, Response]:
+    """parse_page_args reads the ?before=<cursor>&limit=<n> pagination query parameters."""
+    before = None
+    before_str = request.args.get("before")
+    if before_str:
+        try:
+            before = blooms.decode_cursor(before_str)
+        except ValueError:
+            return make_response((f"Invalid cursor", 400))
+
+    limit_str = request.args.get("limit")
+    if limit_str is None:
+        limit = default_limit
+    else:
+        try:
+            limit = int(limit_str)
+        except ValueError:
+            return make_response((f"Invalid limit", 400))
+        if max_limit is None:
+            if limit < 1:
+                return make_response((f"Limit must be at least 1", 400))
+        elif limit < 1 or limit > max_limit:
+            return make_response((f"Limit must be between 1 and {max_limit}", 400))
+    return PageArgs(before=before, limit=limit)
+
+
+def paginated_response(
+    page: List[blooms.Bloom], limit: int, *, append_only: bool = True
+) -> Response:
+    """paginated_response returns the first limit blooms of page, which should have been
+    fetched with limit + 1 so we know whether there is a next page. append_only says
+    whether the list only ever gains newer blooms (see http_cache).
+
+    The cursor for the next page, if there is one, is sent in the X-Next-Cursor header.
+    """
+    response = conditional_response(
+        page[:limit], lambda: jsonify(page[:limit]), append_only=append_only
+    )
+    add_next_cursor(response, page, limit)
+    return response
+
+
+def add_next_cursor(response: Response, page: List[blooms.Bloom], limit: int) -> None:
+    if len(page) > limit:
+        response.headers["X-Next-Cursor"] = blooms.encode_cursor(page[limit - 1])
 
 
 def verify_request_fields(names_to_types: Dict[str, type]) -> Union[Response, None]:
@@ -245,3 +549,36 @@ def verify_request_fields(names_to_types: Dict[str, type]) -> Union[Response, No
                 )
             )
     return None
+
+
+def is_stream_request() -> bool:
+    return request.args.get("stream") == "1"
+
+
+def stream_response(bloom_iterator: Generator[blooms.Bloom, None, None]) -> Response:
+    """stream_response sends blooms as a JSON array as they are read from the database.
+
+    The response is sent chunked, without a length, ETag or next-page cursor, and is never
+    cached. The iterator only holds a database connection while it fetches each chunk, so
+    slow clients don't starve the pool.
+    """
+    json = current_app.json
+
+    def generate():
+        try:
+            yield "["
+            first = True
+            chunk = []
+            for bloom in bloom_iterator:
+                chunk.append(json.dumps(bloom, separators=(",", ":")))
+                if len(chunk) == STREAM_BLOOMS_PER_CHUNK:
+                    yield ("" if first else ",") + ",".join(chunk)
+                    first = False
+                    chunk = []
+            if chunk:
+                yield ("" if first else ",") + ",".join(chunk)
+            yield "]\n"
+        finally:
+            bloom_iterator.close()
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
@@ -0,0 +1,308 @@
+"""explain_check runs every query in the data layer against a large seeded dataset and
+fails if the planner chooses a sequential scan over any of the large tables.
+
+All seeded data is created inside one transaction which is rolled back at the end, so
+this is safe to run against a development database. It needs the migrations in
+../db/migrations to have been applied.
+"""
+
+import argparse
+from contextlib import contextmanager
+import json
+import sys
+from typing import Any, Dict, Iterator, List
+
+from dotenv import load_dotenv
+
+from data import (
+    blooms,
+    follows,
+    hashtags,
+    profiles,
+    search,
+    trending,
+    users,
+)
+from data.connection import connect
+
+DATA_MODULES = [blooms, follows, hashtags, profiles, search, trending, users]
+
+LARGE_TABLES = {
+    "blooms",
+    "follows",
+    "hashtag_counts",
+    "hashtag_dictionary",
+    "hashtags",
+    "timelines",
+    "users",
+}
+
+# Queries which are known to scan a large table, mapped to why that is tolerated.
+KNOWN_SEQ_SCANS = {
+    "reconcile_counters": "recomputes the counters of every user",
+    "load_trending": "re-ranking reads every count in the trend window and its baseline, "
+    "which is most of hashtag_counts, as older counts are deleted",
+    "load_suggestion_index": "loads the whole hashtag dictionary into memory",
+    "rebuild_hashtag_dictionary": "recounts every hashtag",
+    "recount_hashtags": "recounts the hashtags of the last eight days' blooms, which are "
+    "all of the seeded blooms",
+}
+
+SEED_SQL = """
+INSERT INTO users (username, password_salt, password_scrypt)
+SELECT 'explain-check-' || i, 'salt', 'scrypt' FROM generate_series(1, %(users)s) AS i;
+
+CREATE TEMPORARY TABLE explain_check_users ON COMMIT DROP AS
+SELECT id, row_number() OVER (ORDER BY id) - 1 AS n
+FROM users WHERE username LIKE 'explain-check-%%';
+
+CREATE TEMPORARY TABLE explain_check_blooms ON COMMIT DROP AS
+SELECT
+  (SELECT COALESCE(MAX(id), 0) FROM blooms) + i AS id,
+  i %% %(users)s AS sender_n,
+  i %% %(hashtags)s AS hashtag_n,
+  now()::timestamp - i * interval '1 second' AS send_timestamp
+FROM generate_series(1, %(blooms)s) AS i;
+
+INSERT INTO blooms (id, sender_id, content, send_timestamp)
+SELECT b.id, u.id, 'Explain check bloom #tag' || b.hashtag_n, b.send_timestamp
+FROM explain_check_blooms AS b INNER JOIN explain_check_users AS u ON u.n = b.sender_n;
+
+INSERT INTO hashtags (hashtag, bloom_id)
+SELECT 'tag' || hashtag_n, id FROM explain_check_blooms;
+
+INSERT INTO hashtag_counts (bucket_seconds, bucket_start, hashtag, count)
+SELECT
+  sizes.bucket_seconds,
+  date_bin(make_interval(secs => sizes.bucket_seconds), send_timestamp, TIMESTAMP '1970-01-01'),
+  'tag' || hashtag_n,
+  COUNT(*)
+FROM explain_check_blooms CROSS JOIN (VALUES (300), (3600)) AS sizes (bucket_seconds)
+GROUP BY 1, 2, 3
+ON CONFLICT (bucket_seconds, bucket_start, hashtag)
+DO UPDATE SET count = hashtag_counts.count + EXCLUDED.count;
+
+INSERT INTO hashtag_dictionary (hashtag, bloom_count)
+SELECT 'tag' || hashtag_n, COUNT(*) FROM explain_check_blooms GROUP BY hashtag_n
+ON CONFLICT (hashtag)
+DO UPDATE SET bloom_count = hashtag_dictionary.bloom_count + EXCLUDED.bloom_count;
+
+-- Make the trends stale, so that checking them re-ranks them.
+DELETE FROM trending_refreshes;
+
+INSERT INTO follows (follower, followee)
+SELECT follower.id, followee.id
+FROM generate_series(1, %(follows)s) AS i
+INNER JOIN explain_check_users AS follower ON follower.n = i %% %(users)s
+INNER JOIN explain_check_users AS followee ON followee.n = (i * 7919) %% %(users)s
+WHERE follower.id <> followee.id
+ON CONFLICT DO NOTHING;
+
+-- The rest joins the tables just filled, which needs up to date statistics to plan well.
+ANALYZE users, blooms, follows, hashtag_counts, hashtag_dictionary;
+
+INSERT INTO timelines (user_id, bloom_id, send_timestamp)
+SELECT sender_id, id, send_timestamp FROM blooms
+WHERE sender_id IN (SELECT id FROM explain_check_users)
+ON CONFLICT DO NOTHING;
+
+INSERT INTO timelines (user_id, bloom_id, send_timestamp)
+SELECT follows.follower, blooms.id, blooms.send_timestamp
+FROM follows INNER JOIN blooms ON blooms.sender_id = follows.followee
+WHERE follows.follower IN (SELECT id FROM explain_check_users)
+ON CONFLICT DO NOTHING;
+
+UPDATE users SET
+  follower_count = (SELECT COUNT(*) FROM follows WHERE followee = users.id),
+  following_count = (SELECT COUNT(*) FROM follows WHERE follower = users.id),
+  bloom_count = (SELECT COUNT(*) FROM blooms WHERE sender_id = users.id),
+  last_bloom_at = (SELECT MAX(send_timestamp) FROM blooms WHERE sender_id = users.id)
+WHERE id IN (SELECT id FROM explain_check_users);
+
+INSERT INTO follow_suggestions (user_id, suggested_user_id, score)
+SELECT follows.follower, followee_follows.followee, COUNT(*)
+FROM follows INNER JOIN follows AS followee_follows ON followee_follows.follower = follows.followee
+WHERE follows.follower IN (SELECT id FROM explain_check_users) AND follows.follower <> followee_follows.followee
+GROUP BY follows.follower, followee_follows.followee;
+
+ANALYZE;
+"""
+
+
+class ExplainingCursor:
+    """ExplainingCursor wraps a cursor, and EXPLAINs every statement before running it."""
+
+    def __init__(self, cur, plans: List[Dict[str, Any]], caller: List[str]):
+        self._cur = cur
+        self._plans = plans
+        self._caller = caller
+
+    def execute(self, sql, params=None):
+        statement = self._cur.mogrify(sql, params).decode("utf-8")
+        self._cur.execute("EXPLAIN (FORMAT JSON) " + statement)
+        plan = self._cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        self._plans.append(
+            {"function": self._caller[-1], "statement": statement, "plan": plan}
+        )
+        return self._cur.execute(sql, params)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+def seq_scanned_tables(plan_node: Dict[str, Any]) -> Iterator[str]:
+    if plan_node.get("Node Type") == "Seq Scan":
+        yield plan_node["Relation Name"]
+    for child in plan_node.get("Plans", []):
+        yield from seq_scanned_tables(child)
+
+
+def run_data_layer(caller: List[str]) -> None:
+    """run_data_layer calls every function in the data layer which runs a query."""
+
+    def call(function, *args, **kwargs):
+        caller.append(function.__name__)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            caller.pop()
+
+    def drain(function, *args, **kwargs):
+        # Generators only run their queries as they are iterated.
+        caller.append(function.__name__)
+        try:
+            return list(function(*args, **kwargs))
+        finally:
+            caller.pop()
+
+    user = call(users.get_user, "explain-check-1")
+    other_user = call(users.get_user, "explain-check-2")
+    call(users.get_suggested_follows, user, 3)
+    call(users.get_suggested_follows, other_user, 30)
+
+    call(users.register_user, "explain-check-registered", "password")
+    new_user = call(users.get_user, "explain-check-registered")
+    call(users.rehash_password, new_user, "password")
+    call(follows.follow, new_user, other_user)
+    call(follows.load_follow_set, follows.FOLLOWING, user.id)
+    call(follows.load_follow_set, follows.FOLLOWERS, user.id)
+    call(users.get_usernames, [user.id, other_user.id, new_user.id])
+
+    call(blooms.add_bloom, sender=user, content="Checking the plans #tag1")
+    page = call(blooms.get_blooms_for_user, user.username, limit=51)
+    call(
+        blooms.get_blooms_for_user,
+        user.username,
+        before=blooms.Cursor(page[-1].sent_timestamp, page[-1].id),
+        limit=51,
+    )
+    call(
+        profiles.get_profile,
+        user.username,
+        recent_blooms=10,
+    )
+    call(profiles.reconcile_counters)
+    call(blooms.get_home_timeline, user, limit=51)
+    call(
+        blooms.get_home_timeline,
+        user,
+        after=blooms.Cursor(page[-1].sent_timestamp, page[-1].id),
+        limit=101,
+    )
+    call(blooms.get_bloom, page[0].id)
+    call(blooms.get_blooms, [bloom.id for bloom in page[:10]])
+    call(blooms.get_blooms_with_hashtag, "tag1", limit=51)
+    drain(blooms.stream_blooms_for_user, user.username)
+    drain(blooms.stream_blooms_with_hashtag, "tag1")
+    for window_name in trending.WINDOWS:
+        call(trending.load_trending, window_name)
+    call(hashtags.load_suggestion_index)
+    with blooms.db_cursor() as cur:
+        call(
+            blooms.reindex_hashtags,
+            cur,
+            [(bloom.id, bloom.content.upper()) for bloom in page[:10]],
+        )
+    call(hashtags.rebuild_hashtag_dictionary)
+    call(trending.recount_hashtags)
+    # A word in every bloom, one in a few, and a phrase ending in a prefix.
+    for tsquery in ["'explain'", "'tag1'", "'check' <-> 'bloo':*"]:
+        for sort in search.SORTS:
+            page = call(search.search_blooms, tsquery, sort=sort, limit=51)
+            call(
+                search.search_blooms,
+                tsquery,
+                sort=sort,
+                before=blooms.Cursor(page[-1].sent_timestamp, page[-1].id),
+                limit=51,
+            )
+            call(
+                search.search_blooms,
+                tsquery,
+                author=user.username,
+                sort=sort,
+                limit=51,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--blooms", type=int, default=200_000)
+    parser.add_argument("--follows", type=int, default=100_000)
+    parser.add_argument("--hashtags", type=int, default=1_000)
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    conn = connect()
+    plans: List[Dict[str, Any]] = []
+    caller = ["seed"]
+    try:
+        with conn.cursor() as cur:
+            cur.execute(SEED_SQL, vars(args))
+
+        @contextmanager
+        def explaining_db_cursor(name=None, *, readonly=False):
+            # Server-side cursors can only run one statement, so explain on a client-side one.
+            with conn.cursor() as cur:
+                yield ExplainingCursor(cur, plans, caller)
+
+        for module in DATA_MODULES:
+            module.db_cursor = explaining_db_cursor
+
+        run_data_layer(caller)
+    finally:
+        conn.rollback()
+        conn.close()
+
+    failures = 0
+    for entry in plans:
+        scanned = LARGE_TABLES.intersection(
+            seq_scanned_tables(entry["plan"][0]["Plan"])
+        )
+        if not scanned:
+            continue
+        if entry["function"] in KNOWN_SEQ_SCANS:
+            print(
+                f"Known seq scan on {', '.join(sorted(scanned))} in {entry['function']}: {KNOWN_SEQ_SCANS[entry['function']]}"
+            )
+            continue
+        failures += 1
+        print(
+            f"Seq scan on {', '.join(sorted(scanned))} in {entry['function']}:\n{entry['statement']}\n",
+            file=sys.stderr,
+        )
+
+    print(f"Checked {len(plans)} statements, {failures} with unexpected seq scans")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
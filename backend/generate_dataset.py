@@ -0,0 +1,534 @@
+"""generate_dataset loads a large synthetic dataset straight into the database with COPY.
+
+populate.py makes a handful of users through the API, which is fine for clicking around
+but far too small (and slow) to reproduce performance problems. This generates a social
+graph shaped like a real one:
+  * follower counts follow a power law: a few users are followed by a large share of
+    everyone, most by hardly anyone,
+  * how often users post is also heavy-tailed: most users rarely post,
+  * hashtag popularity is Zipfian,
+  * posting times are bursty: users post in sessions of several blooms in quick
+    succession, more during the (UTC) day than at night, and many sessions cluster around
+    a few "events".
+
+The same --seed always generates the same dataset, apart from database ids, which follow
+whatever is already there, and timestamps, which end at the last UTC midnight.
+Rows are generated as they are streamed to COPY, so memory use depends on the number of
+users but not the number of blooms or follows.
+
+After loading, it fills in the tables the app derives from the data: counters,
+celebrities, timelines and follow suggestions.
+
+    python3 generate_dataset.py --users 1000000 --blooms 20000000 --seed 1
+"""
+
+import argparse
+from array import array
+import bisect
+from contextlib import contextmanager
+import datetime
+import functools
+import io
+import itertools
+import math
+import random
+import sys
+import tempfile
+import time
+from typing import Callable, Iterable, Iterator, List, Sequence, Tuple
+
+from dotenv import load_dotenv
+from psycopg2 import sql
+
+from data.blooms import extract_hashtags
+from data.connection import connect
+from data.ids import EPOCH_MS, SEQUENCE_BITS, WORKER_ID_BITS
+from data.timelines import FANOUT_MAX_FOLLOWERS
+from data.users import SCRYPT_PARAMS, generate_salt, scrypt
+from refresh_suggestions import refresh_all_suggestions
+
+# Bloom ids are made like data.ids does, from the bloom's timestamp, but with the user's
+# index in place of the worker id and sequence number. A user never sends two blooms in
+# the same millisecond, so ids are unique as long as there are at most this many users.
+MAX_USERS = 1 << (WORKER_ID_BITS + SEQUENCE_BITS)
+
+WORDS = """
+    the a my our this that today tonight just really so very new old big small good bad
+    great best worst first last love hate like want need think know feel see hear make
+    take give find tell ask work play run walk read write cook eat drink sleep dream
+    coffee tea pizza music song album film book game code bug test deploy release server
+    cat dog bird tree park beach city train bus bike rain sun snow weekend morning night
+    friend family team meeting project idea question answer news story photo video
+""".split()
+
+# How likely a bloom is to have 0, 1, 2 or 3 hashtags.
+HASHTAG_COUNT_CUM_WEIGHTS = list(itertools.accumulate([60, 25, 10, 5]))
+
+# Two letters each, so hashtag names made from them can't collide.
+SYLLABLES = [c + v for c in "bdfgklmnprstvz" for v in "aeiou"]
+
+
+class CopySource(io.TextIOBase):
+    """CopySource is a file-like object which reads lines from an iterator, so COPY can
+    stream rows as they are generated."""
+
+    def __init__(self, lines: Iterable[str]):
+        self._lines = iter(lines)
+        self._buffer = ""
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            chunk = "".join(itertools.islice(self._lines, 1000))
+            if not chunk:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        result, self._buffer = self._buffer[:size], self._buffer[size:]
+        return result
+
+
+def copy_line(values: Sequence) -> str:
+    """copy_line formats a row in COPY's text format."""
+    return "\t".join(copy_value(value) for value in values) + "\n"
+
+
+def copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_lines(cur, table: str, columns: List[str], lines: Iterable[str]) -> None:
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN", CopySource(lines)
+    )
+
+
+@contextmanager
+def foreign_keys_dropped(cur, tables: List[str]):
+    """foreign_keys_dropped drops the foreign keys on tables, and adds them back at the end.
+
+    Checking foreign keys row by row is most of the cost of bulk loading; adding them back
+    checks every row with one query instead. The tables are locked until the transaction
+    ends, so don't load data into a database which is serving requests.
+    """
+    cur.execute(
+        """SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE contype = 'f' AND conrelid = ANY(%s::regclass[])""",
+        (tables,),
+    )
+    constraints = cur.fetchall()
+    for table, name, _ in constraints:
+        cur.execute(
+            sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(
+                sql.Identifier(table), sql.Identifier(name)
+            )
+        )
+    yield
+    for table, name, definition in constraints:
+        cur.execute(
+            sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} ").format(
+                sql.Identifier(table), sql.Identifier(name)
+            )
+            + sql.SQL(definition)
+        )
+
+
+def zipf_cum_weights(rng: random.Random, count: int, exponent: float) -> array:
+    """zipf_cum_weights gives count items Zipfian weights (the item ranked k gets weight
+    1/k**exponent), in a random order, returned as cumulative weights for rng.choices.
+    """
+    ranks = array("l", range(1, count + 1))
+    rng.shuffle(ranks)
+    return array("d", itertools.accumulate(rank**-exponent for rank in ranks))
+
+
+def weighted_sample(
+    rng: random.Random, cum_weights: array, count: int
+) -> Iterator[int]:
+    """weighted_sample picks count indices, with replacement, according to cum_weights."""
+    total = cum_weights[-1]
+    last = len(cum_weights) - 1
+    for _ in range(count):
+        yield min(bisect.bisect(cum_weights, rng.random() * total), last)
+
+
+def hashtag_name(index: int) -> str:
+    syllables = []
+    while True:
+        index, digit = divmod(index, len(SYLLABLES))
+        syllables.append(SYLLABLES[digit])
+        if index == 0 and len(syllables) >= 2:
+            return "".join(syllables)
+
+
+class Generator:
+    """Generator generates rows for one dataset. Rows are generated lazily, and must be
+    consumed in order: users, follows, then blooms."""
+
+    def __init__(self, args: argparse.Namespace, *, first_user_id: int, end_ms: int):
+        self.args = args
+        self.first_user_id = first_user_id
+        self.end_ms = end_ms
+        self.start_ms = end_ms - args.days * 24 * 60 * 60 * 1000
+        rng = random.Random(args.seed)
+        self.rng = rng
+        self.popularity = zipf_cum_weights(rng, args.users, args.follow_exponent)
+        self.activity = zipf_cum_weights(rng, args.users, args.activity_exponent)
+        self.hashtag_popularity = zipf_cum_weights(
+            rng, args.hashtags, args.hashtag_exponent
+        )
+        self.events = sorted(
+            rng.uniform(self.start_ms, self.end_ms) for _ in range(args.events)
+        )
+
+    def user_id(self, index: int) -> int:
+        return self.first_user_id + index
+
+    def username(self, index: int) -> str:
+        return f"{self.args.username_prefix}{index}"
+
+    def users(self, password_salt: bytes, password_scrypt: bytes) -> Iterator[str]:
+        salt = "\\x" + password_salt.hex()
+        scrypt_hash = "\\x" + password_scrypt.hex()
+        for index in range(self.args.users):
+            yield copy_line(
+                (
+                    self.user_id(index),
+                    self.username(index),
+                    salt,
+                    scrypt_hash,
+                    SCRYPT_PARAMS.n,
+                    SCRYPT_PARAMS.r,
+                    SCRYPT_PARAMS.p,
+                )
+            )
+
+    def follows(self) -> Iterator[str]:
+        # How many users each user follows is log-normally distributed, and who they
+        # follow is picked by popularity, so follower counts follow a power law.
+        sigma = 1.0
+        mu = math.log(self.args.mean_follows) - sigma**2 / 2
+        max_follows = min(self.args.max_follows, self.args.users - 1)
+        for index in range(self.args.users):
+            count = min(int(self.rng.lognormvariate(mu, sigma)), max_follows)
+            followees = set()
+            # Popular users get picked repeatedly, so allow a few extra attempts.
+            for _ in range(4):
+                needed = count - len(followees)
+                if needed <= 0:
+                    break
+                followees.update(
+                    followee
+                    for followee in weighted_sample(self.rng, self.popularity, needed)
+                    if followee != index
+                )
+            for followee in sorted(followees)[:count]:
+                yield f"{self.user_id(index)}\t{self.user_id(followee)}\n"
+
+    def bloom_counts(self) -> Iterator[int]:
+        """bloom_counts yields how many blooms each user sends, adding up to about --blooms."""
+        total_weight = self.activity[-1]
+        previous = 0.0
+        for cumulative in self.activity:
+            expected = self.args.blooms * (cumulative - previous) / total_weight
+            previous = cumulative
+            count = int(expected)
+            if self.rng.random() < expected - count:
+                count += 1
+            yield count
+
+    def blooms(self, write_hashtag: Callable[[Tuple[str, int]], None]) -> Iterator[str]:
+        for index, count in enumerate(self.bloom_counts()):
+            if count == 0:
+                continue
+            sender_id = self.user_id(index)
+            for timestamp_ms in self.send_times(count):
+                bloom_id = (timestamp_ms - EPOCH_MS) << (
+                    WORKER_ID_BITS + SEQUENCE_BITS
+                ) | index
+                content = self.content()
+                for hashtag in set(extract_hashtags(content)):
+                    write_hashtag((hashtag, bloom_id))
+                yield f"{bloom_id}\t{sender_id}\t{copy_value(content)}\t{format_timestamp(timestamp_ms)}\n"
+
+    def send_times(self, count: int) -> List[int]:
+        """send_times returns count distinct, increasing millisecond timestamps, in bursty sessions."""
+        times = []
+        while len(times) < count:
+            session_size = min(count - len(times), 1 + int(self.rng.expovariate(1 / 2)))
+            t = self.session_start()
+            for _ in range(session_size):
+                times.append(int(t))
+                # Blooms in a session are usually a minute or two apart.
+                t += 1000 + self.rng.expovariate(1 / 90_000)
+        times.sort()
+        for i in range(1, len(times)):
+            if times[i] <= times[i - 1]:
+                times[i] = times[i - 1] + 1
+        return times
+
+    def session_start(self) -> float:
+        if self.events and self.rng.random() < self.args.event_share:
+            # Sessions around an event spread out over an hour or so after it.
+            event = self.rng.choice(self.events)
+            return min(event + self.rng.expovariate(1 / 1_800_000), self.end_ms)
+        while True:
+            t = self.rng.uniform(self.start_ms, self.end_ms)
+            hour = (t / 3_600_000) % 24
+            # Busiest in the afternoon, quietest before dawn.
+            if (
+                self.rng.random()
+                < (1 + 0.8 * math.sin((hour - 9) / 24 * 2 * math.pi)) / 1.8
+            ):
+                return t
+
+    def content(self) -> str:
+        words = self.rng.choices(WORDS, k=3 + int(self.rng.random() * 13))
+        hashtag_count = self.rng.choices(
+            range(4), cum_weights=HASHTAG_COUNT_CUM_WEIGHTS
+        )[0]
+        for hashtag in weighted_sample(
+            self.rng, self.hashtag_popularity, hashtag_count
+        ):
+            words.insert(self.rng.randint(0, len(words)), "#" + hashtag_name(hashtag))
+        return " ".join(words)
+
+
+@functools.lru_cache(maxsize=None)
+def format_date(day: int) -> str:
+    return (datetime.date(1970, 1, 1) + datetime.timedelta(days=day)).isoformat()
+
+
+def format_timestamp(timestamp_ms: int) -> str:
+    """format_timestamp formats a UTC timestamp; it's much quicker than strftime."""
+    day, ms = divmod(timestamp_ms, 24 * 60 * 60 * 1000)
+    seconds, ms = divmod(ms, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{format_date(day)} {hours:02}:{minutes:02}:{seconds:02}.{ms:03}"
+
+
+# The tables the generator loads, whose foreign keys are dropped while it does.
+LOADED_TABLES = ["follows", "blooms", "hashtags", "celebrities", "timelines"]
+
+# Fills in the data the app derives for the new users. Nothing can already exist for
+# them, so there's no need for ON CONFLICT.
+DERIVED_SQL = """
+UPDATE users SET follower_count = counts.count
+FROM (SELECT followee, COUNT(*) FROM follows WHERE followee >= %(first_user_id)s GROUP BY followee) AS counts
+WHERE users.id = counts.followee;
+
+UPDATE users SET following_count = counts.count
+FROM (SELECT follower, COUNT(*) FROM follows WHERE follower >= %(first_user_id)s GROUP BY follower) AS counts
+WHERE users.id = counts.follower;
+
+UPDATE users SET bloom_count = counts.count, last_bloom_at = counts.last_bloom_at
+FROM (
+  SELECT sender_id, COUNT(*), MAX(send_timestamp) AS last_bloom_at
+  FROM blooms WHERE sender_id >= %(first_user_id)s GROUP BY sender_id
+) AS counts
+WHERE users.id = counts.sender_id;
+
+INSERT INTO celebrities (user_id)
+SELECT id FROM users WHERE id >= %(first_user_id)s AND follower_count > %(fanout_max_followers)s;
+
+INSERT INTO timelines (user_id, bloom_id, send_timestamp)
+SELECT sender_id, id, send_timestamp FROM blooms WHERE sender_id >= %(first_user_id)s;
+
+INSERT INTO timelines (user_id, bloom_id, send_timestamp)
+SELECT follows.follower, blooms.id, blooms.send_timestamp
+FROM follows INNER JOIN blooms ON blooms.sender_id = follows.followee
+WHERE
+  follows.followee >= %(first_user_id)s
+  AND NOT EXISTS (SELECT 1 FROM celebrities WHERE user_id = follows.followee);
+
+-- The last eight days' hashtags, as far back as any trend window looks. Other users' blooms
+-- may already be counted in the same buckets.
+INSERT INTO hashtag_counts (bucket_seconds, bucket_start, hashtag, count)
+SELECT
+  sizes.bucket_seconds,
+  date_bin(make_interval(secs => sizes.bucket_seconds), blooms.send_timestamp, TIMESTAMP '1970-01-01'),
+  hashtags.hashtag,
+  COUNT(*)
+FROM hashtags
+INNER JOIN blooms ON blooms.id = hashtags.bloom_id
+CROSS JOIN (VALUES (300), (3600)) AS sizes (bucket_seconds)
+WHERE blooms.sender_id >= %(first_user_id)s AND blooms.send_timestamp >= now() - interval '8 days'
+GROUP BY 1, 2, 3
+ON CONFLICT (bucket_seconds, bucket_start, hashtag)
+DO UPDATE SET count = hashtag_counts.count + EXCLUDED.count;
+
+INSERT INTO hashtag_dictionary (hashtag, bloom_count)
+SELECT hashtags.hashtag, COUNT(*)
+FROM hashtags INNER JOIN blooms ON blooms.id = hashtags.bloom_id
+WHERE blooms.sender_id >= %(first_user_id)s
+GROUP BY hashtags.hashtag
+ON CONFLICT (hashtag)
+DO UPDATE SET bloom_count = hashtag_dictionary.bloom_count + EXCLUDED.bloom_count;
+"""
+
+
+_started = time.monotonic()
+
+
+def progress(message: str) -> None:
+    print(f"[{time.monotonic() - _started:7.1f}s] {message}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--blooms", type=int, default=1_000_000)
+    parser.add_argument("--mean-follows", type=float, default=20)
+    parser.add_argument("--max-follows", type=int, default=5000)
+    parser.add_argument("--hashtags", type=int, default=10_000)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument(
+        "--event-share",
+        type=float,
+        default=0.2,
+        help="The share of posting sessions which cluster around events.",
+    )
+    parser.add_argument("--follow-exponent", type=float, default=1.0)
+    parser.add_argument("--activity-exponent", type=float, default=0.8)
+    parser.add_argument("--hashtag-exponent", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--username-prefix", default="gen")
+    parser.add_argument(
+        "--password",
+        default="password",
+        help="Every generated user has this password.",
+    )
+    parser.add_argument(
+        "--skip-suggestions",
+        action="store_true",
+        help="Don't compute follow suggestions, which takes a while for many users.",
+    )
+    args = parser.parse_args()
+    if not 2 <= args.users <= MAX_USERS:
+        parser.error(f"--users must be between 2 and {MAX_USERS}")
+    if time.time() * 1000 - args.days * 24 * 60 * 60 * 1000 < EPOCH_MS:
+        parser.error("--days can't reach back before bloom ids' epoch (2024-01-01)")
+
+    load_dotenv()
+
+    # Every user shares one password hash; hashing millions of passwords would take hours.
+    password_salt = generate_salt()
+    password_scrypt = scrypt(
+        args.password.encode("utf-8"), password_salt, SCRYPT_PARAMS
+    )
+
+    conn = connect()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                first_user_id = load_dataset(
+                    cur,
+                    args,
+                    password_salt=password_salt,
+                    password_scrypt=password_scrypt,
+                )
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE")
+    finally:
+        conn.close()
+    progress("Analyzed")
+
+    if not args.skip_suggestions:
+        refresh_all_suggestions(after_user_id=first_user_id - 1)
+        progress("Computed follow suggestions")
+
+
+def load_dataset(
+    cur, args: argparse.Namespace, *, password_salt: bytes, password_scrypt: bytes
+) -> int:
+    """load_dataset generates and loads a dataset, and returns the first new user's id."""
+    cur.execute(
+        "SELECT 1 FROM users WHERE username = %s", (f"{args.username_prefix}0",)
+    )
+    if cur.fetchone() is not None:
+        raise SystemExit(
+            f"Users named {args.username_prefix}* already exist; pass a different --username-prefix."
+        )
+    cur.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM users")
+    first_user_id = cur.fetchone()[0]
+    # End at the last UTC midnight, so that the same seed gives the same dataset all day
+    # (and times of day line up from one day to the next).
+    day_ms = 24 * 60 * 60 * 1000
+    generator = Generator(
+        args,
+        first_user_id=first_user_id,
+        end_ms=time.time_ns() // 1_000_000 // day_ms * day_ms,
+    )
+
+    with foreign_keys_dropped(cur, LOADED_TABLES):
+        copy_lines(
+            cur,
+            "users",
+            [
+                "id",
+                "username",
+                "password_salt",
+                "password_scrypt",
+                "scrypt_n",
+                "scrypt_r",
+                "scrypt_p",
+            ],
+            generator.users(password_salt, password_scrypt),
+        )
+        cur.execute("SELECT setval('users_id_seq', (SELECT MAX(id) FROM users))")
+        progress(f"Loaded {args.users} users")
+
+        copy_lines(cur, "follows", ["follower", "followee"], generator.follows())
+        progress(f"Loaded {cur.rowcount} follows")
+
+        # COPY can only stream one table at a time, so hashtags are spooled to a
+        # temporary file while the blooms are loaded.
+        with tempfile.TemporaryFile("w+") as hashtags_file:
+
+            def write_hashtag(row: Tuple[str, int]) -> None:
+                hashtags_file.write(copy_line(row))
+
+            copy_lines(
+                cur,
+                "blooms",
+                ["id", "sender_id", "content", "send_timestamp"],
+                generator.blooms(write_hashtag),
+            )
+            progress(f"Loaded {cur.rowcount} blooms")
+            hashtags_file.seek(0)
+            cur.copy_expert(
+                "COPY hashtags (hashtag, bloom_id) FROM STDIN", hashtags_file
+            )
+            progress(f"Loaded {cur.rowcount} hashtags")
+
+        cur.execute(
+            DERIVED_SQL,
+            dict(
+                first_user_id=first_user_id,
+                fanout_max_followers=FANOUT_MAX_FOLLOWERS,
+            ),
+        )
+        progress("Computed counters, celebrities, timelines and hashtag counts")
+    progress("Checked foreign keys")
+    return first_user_id
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""A bounded pool of threads for password hashing.
+
+Hashing a password with scrypt is deliberately slow. Running it on request threads means a
+burst of logins (e.g. everyone logging back in after an outage) can tie up every request
+thread, so that nothing else gets served. Instead, hashes run on a small pool of threads
+(hashlib.scrypt releases the GIL, so they run in parallel), and when more than
+HASHING_MAX_QUEUE hashes are already waiting, new ones are refused straight away with
+HashingSaturatedError, which is served as 503 Service Unavailable with Retry-After.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import os
+import threading
+import time
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class HashingSaturatedError(Exception):
+    """HashingSaturatedError is raised when too many hashes are already waiting to run."""
+
+    def __init__(self, retry_after_seconds: int):
+        super().__init__("Too many password hashes are waiting to run")
+        self.retry_after_seconds = retry_after_seconds
+
+
+@dataclass
+class HashingStats:
+    completed: int
+    rejected: int
+    running: int
+    queued: int
+    workers: int
+    max_queue: int
+    queue_wait_seconds_total: float
+    queue_wait_seconds_max: float
+    hash_seconds_total: float
+    hash_seconds_max: float
+
+
+class HashingPool:
+    """HashingPool runs functions on up to workers threads, with at most max_queue more
+    waiting for a thread. It is thread-safe."""
+
+    def __init__(
+        self,
+        *,
+        workers: int,
+        max_queue: int,
+        retry_after_seconds: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        if max_queue < 0:
+            raise ValueError(f"max_queue must not be negative, got {max_queue}")
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retry_after_seconds = retry_after_seconds
+        self._clock = clock
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="hashing"
+        )
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._queue_wait_total = 0.0
+        self._queue_wait_max = 0.0
+        self._hash_total = 0.0
+        self._hash_max = 0.0
+
+    def run(self, function: Callable[..., T], *args) -> T:
+        """run calls function(*args) on the pool and returns its result, raising
+        HashingSaturatedError if the queue is full."""
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                self._rejected += 1
+                raise HashingSaturatedError(self.retry_after_seconds)
+            self._pending += 1
+        submitted_at = self._clock()
+        try:
+            return self._executor.submit(
+                self._timed, submitted_at, function, *args
+            ).result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _timed(self, submitted_at: float, function: Callable[..., T], *args) -> T:
+        started_at = self._clock()
+        with self._lock:
+            self._running += 1
+        try:
+            return function(*args)
+        finally:
+            finished_at = self._clock()
+            queue_wait = started_at - submitted_at
+            hash_time = finished_at - started_at
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+                self._queue_wait_total += queue_wait
+                self._queue_wait_max = max(self._queue_wait_max, queue_wait)
+                self._hash_total += hash_time
+                self._hash_max = max(self._hash_max, hash_time)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> HashingStats:
+        with self._lock:
+            return HashingStats(
+                completed=self._completed,
+                rejected=self._rejected,
+                running=self._running,
+                queued=self._pending - self._running,
+                workers=self.workers,
+                max_queue=self.max_queue,
+                queue_wait_seconds_total=self._queue_wait_total,
+                queue_wait_seconds_max=self._queue_wait_max,
+                hash_seconds_total=self._hash_total,
+                hash_seconds_max=self._hash_max,
+            )
+
+
+_pool: Optional[HashingPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_hashing_pool() -> HashingPool:
+    """get_hashing_pool returns the process-wide hashing pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = HashingPool(
+                    workers=int(os.getenv("HASHING_WORKERS", str(os.cpu_count() or 1))),
+                    max_queue=int(os.getenv("HASHING_MAX_QUEUE", "32")),
+                    retry_after_seconds=int(
+                        os.getenv("HASHING_RETRY_AFTER_SECONDS", "1")
+                    ),
+                )
+    return _pool
+
+
+def run_hash(function: Callable[..., T], *args) -> T:
+    return get_hashing_pool().run(function, *args)
+
+
+def hashing_stats() -> HashingStats:
+    return get_hashing_pool().stats()
+
+
+def _reset_after_fork() -> None:
+    # Threads don't survive a fork, so a forked child needs a pool of its own.
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
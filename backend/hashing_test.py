@@ -0,0 +1,53 @@
+import threading
+import unittest
+
+from hashing import HashingPool, HashingSaturatedError
+
+
+class TestHashingPool(unittest.TestCase):
+    def test_runs_functions(self):
+        pool = HashingPool(workers=2, max_queue=2, retry_after_seconds=1)
+        self.assertEqual(pool.run(pow, 2, 10), 1024)
+        stats = pool.stats()
+        self.assertEqual((stats.completed, stats.running, stats.queued), (1, 0, 0))
+        pool.shutdown()
+
+    def test_propagates_exceptions(self):
+        pool = HashingPool(workers=1, max_queue=0, retry_after_seconds=1)
+        with self.assertRaises(ZeroDivisionError):
+            pool.run(lambda: 1 / 0)
+        self.assertEqual(pool.stats().completed, 1)
+        pool.shutdown()
+
+    def test_rejects_when_queue_is_full(self):
+        pool = HashingPool(workers=1, max_queue=1, retry_after_seconds=7)
+        release = threading.Event()
+        started = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        threads = [threading.Thread(target=pool.run, args=(block,)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        started.wait()
+        while pool.stats().queued < 1:
+            pass
+
+        with self.assertRaises(HashingSaturatedError) as context:
+            pool.run(pow, 2, 2)
+        self.assertEqual(context.exception.retry_after_seconds, 7)
+
+        release.set()
+        for thread in threads:
+            thread.join()
+        stats = pool.stats()
+        self.assertEqual((stats.completed, stats.rejected), (2, 1))
+        self.assertGreater(stats.queue_wait_seconds_max, 0)
+        self.assertEqual(pool.run(pow, 2, 2), 4)
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,509 @@
+"""Pushing new blooms to home timelines as they are sent: GET /home/stream.
+
+Clients keep a Server-Sent Events stream open, and are sent each new bloom from themselves
+and the users they follow as a "bloom" event, instead of polling /home.
+
+Open streams cost little but a socket, so rather than tie up one of gunicorn's threads
+each, every worker serves them from an asyncio event loop on a thread of its own, on
+STREAM_PORT. The workers all listen on the port (with SO_REUSEPORT), and the kernel
+spreads connections between them. Only the request head is parsed here: the app checks
+the access token and adds the CORS headers, as it does for its own routes.
+
+add_blooms notifies BLOOMS_CHANNEL of new blooms' ids, so every worker's notifications
+listener hears about every bloom. It hands each message to the event loop, which looks up
+the sender's followers in the follow cache on a thread of its executor, and only if some
+of them (or the sender) have a stream open in this worker fetches the blooms, once for all
+of them.
+
+Event ids are cursors, so a client which reconnects with a Last-Event-ID header is sent
+the blooms it missed, from its home timeline, before any new ones. If it missed more than
+STREAM_MAX_REPLAY, it is sent a "reset" event instead, and should fetch /home afresh.
+
+Each stream has a queue of at most STREAM_MAX_QUEUED events waiting to be written; a
+client which falls that far behind is disconnected, to reconnect and catch up from the
+database. So are all clients whenever the notifications listener reconnects, as it may
+have missed blooms. Blooms sent together which don't fit in a stream's queue (as from
+/blooms/batch) are replaced by a reset event.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import logging
+import os
+import random
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from data import blooms, notifications
+from data.connection import read_from_primary
+from data.follows import FOLLOWERS, get_follow_set
+from data.users import User
+from flask import Flask, Response
+from flask_jwt_extended import get_current_user, verify_jwt_in_request
+
+logger = logging.getLogger(__name__)
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("STREAM_PORT", "3001"))
+# How many streams each worker may have open.
+MAX_CONNECTIONS = int(os.getenv("STREAM_MAX_CONNECTIONS", "10000"))
+HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+MAX_QUEUED = int(os.getenv("STREAM_MAX_QUEUED", "100"))
+MAX_REPLAY = int(os.getenv("STREAM_MAX_REPLAY", "100"))
+
+PATH = "/home/stream"
+# Requests are only a line and a few headers: longer ones are refused with a 431, and
+# those which take longer than REQUEST_TIMEOUT_SECONDS to arrive with a 408.
+MAX_REQUEST_BYTES = 8192
+REQUEST_TIMEOUT_SECONDS = 10.0
+# Clients are told to wait a random time in this range before reconnecting, so that they
+# don't all come back at once when a worker disconnects them.
+RETRY_MILLISECONDS = (1000, 10000)
+
+HEARTBEAT = b": heartbeat\n\n"
+
+
+@dataclass(frozen=True)
+class Request:
+    method: str
+    path: str
+    # By lower-case name.
+    headers: Dict[str, str]
+
+
+@dataclass
+class StreamStats:
+    connections: int
+    rejected: int
+    dropped: int
+    events: int
+
+
+class Subscriber:
+    """Subscriber is an open stream, and the events waiting to be written to it."""
+
+    def __init__(self, user_id: int, task: asyncio.Task):
+        self.user_id = user_id
+        self.task = task
+        # (bloom id, event) pairs.
+        self.events: asyncio.Queue[Tuple[int, bytes]] = asyncio.Queue(MAX_QUEUED)
+
+
+# New blooms' recipients, their (bloom id, event) pairs, and the reset event to send
+# recipients without room for them all instead.
+Delivery = Tuple[List[Subscriber], List[Tuple[int, bytes]], Tuple[int, bytes]]
+
+
+class Hub:
+    """Hub keeps track of a process's open streams, and hands new blooms to them.
+
+    Streams are added, removed and sent events on the event loop's thread, and recipients
+    are looked up on the executor's threads.
+    """
+
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self._lock = threading.Lock()
+        self._subscribers: Dict[int, List[Subscriber]] = {}
+        self._connections = 0
+        self._rejected = 0
+        self._dropped = 0
+        self._events = 0
+
+    def add(self, subscriber: Subscriber) -> bool:
+        """add starts sending events to subscriber, unless too many streams are open."""
+        with self._lock:
+            if self._connections >= self.max_connections:
+                self._rejected += 1
+                return False
+            self._subscribers.setdefault(subscriber.user_id, []).append(subscriber)
+            self._connections += 1
+            return True
+
+    def remove(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user_id, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+                self._connections -= 1
+                if not subscribers:
+                    del self._subscribers[subscriber.user_id]
+
+    def recipients(self, sender_id: int) -> List[Subscriber]:
+        """recipients returns the streams of sender_id and their followers."""
+        if not self._subscribers:
+            return []
+        followers = get_follow_set(FOLLOWERS, sender_id)
+        with self._lock:
+            # Check whichever is fewer: the followers, or the users with streams.
+            if len(followers) < len(self._subscribers):
+                user_ids: List[int] = [
+                    id for id in followers if id in self._subscribers
+                ]
+            else:
+                user_ids = [id for id in self._subscribers if id in followers]
+            user_ids.append(sender_id)
+            return [
+                subscriber
+                for user_id in user_ids
+                for subscriber in self._subscribers.get(user_id, [])
+            ]
+
+    def deliver(
+        self,
+        recipients: List[Subscriber],
+        events: List[Tuple[int, bytes]],
+        reset: Tuple[int, bytes],
+    ) -> None:
+        """deliver queues events for recipients. Recipients whose queue is already full are
+        disconnected, and those without room for all the events are sent reset instead
+        of them and anything else waiting."""
+        for subscriber in recipients:
+            queue = subscriber.events
+            if queue.full():
+                self._dropped += 1
+                subscriber.task.cancel()
+            elif queue.maxsize - queue.qsize() < len(events):
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(reset)
+                self._events += 1
+            else:
+                for event in events:
+                    queue.put_nowait(event)
+                self._events += len(events)
+
+    def disconnect_all(self) -> None:
+        with self._lock:
+            subscribers = [s for ss in self._subscribers.values() for s in ss]
+        for subscriber in subscribers:
+            subscriber.task.cancel()
+
+    def stats(self) -> StreamStats:
+        return StreamStats(
+            connections=self._connections,
+            rejected=self._rejected,
+            dropped=self._dropped,
+            events=self._events,
+        )
+
+
+_hub = Hub(MAX_CONNECTIONS)
+# Runs streams' queries. Replays must include blooms sent just before the stream opened,
+# and new blooms must be found as soon as they are sent, which replicas may not have yet,
+# so they read from the primary.
+_executor = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="home-stream", initializer=read_from_primary
+)
+# The running event loop, and the app which authenticates requests; None until start.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_app: Optional[Flask] = None
+# Delivers the last blooms message heard, after those before it; used on the event loop.
+_last_delivery: Optional[asyncio.Task] = None
+
+
+def stream_stats() -> StreamStats:
+    return _hub.stats()
+
+
+def start(app: Flask) -> None:
+    """start serves streams on STREAM_PORT from a thread of its own. It must be called after
+    forking, as threads don't survive it."""
+    global _app
+    _app = app
+    notifications.subscribe(
+        blooms.BLOOMS_CHANNEL,
+        on_message=_on_blooms_message,
+        on_reset=_on_blooms_reset,
+    )
+    # Start listening now, rather than when the first stream opens.
+    notifications.is_listening(blooms.BLOOMS_CHANNEL)
+    threading.Thread(target=_serve_forever, name="home-stream", daemon=True).start()
+
+
+def _serve_forever() -> None:
+    global _loop
+    loop = asyncio.new_event_loop()
+
+    async def serve():
+        server = await start_server(HOST, PORT, reuse_port=True, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    _loop = loop
+    try:
+        loop.run_until_complete(serve())
+    except Exception:
+        logger.exception("Stopped serving streams on port %d", PORT)
+
+
+def _on_blooms_message(payload: str) -> None:
+    loop = _loop
+    if loop is None:
+        return
+    sender_id, *bloom_ids = map(int, payload.split())
+    # Looking up the recipients and blooms queries the database, which would hold up the
+    # notifications listener, and every other channel's messages with it.
+    loop.call_soon_threadsafe(_fetch_and_deliver, sender_id, bloom_ids)
+
+
+def _fetch_and_deliver(sender_id: int, bloom_ids: List[int]) -> None:
+    """_fetch_and_deliver fetches new blooms on the executor, and delivers them to their
+    recipients' streams. It runs on the event loop. Messages are fetched at the same time,
+    but delivered in the order they arrived."""
+    global _last_delivery
+    fetch = asyncio.get_running_loop().run_in_executor(
+        _executor, _fetch_delivery, sender_id, bloom_ids
+    )
+    _last_delivery = asyncio.create_task(_deliver_after(_last_delivery, fetch))
+
+
+def _fetch_delivery(sender_id: int, bloom_ids: List[int]) -> Optional[Delivery]:
+    recipients = _hub.recipients(sender_id)
+    if not recipients:
+        return None
+    new_blooms = blooms.get_blooms(bloom_ids)
+    if not new_blooms:
+        return None
+    events = [(bloom.id, bloom_event(bloom)) for bloom in new_blooms]
+    reset = (new_blooms[-1].id, reset_event(new_blooms[-1]))
+    return recipients, events, reset
+
+
+async def _deliver_after(
+    previous: Optional[asyncio.Task], fetch: "asyncio.Future[Optional[Delivery]]"
+) -> None:
+    if previous is not None:
+        await asyncio.wait([previous])
+    try:
+        delivery = await fetch
+    except Exception:
+        logger.exception("Couldn't fetch new blooms for streams")
+        return
+    if delivery is not None:
+        _hub.deliver(*delivery)
+
+
+def _on_blooms_reset() -> None:
+    loop = _loop
+    if loop is not None:
+        loop.call_soon_threadsafe(_hub.disconnect_all)
+
+
+def bloom_event(bloom: blooms.Bloom) -> bytes:
+    return format_event("bloom", _app.json.dumps(bloom), id=blooms.encode_cursor(bloom))
+
+
+def reset_event(newest: blooms.Bloom) -> bytes:
+    """reset_event tells the client to fetch its timeline afresh, and resume from newest."""
+    return format_event("reset", "{}", id=blooms.encode_cursor(newest))
+
+
+def format_event(event: str, data: str, *, id: Optional[str] = None) -> bytes:
+    """format_event returns a Server-Sent Event."""
+    lines = [] if id is None else [f"id: {id}"]
+    lines.append(f"event: {event}")
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+def parse_request(head: bytes) -> Request:
+    """parse_request parses an HTTP request's line and headers, raising ValueError if they
+    are invalid."""
+    try:
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, version = lines[0].split(" ")
+    except ValueError:
+        raise ValueError("Invalid request line")
+    if not version.startswith("HTTP/1."):
+        raise ValueError(f"Unsupported version: {version}")
+    if not method.isalpha() or not target.startswith("/"):
+        raise ValueError("Invalid request line")
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, separator, value = line.partition(":")
+        # Lines starting with whitespace continue the header before them, which HTTP/1.1
+        # no longer allows.
+        if not separator or not name or name != name.strip():
+            raise ValueError(f"Invalid header: {line}")
+        headers[name.lower()] = value.strip()
+    return Request(method=method, path=target.split("?")[0], headers=headers)
+
+
+def format_response(
+    status: str, headers: Iterable[Tuple[str, str]], body: bytes
+) -> bytes:
+    """format_response returns an HTTP response's head, followed by body."""
+    lines = [f"HTTP/1.1 {status}", "Connection: close"]
+    lines.extend(f"{name}: {value}" for name, value in headers)
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+
+def format_error(status: str, message: str) -> bytes:
+    """format_error returns a response to a request too broken to hand to the app."""
+    body = message.encode("utf-8")
+    return format_response(
+        status,
+        [
+            ("Content-Type", "text/plain; charset=utf-8"),
+            ("Content-Length", str(len(body))),
+        ],
+        body,
+    )
+
+
+def check_request(
+    request: Request,
+) -> Tuple[Response, Optional[User], Optional[blooms.Cursor]]:
+    """check_request answers request as the app answers its own: the app checks its access
+    token (with its user lookup and error responses) and adds its CORS headers. It returns
+    the response, and if it opens a stream, whose stream it is and where to replay it from.
+
+    It may query the database, so is run on the executor."""
+    user = after = None
+    with _app.test_request_context(
+        request.path, method=request.method, headers=request.headers
+    ):
+        if request.path != PATH:
+            response = _app.make_response(("Not found", 404))
+        elif request.method == "OPTIONS":
+            response = _app.make_response(("", 204, {"Allow": "GET, OPTIONS"}))
+        elif request.method != "GET":
+            response = _app.make_response(
+                ("Method not allowed", 405, {"Allow": "GET, OPTIONS"})
+            )
+        else:
+            response, user, after = _check_stream_request(request)
+        return _app.process_response(response), user, after
+
+
+def _check_stream_request(
+    request: Request,
+) -> Tuple[Response, Optional[User], Optional[blooms.Cursor]]:
+    last_event_id = request.headers.get("last-event-id")
+    try:
+        after = blooms.decode_cursor(last_event_id) if last_event_id else None
+    except ValueError as error:
+        return _app.make_response((str(error), 400)), None, None
+    try:
+        verify_jwt_in_request()
+        user = get_current_user()
+    except Exception as error:
+        # Raises again unless the app handles it (as it does bad tokens).
+        return _app.make_response(_app.handle_user_exception(error)), None, None
+    response = Response(
+        status=200,
+        headers={
+            "Cache-Control": "no-store",
+            # Stop proxies buffering events.
+            "X-Accel-Buffering": "no",
+        },
+        content_type="text/event-stream",
+    )
+    return response, user, after
+
+
+def too_many_streams(request: Request) -> Response:
+    with _app.test_request_context(
+        request.path, method=request.method, headers=request.headers
+    ):
+        return _app.process_response(
+            _app.make_response(("Too many streams", 503, {"Retry-After": "10"}))
+        )
+
+
+async def start_server(host: str, port: int, **kwargs) -> asyncio.Server:
+    """start_server serves streams on host and port."""
+    return await asyncio.start_server(
+        _handle, host, port, limit=MAX_REQUEST_BYTES, **kwargs
+    )
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        try:
+            async with asyncio.timeout(REQUEST_TIMEOUT_SECONDS):
+                head = await reader.readuntil(b"\r\n\r\n")
+        except TimeoutError:
+            writer.write(format_error("408 Request Timeout", "Request timed out"))
+            return
+        except asyncio.LimitOverrunError:
+            writer.write(
+                format_error("431 Request Header Fields Too Large", "Request too large")
+            )
+            return
+        try:
+            request = parse_request(head)
+        except ValueError as error:
+            writer.write(format_error("400 Bad Request", str(error)))
+        else:
+            await _respond(request, writer)
+    except (asyncio.IncompleteReadError, ConnectionError, TimeoutError):
+        pass
+    except asyncio.CancelledError:
+        # The hub disconnected the stream.
+        pass
+    except Exception:
+        logger.exception("Stream failed")
+    finally:
+        writer.close()
+
+
+async def _respond(request: Request, writer: asyncio.StreamWriter) -> None:
+    loop = asyncio.get_running_loop()
+    response, user, after = await loop.run_in_executor(
+        _executor, check_request, request
+    )
+    subscriber = None
+    if user is not None:
+        subscriber = Subscriber(user.id, asyncio.current_task())
+        if not _hub.add(subscriber):
+            subscriber = None
+            response = await loop.run_in_executor(_executor, too_many_streams, request)
+    if subscriber is None:
+        writer.write(
+            format_response(
+                response.status, response.headers.items(), response.get_data()
+            )
+        )
+        return
+    try:
+        # The response has no length: the events follow, until the connection is closed.
+        writer.write(
+            format_response(response.status, response.headers.items(), b"")
+            + f"retry: {random.randint(*RETRY_MILLISECONDS)}\n\n".encode("ascii")
+        )
+        # Events for new blooms are already being queued, so they may include some of the
+        # blooms replayed.
+        replayed: Set[int] = set()
+        if after is not None:
+            missed = await loop.run_in_executor(
+                _executor,
+                lambda: blooms.get_home_timeline(
+                    user, after=after, limit=MAX_REPLAY + 1
+                ),
+            )
+            if len(missed) > MAX_REPLAY:
+                writer.write(reset_event(missed[0]))
+            else:
+                for bloom in reversed(missed):
+                    writer.write(bloom_event(bloom))
+                    replayed.add(bloom.id)
+        await writer.drain()
+
+        while True:
+            try:
+                async with asyncio.timeout(HEARTBEAT_SECONDS):
+                    bloom_id, event = await subscriber.events.get()
+            except TimeoutError:
+                event = HEARTBEAT
+            else:
+                if bloom_id in replayed:
+                    continue
+            writer.write(event)
+            await writer.drain()
+    finally:
+        _hub.remove(subscriber)
@@ -0,0 +1,266 @@
+import asyncio
+import datetime
+import threading
+import unittest
+from unittest import mock
+
+import home_stream
+from data.blooms import Bloom
+from data.users import User
+from flask import Flask
+from flask_cors import CORS
+from flask_jwt_extended import JWTManager, create_access_token
+from home_stream import (
+    MAX_REQUEST_BYTES,
+    Hub,
+    Subscriber,
+    format_event,
+    format_response,
+    parse_request,
+    start_server,
+)
+from id_set import IdSet
+
+
+class TestHomeStream(unittest.TestCase):
+    def test_parse_request(self):
+        request = parse_request(
+            b"GET /home/stream?x=1 HTTP/1.1\r\nHost: localhost\r\nLast-Event-ID:  abc \r\n\r\n"
+        )
+        self.assertEqual(request.method, "GET")
+        self.assertEqual(request.path, "/home/stream")
+        self.assertEqual(request.headers, {"host": "localhost", "last-event-id": "abc"})
+        for head in [
+            b"GET /home/stream\r\n\r\n",
+            b"GET /home/stream SPDY/3\r\n\r\n",
+            b"GET /home/stream HTTP/1.1\r\nNo colon\r\n\r\n",
+            b"GET home/stream HTTP/1.1\r\n\r\n",
+            b"GET  /home/stream HTTP/1.1\r\n\r\n",
+            b"GET /home/stream HTTP/1.1\r\nA: b\r\n folded\r\n\r\n",
+            b"GET /home/stream HTTP/1.1\r\nA : b\r\n\r\n",
+            b"\xff\xfe\r\n\r\n",
+        ]:
+            with self.subTest(head=head):
+                self.assertRaises(ValueError, parse_request, head)
+
+    def test_format(self):
+        self.assertEqual(
+            format_event("bloom", '{"a": 1}', id="cursor"),
+            b'id: cursor\nevent: bloom\ndata: {"a": 1}\n\n',
+        )
+        self.assertEqual(
+            format_event("note", "two\nlines"),
+            b"event: note\ndata: two\ndata: lines\n\n",
+        )
+        self.assertEqual(
+            format_response("404 Not Found", [("A", "b"), ("A", "c")], b"Nope"),
+            b"HTTP/1.1 404 Not Found\r\nConnection: close\r\nA: b\r\nA: c\r\n\r\nNope",
+        )
+
+    def test_recipients(self):
+        hub = Hub(max_connections=10)
+        subscribers = {
+            user_id: Subscriber(user_id, mock.Mock()) for user_id in [1, 2, 3, 4]
+        }
+        for subscriber in subscribers.values():
+            self.assertTrue(hub.add(subscriber))
+        second_tab = Subscriber(2, mock.Mock())
+        hub.add(second_tab)
+        hub.remove(subscribers[4])
+
+        # Both with fewer followers than streams, and more.
+        for followers in [IdSet.of([2, 5]), IdSet.of(range(2, 100))]:
+            with self.subTest(followers=followers), mock.patch(
+                "home_stream.get_follow_set", return_value=followers
+            ):
+                recipients = hub.recipients(1)
+                self.assertCountEqual(
+                    recipients,
+                    [subscribers[1], subscribers[2], second_tab]
+                    + ([subscribers[3]] if 3 in followers else []),
+                )
+
+    def test_limits(self):
+        hub = Hub(max_connections=2)
+        slow, fast = Subscriber(1, mock.Mock()), Subscriber(2, mock.Mock())
+        self.assertTrue(hub.add(slow))
+        self.assertTrue(hub.add(fast))
+        self.assertFalse(hub.add(Subscriber(3, mock.Mock())))
+
+        reset = (0, b"reset")
+        # The slow subscriber has room for one more event, not two.
+        hub.deliver([slow], [(1, b"event")] * (slow.events.maxsize - 1), reset)
+        hub.deliver([slow, fast], [(2, b"event"), (3, b"event")], reset)
+        self.assertEqual(slow.events.qsize(), 1)
+        self.assertEqual(slow.events.get_nowait(), reset)
+        self.assertEqual(fast.events.qsize(), 2)
+
+        # Once it has a full queue waiting, it is disconnected.
+        hub.deliver([slow], [(4, b"event")] * slow.events.maxsize, reset)
+        hub.deliver([slow, fast], [(5, b"event")], reset)
+        slow.task.cancel.assert_called_once()
+        fast.task.cancel.assert_not_called()
+        self.assertEqual(fast.events.qsize(), 3)
+
+        stats = hub.stats()
+        self.assertEqual((stats.connections, stats.rejected, stats.dropped), (2, 1, 1))
+
+
+class TestDelivery(unittest.IsolatedAsyncioTestCase):
+    async def test_delivers_in_order_off_the_listener_thread(self):
+        hub = Hub(max_connections=10)
+        subscriber = Subscriber(1, mock.Mock())
+        hub.add(subscriber)
+        second_fetched = threading.Event()
+
+        def get_blooms(bloom_ids):
+            # The first message's blooms take longer to fetch than the second's.
+            if bloom_ids == [1]:
+                self.assertTrue(second_fetched.wait(5))
+            else:
+                second_fetched.set()
+            return [
+                Bloom(bloom_id, "sample", "Hi", datetime.datetime(2020, 3, 4))
+                for bloom_id in bloom_ids
+            ]
+
+        with mock.patch.multiple(
+            home_stream,
+            _hub=hub,
+            _loop=asyncio.get_running_loop(),
+            _last_delivery=None,
+            get_follow_set=mock.Mock(return_value=IdSet.of([])),
+            bloom_event=lambda bloom: b"bloom",
+            reset_event=lambda bloom: b"reset",
+        ), mock.patch("data.blooms.get_blooms", get_blooms):
+            # Were the first message fetched on the listener's thread, the second would
+            # never arrive.
+            home_stream._on_blooms_message("1 1")
+            home_stream._on_blooms_message("1 2")
+            delivered = [
+                await asyncio.wait_for(subscriber.events.get(), 5) for _ in range(2)
+            ]
+        self.assertEqual(delivered, [(1, b"bloom"), (2, b"bloom")])
+
+
+class TestServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        app = Flask("Dummy")
+        app.config["JWT_SECRET_KEY"] = "secret for tests, at least 32 bytes long"
+        jwt = JWTManager(app)
+        jwt.user_lookup_loader(
+            lambda header, payload: User(7, payload["sub"], b"", b"", None)
+        )
+        CORS(
+            app,
+            resources={r"/*": {"origins": "*", "allow_headers": ["Authorization"]}},
+        )
+        with app.app_context():
+            self.token = create_access_token(identity="sample")
+        patcher = mock.patch.multiple(
+            home_stream,
+            _app=app,
+            _hub=Hub(max_connections=1),
+            REQUEST_TIMEOUT_SECONDS=0.2,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = await start_server("127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+
+    async def send(self, head: bytes) -> bytes:
+        """send sends head, and returns the response up to the connection closing."""
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(head)
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        return response
+
+    def stream_request(self, *headers: str) -> bytes:
+        lines = ["GET /home/stream HTTP/1.1", "Host: localhost", *headers]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def test_malformed_request(self):
+        response = await self.send(b"GET /home/stream\r\n\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.1 400 Bad Request\r\n"))
+
+    async def test_oversized_headers(self):
+        response = await self.send(
+            self.stream_request("X-Padding: " + "a" * MAX_REQUEST_BYTES)
+        )
+        self.assertTrue(
+            response.startswith(b"HTTP/1.1 431 Request Header Fields Too Large\r\n")
+        )
+
+    async def test_slow_request_head(self):
+        response = await self.send(b"GET /home/stream HTTP/1.1\r\nHost: loc")
+        self.assertTrue(response.startswith(b"HTTP/1.1 408 Request Timeout\r\n"))
+
+    async def test_answered_by_the_app(self):
+        origin = "Origin: https://purpleforest.example"
+        for head, status, expected_header in [
+            (
+                self.stream_request(origin),
+                b"401 UNAUTHORIZED",
+                b"Access-Control-Allow-Origin: https://purpleforest.example",
+            ),
+            (
+                self.stream_request(origin, "Authorization: Bearer nonsense"),
+                b"422 UNPROCESSABLE ENTITY",
+                b"Access-Control-Allow-Origin: https://purpleforest.example",
+            ),
+            (
+                b"OPTIONS /home/stream HTTP/1.1\r\n"
+                + f"{origin}\r\n".encode("ascii")
+                + b"Access-Control-Request-Method: GET\r\n"
+                + b"Access-Control-Request-Headers: authorization\r\n\r\n",
+                b"204 NO CONTENT",
+                b"Access-Control-Allow-Headers: authorization",
+            ),
+            (
+                self.stream_request(
+                    f"Authorization: Bearer {self.token}", "Last-Event-ID: x"
+                ),
+                b"400 BAD REQUEST",
+                b"Content-Type: text/html; charset=utf-8",
+            ),
+            (
+                b"GET /elsewhere HTTP/1.1\r\n\r\n",
+                b"404 NOT FOUND",
+                b"Content-Length: 9",
+            ),
+            (
+                b"POST /home/stream HTTP/1.1\r\n\r\n",
+                b"405 METHOD NOT ALLOWED",
+                b"Allow: GET, OPTIONS",
+            ),
+        ]:
+            with self.subTest(head=head):
+                response_head = (await self.send(head)).split(b"\r\n\r\n")[0]
+                self.assertTrue(
+                    response_head.startswith(b"HTTP/1.1 " + status + b"\r\n")
+                )
+                self.assertIn(expected_header, response_head)
+
+    async def test_opens_streams_up_to_the_limit(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(self.stream_request(f"Authorization: Bearer {self.token}"))
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertIn(b"Content-Type: text/event-stream", head)
+        self.assertNotIn(b"Content-Length", head)
+        self.assertTrue((await reader.readline()).startswith(b"retry: "))
+
+        response = await self.send(
+            self.stream_request(f"Authorization: Bearer {self.token}")
+        )
+        self.assertTrue(response.startswith(b"HTTP/1.1 503 SERVICE UNAVAILABLE\r\n"))
+        self.assertIn(b"Retry-After: 10", response)
+        writer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
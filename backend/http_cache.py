@@ -0,0 +1,177 @@
+"""HTTP caching for the public, read-only bloom endpoints.
+
+Blooms never change once they are sent, so a list of blooms is identified by the blooms on
+it: responses carry an ETag made from their ids, and requests whose If-None-Match matches
+get a 304 Not Modified without a body. (Not just the newest bloom's: following someone
+adds their older blooms to /home under the same newest bloom.)
+
+Lists which only ever gain newer blooms also carry a Last-Modified, for clients which only
+send If-Modified-Since; If-None-Match takes precedence over it. HTTP dates only have whole
+seconds, and more blooms may be sent in the same second as the newest, so Last-Modified is
+the end of the newest bloom's second, and is only sent once that has passed.
+
+Responses are also kept in an in-process LRU cache, tagged with the sender or hashtag
+they list, which add_blooms invalidates when a new bloom is sent. Other worker processes
+don't see the invalidation, so entries also expire after HTTP_CACHE_TTL_SECONDS.
+
+Reads from replicas may not show a new bloom yet, so for READ_YOUR_WRITES_SECONDS after a
+tag is invalidated, responses read from a replica aren't cached under it, and requests
+which must read from the primary (see data.recent_writers) skip the cache altogether.
+"""
+
+import datetime
+import functools
+import hashlib
+import os
+from dataclasses import dataclass
+from typing import Callable, Hashable, List, Optional, Tuple
+
+from cache import MISSING, CacheStats, LRUCache
+from data.blooms import Bloom, extract_hashtags
+from data.connection import reading_from_primary, used_replica
+from data.recent_writers import WINDOW_SECONDS
+from flask import Response, make_response, request
+
+FEED_MAX_AGE_SECONDS = int(os.getenv("HTTP_CACHE_FEED_MAX_AGE_SECONDS", "10"))
+IMMUTABLE_MAX_AGE_SECONDS = 365 * 24 * 60 * 60
+
+_response_cache = LRUCache(
+    int(os.getenv("HTTP_CACHE_MAX_SIZE", "1000")),
+    ttl=float(os.getenv("HTTP_CACHE_TTL_SECONDS", "10")),
+)
+# The tags invalidated in the last READ_YOUR_WRITES_SECONDS.
+_recently_invalidated = LRUCache(_response_cache.max_size, ttl=WINDOW_SECONDS)
+
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    headers: List[Tuple[str, str]]
+    etag: str
+    last_modified: Optional[datetime.datetime]
+
+
+def bloom_etag(blooms: List[Bloom]) -> str:
+    """bloom_etag returns the ETag for a list of blooms, which changes if any of them do."""
+    ids = ",".join([str(bloom.id) for bloom in blooms])
+    return hashlib.blake2b(ids.encode("ascii"), digest_size=16).hexdigest()
+
+
+def bloom_last_modified(newest_first: List[Bloom]) -> Optional[datetime.datetime]:
+    """bloom_last_modified returns the Last-Modified for a newest-first list of blooms which
+    only ever gains newer blooms, or None if it can't have one yet."""
+    if not newest_first:
+        return None
+    sent = newest_first[0].sent_timestamp
+    if sent.tzinfo is None:
+        # Timestamps are stored in UTC without a time zone.
+        sent = sent.replace(tzinfo=datetime.UTC)
+    end_of_second = sent.replace(microsecond=0) + datetime.timedelta(seconds=1)
+    if end_of_second > datetime.datetime.now(datetime.UTC):
+        return None
+    return end_of_second
+
+
+def is_not_modified(etag: str, last_modified: Optional[datetime.datetime]) -> bool:
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since is not None and last_modified is not None:
+        return request.if_modified_since >= last_modified
+    return False
+
+
+def not_modified_response(
+    etag: str, last_modified: Optional[datetime.datetime]
+) -> Response:
+    response = make_response("", 304)
+    set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(
+    response: Response, etag: str, last_modified: Optional[datetime.datetime]
+) -> None:
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+
+def conditional_response(
+    newest_first: List[Bloom],
+    make_body: Callable[[], Response],
+    *,
+    append_only: bool = True,
+) -> Response:
+    """conditional_response answers with 304 if the client already has newest_first, and
+    otherwise calls make_body and adds the ETag (and, if the list is append_only,
+    Last-Modified) headers to it."""
+    etag = bloom_etag(newest_first)
+    last_modified = bloom_last_modified(newest_first) if append_only else None
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    response = make_body()
+    set_validators(response, etag, last_modified)
+    return response
+
+
+def cached(tag: Callable[..., Hashable], *, immutable: bool = False):
+    """cached caches a view's successful responses, under a key made from tag (called with
+    the view's arguments) and the request's path and query string."""
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (tag(*args, **kwargs), request.full_path)
+            # The cached response may have been read from a replica which hadn't caught up
+            # with the requester's writes.
+            entry = MISSING if reading_from_primary() else _response_cache.get(key)
+            if entry is MISSING:
+                response = view(*args, **kwargs)
+                etag, _ = response.get_etag()
+                if response.status_code != 200 or etag is None:
+                    return response
+                set_cache_control(response, immutable=immutable)
+                if used_replica() and _recently_invalidated.get(key[0]) is not MISSING:
+                    return response
+                entry = CachedResponse(
+                    body=response.get_data(),
+                    headers=list(response.headers.items()),
+                    etag=etag,
+                    last_modified=response.last_modified,
+                )
+                _response_cache.set(key, entry)
+                return response
+            if is_not_modified(entry.etag, entry.last_modified):
+                response = not_modified_response(entry.etag, entry.last_modified)
+                set_cache_control(response, immutable=immutable)
+                return response
+            return Response(entry.body, status=200, headers=entry.headers)
+
+        return wrapper
+
+    return decorator
+
+
+def set_cache_control(response: Response, *, immutable: bool) -> None:
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE_SECONDS
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = FEED_MAX_AGE_SECONDS
+
+
+def invalidate_blooms(new_blooms: List[Bloom]) -> None:
+    """invalidate_blooms drops cached responses listing the senders or hashtags of new_blooms."""
+    tags = set()
+    for bloom in new_blooms:
+        tags.add(("user", bloom.sender))
+        for hashtag in extract_hashtags(bloom.content):
+            tags.add(("hashtag", hashtag))
+    _response_cache.invalidate_where(lambda key: key[0] in tags)
+    for tag in tags:
+        _recently_invalidated.set(tag, True)
+
+
+def response_cache_stats() -> CacheStats:
+    return _response_cache.stats()
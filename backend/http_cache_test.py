@@ -0,0 +1,65 @@
+import datetime
+import unittest
+
+from data.blooms import Bloom
+from flask import Flask
+from http_cache import bloom_etag, bloom_last_modified, is_not_modified
+
+
+def make_bloom(
+    bloom_id: int,
+    sent_timestamp: datetime.datetime = datetime.datetime(2020, 3, 4, 14, 15, 16),
+) -> Bloom:
+    return Bloom(
+        id=bloom_id,
+        sender="sample",
+        content=f"Bloom {bloom_id}",
+        sent_timestamp=sent_timestamp,
+    )
+
+
+class TestHttpCache(unittest.TestCase):
+    def test_etag_covers_every_bloom(self):
+        newest, older, backfilled = make_bloom(3), make_bloom(1), make_bloom(2)
+        self.assertEqual(bloom_etag([newest, older]), bloom_etag([newest, older]))
+        # Following someone adds their older blooms under the same newest bloom.
+        self.assertNotEqual(
+            bloom_etag([newest, older]), bloom_etag([newest, backfilled])
+        )
+        self.assertNotEqual(bloom_etag([newest]), bloom_etag([newest, older]))
+
+    def test_last_modified_is_the_end_of_the_newest_blooms_second(self):
+        bloom = make_bloom(1, datetime.datetime(2020, 3, 4, 14, 15, 16, 500000))
+        self.assertEqual(
+            bloom_last_modified([bloom]),
+            datetime.datetime(2020, 3, 4, 14, 15, 17, tzinfo=datetime.UTC),
+        )
+        self.assertIsNone(bloom_last_modified([]))
+        # More blooms may yet be sent in this second.
+        now = datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+        self.assertIsNone(bloom_last_modified([make_bloom(2, now)]))
+
+    def test_if_none_match_takes_precedence(self):
+        app = Flask("Dummy")
+        last_modified = datetime.datetime(2020, 3, 4, 14, 15, 17, tzinfo=datetime.UTC)
+        cases = [
+            ({"If-Modified-Since": "Wed, 04 Mar 2020 14:15:17 GMT"}, True),
+            ({"If-Modified-Since": "Wed, 04 Mar 2020 14:15:16 GMT"}, False),
+            (
+                {
+                    "If-None-Match": '"other"',
+                    "If-Modified-Since": "Wed, 04 Mar 2020 14:15:17 GMT",
+                },
+                False,
+            ),
+            ({"If-None-Match": '"etag"'}, True),
+        ]
+        for headers, not_modified in cases:
+            with self.subTest(headers=headers), app.test_request_context(
+                headers=headers
+            ):
+                self.assertEqual(is_not_modified("etag", last_modified), not_modified)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+from array import array
+from bisect import bisect_left, insort
+from typing import Iterable, Iterator, List
+
+
+class IdSet:
+    """IdSet is an immutable set of database ids, kept as a sorted array of 32-bit integers.
+
+    That takes 4 bytes an id, rather than the 60 or so a set of ints takes, and membership
+    tests are a binary search.
+    """
+
+    __slots__ = ("_ids",)
+
+    def __init__(self, sorted_ids: Iterable[int] = ()):
+        """sorted_ids must be in ascending order without repeats (e.g. from ORDER BY on a
+        unique column); use IdSet.of for anything else."""
+        self._ids = array("i", sorted_ids)
+
+    @classmethod
+    def of(cls, ids: Iterable[int]) -> "IdSet":
+        return cls(sorted(set(ids)))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._ids)
+
+    def __contains__(self, id: int) -> bool:
+        index = bisect_left(self._ids, id)
+        return index < len(self._ids) and self._ids[index] == id
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, IdSet) and self._ids == other._ids
+
+    def __repr__(self) -> str:
+        return f"IdSet({list(self._ids)!r})"
+
+    def with_id(self, id: int) -> "IdSet":
+        """with_id returns a copy of the set with id added."""
+        if id in self:
+            return self
+        copy = IdSet()
+        copy._ids = array("i", self._ids)
+        insort(copy._ids, id)
+        return copy
+
+    def intersection(self, other: "IdSet") -> List[int]:
+        """intersection returns the ids in both sets, in ascending order.
+
+        It searches the larger set for each id of the smaller, so intersecting a few ids
+        with millions takes a few binary searches rather than a pass over the millions.
+        """
+        small, large = sorted((self._ids, other._ids), key=len)
+        common = []
+        start = 0
+        for id in small:
+            start = bisect_left(large, id, start)
+            if start == len(large):
+                break
+            if large[start] == id:
+                common.append(id)
+        return common
@@ -0,0 +1,34 @@
+import unittest
+
+from id_set import IdSet
+
+
+class TestIdSet(unittest.TestCase):
+    def test_contains(self):
+        ids = IdSet.of([7, 3, 3, 11])
+        self.assertEqual(list(ids), [3, 7, 11])
+        self.assertEqual(len(ids), 3)
+        for id in [3, 7, 11]:
+            self.assertIn(id, ids)
+        for id in [0, 4, 12]:
+            self.assertNotIn(id, ids)
+        self.assertNotIn(1, IdSet())
+
+    def test_with_id(self):
+        ids = IdSet([3, 7])
+        self.assertEqual(ids.with_id(5), IdSet([3, 5, 7]))
+        self.assertEqual(ids.with_id(1), IdSet([1, 3, 7]))
+        self.assertIs(ids.with_id(7), ids)
+        # The original is unchanged.
+        self.assertEqual(ids, IdSet([3, 7]))
+
+    def test_intersection(self):
+        many = IdSet(range(0, 1000, 3))
+        self.assertEqual(IdSet([1, 3, 4, 9, 999]).intersection(many), [3, 9, 999])
+        self.assertEqual(many.intersection(IdSet([1, 3, 4, 9, 999])), [3, 9, 999])
+        self.assertEqual(many.intersection(IdSet([1000])), [])
+        self.assertEqual(IdSet().intersection(many), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,20 +1,44 @@
+import argparse
 import os
 
+from batch import batch
 from custom_json_provider import CustomJsonProvider
+from data.blooms import add_bloom_listener
+from data.connection import (
+    read_from_replicas,
+    set_query_observer,
+    start_query_count,
+)
 from data.users import lookup_user
 from endpoints import (
+    add_query_count_header,
     do_follow,
     get_bloom,
+    hashing_saturated,
     hashtag,
+    hashtag_suggestions,
     home_timeline,
     login,
     other_profile,
     register,
+    search,
     self_profile,
     send_bloom,
+    send_blooms_batch,
     suggested_follows,
+    trending,
     user_blooms,
 )
+from hashing import HashingSaturatedError
+import home_stream
+from http_cache import invalidate_blooms
+from metrics import (
+    query_observer,
+    record_request_metrics,
+    serve_metrics,
+    start_request_metrics,
+)
+from server import Server, server_options
 
 from dotenv import load_dotenv
 from flask import Flask
@@ -22,7 +46,9 @@ from flask_cors import CORS
 from flask_jwt_extended import JWTManager
 
 
-def main():
+def create_app() -> Flask:
+    """create_app builds the application. It doesn't connect to the database: each process
+    opens its own connections when it first needs them."""
     load_dotenv()
 
     app = Flask("PurpleForest")
@@ -36,7 +62,9 @@ def main():
         resources={
             r"/*": {
                 "origins": "*",
-                "allow_headers": ["Content-Type", "Authorization"],
+                # Last-Event-ID resumes /home/stream.
+                "allow_headers": ["Content-Type", "Authorization", "Last-Event-ID"],
+                "expose_headers": ["ETag", "Last-Modified", "X-Next-Cursor"],
                 "methods": ["GET", "POST", "OPTIONS"],
             }
         },
@@ -46,6 +74,18 @@ def main():
     jwt = JWTManager(app)
     jwt.user_lookup_loader(lookup_user)
 
+    add_bloom_listener(invalidate_blooms)
+
+    app.register_error_handler(HashingSaturatedError, hashing_saturated)
+
+    app.before_request(start_query_count)
+    app.before_request(read_from_replicas)
+    app.before_request(start_request_metrics)
+    app.after_request(record_request_metrics)
+    if os.getenv("EXPOSE_QUERY_COUNT") == "1":
+        app.after_request(add_query_count_header)
+    set_query_observer(query_observer())
+
     app.add_url_rule("/register", methods=["POST"], view_func=register)
     app.add_url_rule("/login", methods=["POST"], view_func=login)
 
@@ -57,11 +97,36 @@ def main():
     app.add_url_rule("/suggested-follows/<limit_str>", view_func=suggested_follows)
 
     app.add_url_rule("/bloom", methods=["POST"], view_func=send_bloom)
+    app.add_url_rule("/blooms/batch", methods=["POST"], view_func=send_blooms_batch)
     app.add_url_rule("/bloom/<id_str>", methods=["GET"], view_func=get_bloom)
     app.add_url_rule("/blooms/<profile_username>", view_func=user_blooms)
     app.add_url_rule("/hashtag/<hashtag>", view_func=hashtag)
+    app.add_url_rule("/hashtags/suggest", view_func=hashtag_suggestions)
+    app.add_url_rule("/trending", view_func=trending)
+    app.add_url_rule("/search", view_func=search)
+
+    app.add_url_rule("/batch", methods=["POST"], view_func=batch)
+
+    app.add_url_rule("/metrics", view_func=serve_metrics)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the PurpleForest backend.")
+    parser.add_argument(
+        "--dev",
+        action="store_true",
+        help="Run Flask's single-process development server, with the reloader and debugger.",
+    )
+    args = parser.parse_args()
 
-    app.run(host="0.0.0.0", port="3000", debug=True)
+    if args.dev:
+        app = create_app()
+        home_stream.start(app)
+        app.run(host="0.0.0.0", port="3000", debug=True)
+    else:
+        Server(create_app, server_options()).run()
 
 
 if __name__ == "__main__":
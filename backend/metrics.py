@@ -0,0 +1,706 @@
+"""Request and query metrics, served in Prometheus' text format at /metrics.
+
+Every request's duration, status and number of database queries are recorded by route;
+this is cheap enough to always do. Per-statement metrics (how long each normalized
+statement takes and how many rows it returns) are only recorded for a sample of requests,
+METRICS_QUERY_SAMPLE_RATE of them (by default none). Separately, any statement which takes
+at least SLOW_QUERY_SECONDS is logged. If neither is turned on, statements aren't timed at
+all.
+
+Under gunicorn each worker process records its own metrics. So that /metrics reports all of
+them whichever worker serves it, workers write snapshots of their metrics to a shared
+directory (every METRICS_FLUSH_SECONDS, and when they exit) and /metrics adds them up.
+When a worker exits, the master folds its snapshot into an archive, so that counters never
+go backwards.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+import fcntl
+import functools
+import json
+import logging
+import math
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from cache import CacheStats
+from data.connection import (
+    PoolStats,
+    ReplicaStats,
+    pool_stats,
+    query_count,
+    replica_stats,
+)
+from data.users import user_cache_stats
+from hashing import HashingStats, hashing_stats
+from home_stream import StreamStats, stream_stats
+from http_cache import response_cache_stats
+
+from flask import Response, has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+QUERY_SAMPLE_RATE = float(os.getenv("METRICS_QUERY_SAMPLE_RATE", "0"))
+SLOW_QUERY_SECONDS: Optional[float] = (
+    float(os.environ["SLOW_QUERY_SECONDS"]) if os.getenv("SLOW_QUERY_SECONDS") else None
+)
+FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+# Statements beyond this many distinct ones are counted together, as "other".
+MAX_STATEMENTS = int(os.getenv("METRICS_MAX_STATEMENTS", "500"))
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+QUERY_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005) + LATENCY_BUCKETS
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 7, 10, 15, 20, 30, 50, 100)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# A sample is keyed by its name and its labels, e.g.
+# ("purpleforest_http_request_duration_seconds_bucket", (("route", "/home"), ("le", "0.1"))).
+SampleKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+@dataclass
+class MetricFamily:
+    name: str
+    type: str
+    help: str
+    samples: Dict[SampleKey, float]
+    # How the samples of several processes are combined: "sum" or "max".
+    aggregate: str = "sum"
+
+
+class Counter:
+    """Counter is a thread-safe count, for each combination of its labels' values."""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self) -> MetricFamily:
+        with self._lock:
+            values = list(self._values.items())
+        return MetricFamily(
+            self.name,
+            COUNTER,
+            self.help,
+            {
+                (self.name, tuple(zip(self.labelnames, labels))): value
+                for labels, value in values
+            },
+        )
+
+
+class Histogram:
+    """Histogram is a thread-safe count of observed values in each of some buckets, with
+    their sum, for each combination of its labels' values."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # Maps labels to the count in each bucket (the last one being +Inf), then the sum.
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-1] += value
+
+    def collect(self) -> MetricFamily:
+        with self._lock:
+            values = [(labels, list(state)) for labels, state in self._values.items()]
+        samples = {}
+        for labels, state in values:
+            pairs = tuple(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), state):
+                cumulative += count
+                le = (("le", format_value(bound)),)
+                samples[(f"{self.name}_bucket", pairs + le)] = cumulative
+            samples[(f"{self.name}_sum", pairs)] = state[-1]
+            samples[(f"{self.name}_count", pairs)] = cumulative
+        return MetricFamily(self.name, HISTOGRAM, self.help, samples)
+
+
+REQUEST_DURATION = Histogram(
+    "purpleforest_http_request_duration_seconds",
+    "How long requests took to handle, until their response started.",
+    ["method", "route"],
+)
+RESPONSES = Counter(
+    "purpleforest_http_responses_total",
+    "Responses sent, by status.",
+    ["method", "route", "status"],
+)
+REQUEST_QUERIES = Histogram(
+    "purpleforest_http_request_queries",
+    "How many database statements requests ran.",
+    ["method", "route"],
+    buckets=QUERY_COUNT_BUCKETS,
+)
+QUERY_DURATION = Histogram(
+    "purpleforest_db_query_duration_seconds",
+    "How long statements took to run, in sampled requests.",
+    ["statement"],
+    buckets=QUERY_LATENCY_BUCKETS,
+)
+QUERY_ROWS = Counter(
+    "purpleforest_db_query_rows_total",
+    "Rows returned or changed by statements, in sampled requests.",
+    ["statement"],
+)
+SLOW_QUERIES = Counter(
+    "purpleforest_db_slow_queries_total",
+    "Statements which took at least SLOW_QUERY_SECONDS.",
+)
+METRICS = [
+    REQUEST_DURATION,
+    RESPONSES,
+    REQUEST_QUERIES,
+    QUERY_DURATION,
+    QUERY_ROWS,
+    SLOW_QUERIES,
+]
+
+# For each field of a stats dataclass: its metric's name, type and help. Gauges named
+# *_max_seconds are combined across processes by taking the largest.
+POOL_FIELDS = {
+    "in_use": ("purpleforest_db_pool_connections_in_use", GAUGE, "Connections in use."),
+    "idle": ("purpleforest_db_pool_connections_idle", GAUGE, "Idle connections."),
+    "max_size": ("purpleforest_db_pool_max_size", GAUGE, "The most connections."),
+    "checkouts": ("purpleforest_db_pool_checkouts_total", COUNTER, "Checkouts."),
+    "waits": (
+        "purpleforest_db_pool_waits_total",
+        COUNTER,
+        "Checkouts which had to wait for a connection.",
+    ),
+    "total_wait_seconds": (
+        "purpleforest_db_pool_wait_seconds_total",
+        COUNTER,
+        "Time spent checking out connections.",
+    ),
+    "max_wait_seconds": (
+        "purpleforest_db_pool_wait_max_seconds",
+        GAUGE,
+        "The longest time spent checking out a connection.",
+    ),
+    "connections_opened": (
+        "purpleforest_db_pool_connections_opened_total",
+        COUNTER,
+        "Connections opened.",
+    ),
+    "connections_discarded": (
+        "purpleforest_db_pool_connections_discarded_total",
+        COUNTER,
+        "Connections closed because they were broken or stale.",
+    ),
+}
+HASHING_FIELDS = {
+    "completed": ("purpleforest_hashing_completed_total", COUNTER, "Hashes run."),
+    "rejected": (
+        "purpleforest_hashing_rejected_total",
+        COUNTER,
+        "Hashes refused because the queue was full.",
+    ),
+    "running": ("purpleforest_hashing_running", GAUGE, "Hashes running."),
+    "queued": ("purpleforest_hashing_queued", GAUGE, "Hashes waiting to run."),
+    "workers": ("purpleforest_hashing_workers", GAUGE, "Hashing threads."),
+    "max_queue": (
+        "purpleforest_hashing_max_queue",
+        GAUGE,
+        "The most hashes which may wait.",
+    ),
+    "queue_wait_seconds_total": (
+        "purpleforest_hashing_queue_wait_seconds_total",
+        COUNTER,
+        "Time hashes spent waiting to run.",
+    ),
+    "queue_wait_seconds_max": (
+        "purpleforest_hashing_queue_wait_max_seconds",
+        GAUGE,
+        "The longest time a hash waited to run.",
+    ),
+    "hash_seconds_total": (
+        "purpleforest_hashing_seconds_total",
+        COUNTER,
+        "Time spent hashing.",
+    ),
+    "hash_seconds_max": (
+        "purpleforest_hashing_max_seconds",
+        GAUGE,
+        "The longest time a hash took.",
+    ),
+}
+REPLICA_FIELDS = {
+    "lag_seconds": (
+        "purpleforest_db_replica_lag_max_seconds",
+        GAUGE,
+        "How far behind the primary the replica was when last checked.",
+    ),
+    "in_rotation": (
+        "purpleforest_db_replica_in_rotation",
+        GAUGE,
+        "Workers reading from the replica.",
+    ),
+}
+STREAM_FIELDS = {
+    "connections": ("purpleforest_streams_open", GAUGE, "Open home timeline streams."),
+    "rejected": (
+        "purpleforest_streams_rejected_total",
+        COUNTER,
+        "Streams refused because too many were open.",
+    ),
+    "dropped": (
+        "purpleforest_streams_dropped_total",
+        COUNTER,
+        "Streams disconnected for falling behind.",
+    ),
+    "events": ("purpleforest_stream_events_total", COUNTER, "Bloom events queued."),
+}
+CACHE_FIELDS = {
+    "hits": ("purpleforest_cache_hits_total", COUNTER, "Cache hits."),
+    "misses": ("purpleforest_cache_misses_total", COUNTER, "Cache misses."),
+    "evictions": (
+        "purpleforest_cache_evictions_total",
+        COUNTER,
+        "Entries evicted to make room.",
+    ),
+    "size": ("purpleforest_cache_size", GAUGE, "Entries in the cache."),
+    "max_size": ("purpleforest_cache_max_size", GAUGE, "The most entries."),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def stats_families(
+    fields: Dict[str, Tuple[str, str, str]],
+    labelled_stats: Iterable[Tuple[Labels, Any]],
+) -> List[MetricFamily]:
+    """stats_families makes metrics from the fields of some stats dataclasses."""
+    labelled_stats = list(labelled_stats)
+    families = []
+    for field, (name, type, help) in fields.items():
+        samples = {
+            (name, labels): float(getattr(stats, field))
+            for labels, stats in labelled_stats
+        }
+        aggregate = "max" if name.endswith("_max_seconds") else "sum"
+        families.append(MetricFamily(name, type, help, samples, aggregate))
+    return families
+
+
+def collect() -> List[MetricFamily]:
+    """collect returns this process's metrics."""
+    pool: PoolStats = pool_stats()
+    replicas: List[Tuple[Labels, ReplicaStats]] = [
+        ((("replica", address),), stats) for address, stats in replica_stats().items()
+    ]
+    hashing: HashingStats = hashing_stats()
+    streams: StreamStats = stream_stats()
+    caches: List[Tuple[Labels, CacheStats]] = [
+        ((("cache", "users"),), user_cache_stats()),
+        ((("cache", "responses"),), response_cache_stats()),
+    ]
+    return (
+        [metric.collect() for metric in METRICS]
+        + stats_families(
+            POOL_FIELDS,
+            [((), pool)] + [(labels, stats.pool) for labels, stats in replicas],
+        )
+        + stats_families(REPLICA_FIELDS, replicas)
+        + stats_families(HASHING_FIELDS, [((), hashing)])
+        + stats_families(STREAM_FIELDS, [((), streams)])
+        + stats_families(CACHE_FIELDS, caches)
+    )
+
+
+def merge(snapshots: Iterable[List[MetricFamily]]) -> List[MetricFamily]:
+    """merge combines the metrics of several processes."""
+    merged: Dict[str, MetricFamily] = {}
+    for families in snapshots:
+        for family in families:
+            into = merged.get(family.name)
+            if into is None:
+                merged[family.name] = MetricFamily(
+                    family.name,
+                    family.type,
+                    family.help,
+                    dict(family.samples),
+                    family.aggregate,
+                )
+                continue
+            for key, value in family.samples.items():
+                if key not in into.samples:
+                    into.samples[key] = value
+                elif into.aggregate == "max":
+                    into.samples[key] = max(into.samples[key], value)
+                else:
+                    into.samples[key] += value
+    return list(merged.values())
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def render(families: List[MetricFamily]) -> str:
+    """render formats metrics in Prometheus' text exposition format."""
+    lines = []
+    for family in families:
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {family.type}")
+        for (name, labels), value in family.samples.items():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# Normalizing statements ------------------------------------------------------------------
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s|%s|\b\d+(?:\.\d+)?\b")
+_LIST = re.compile(r"\(\?(?:, \?)*\)(?:, \(\?(?:, \?)*\))+|\(\?(?:, \?)+\)")
+_SPACE = re.compile(r"\s+")
+_COMMA = re.compile(r"\s*,\s*")
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_statement(statement: str) -> str:
+    """normalize_statement replaces the values in a statement with ?, and lists of values
+    with (...), so that statements which only differ in their values look the same."""
+    statement = _SPACE.sub(" ", statement).strip()
+    statement = _LITERAL.sub("?", statement)
+    statement = _COMMA.sub(", ", statement)
+    return _LIST.sub("(...)", statement)
+
+
+def statement_text(cursor, query: Any) -> str:
+    if isinstance(query, bytes):
+        return query.decode("utf-8", errors="replace")
+    if isinstance(query, str):
+        return query
+    # A psycopg2.sql.Composable.
+    return query.as_string(cursor)
+
+
+_statement_labels: set = set()
+_statement_labels_lock = threading.Lock()
+
+
+def statement_label(statement: str) -> str:
+    if statement in _statement_labels:
+        return statement
+    with _statement_labels_lock:
+        if len(_statement_labels) >= MAX_STATEMENTS:
+            return "other"
+        _statement_labels.add(statement)
+    return statement
+
+
+# Recording -------------------------------------------------------------------------------
+
+# Whether to record per-statement metrics for the current request.
+_sampled: ContextVar[bool] = ContextVar("metrics_sampled", default=False)
+_request_started_at: ContextVar[Optional[float]] = ContextVar(
+    "request_started_at", default=None
+)
+
+
+def observe_query(cursor, query: Any, seconds: float) -> None:
+    """observe_query is the query observer: it records sampled statements, and logs slow
+    ones."""
+    slow = SLOW_QUERY_SECONDS is not None and seconds >= SLOW_QUERY_SECONDS
+    sampled = _sampled.get()
+    if not (slow or sampled):
+        return
+    statement = normalize_statement(statement_text(cursor, query))
+    rows = cursor.rowcount
+    if sampled:
+        label = statement_label(statement)
+        QUERY_DURATION.observe(seconds, label)
+        if rows > 0:
+            QUERY_ROWS.inc(label, amount=rows)
+    if slow:
+        SLOW_QUERIES.inc()
+        where = f" in {request.method} {request.path}" if has_request_context() else ""
+        # Only the normalized statement is logged: its values might be private.
+        logger.warning(
+            "Slow query took %.3fs (%s rows)%s: %s",
+            seconds,
+            rows if rows >= 0 else "unknown",
+            where,
+            statement,
+        )
+
+
+def query_observer():
+    """query_observer returns the query observer to use, or None if statements needn't be
+    timed."""
+    if QUERY_SAMPLE_RATE > 0 or SLOW_QUERY_SECONDS is not None:
+        return observe_query
+    return None
+
+
+def start_request_metrics() -> None:
+    _request_started_at.set(time.perf_counter())
+    _sampled.set(QUERY_SAMPLE_RATE > 0 and random.random() < QUERY_SAMPLE_RATE)
+
+
+def record_request_metrics(response: Response) -> Response:
+    """record_request_metrics records a request's metrics as its response is sent. (A
+    streamed response's duration only counts until its first chunk.)"""
+    started_at = _request_started_at.get()
+    if started_at is None:
+        return response
+    _request_started_at.set(None)
+    seconds = time.perf_counter() - started_at
+    # Looking up the request through its proxy each time would cost more than the rest.
+    current_request = request._get_current_object()
+    method = current_request.method
+    rule = current_request.url_rule
+    # Label by route rather than path, so that there are a bounded number of labels.
+    route = rule.rule if rule is not None else "unmatched"
+    REQUEST_DURATION.observe(seconds, method, route)
+    RESPONSES.inc(method, route, str(response.status_code))
+    count = query_count()
+    if count is not None:
+        REQUEST_QUERIES.observe(count, method, route)
+    return response
+
+
+# Sharing metrics between processes -------------------------------------------------------
+
+_directory: Optional[str] = None
+_created_directory = False
+_flush_lock = threading.Lock()
+_stopped = False
+_pending_archives: List[int] = []
+_archiving = False
+
+ARCHIVE = "archive.json"
+
+
+def prepare_directory() -> None:
+    """prepare_directory sets up the directory which worker processes share their metrics
+    through: METRICS_DIR if it is set (clearing any old snapshots), or else a new
+    temporary directory. It must be called before workers are forked."""
+    global _directory, _created_directory
+    directory = os.getenv("METRICS_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                os.remove(os.path.join(directory, name))
+        _created_directory = False
+    else:
+        directory = tempfile.mkdtemp(prefix="purpleforest-metrics-")
+        _created_directory = True
+    _directory = directory
+
+
+def remove_directory() -> None:
+    """remove_directory removes the directory made by prepare_directory, if it made one."""
+    if _directory is not None and _created_directory:
+        shutil.rmtree(_directory, ignore_errors=True)
+
+
+@contextmanager
+def _locked(exclusive: bool):
+    with open(os.path.join(_directory, ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(_directory, f"{pid}.json")
+
+
+def _write(path: str, families: List[MetricFamily]) -> None:
+    temporary = f"{path}.{threading.get_ident()}.tmp"
+    with open(temporary, "w") as file:
+        json.dump(
+            [
+                {
+                    "name": family.name,
+                    "type": family.type,
+                    "help": family.help,
+                    "aggregate": family.aggregate,
+                    "samples": [
+                        [name, labels, value]
+                        for (name, labels), value in family.samples.items()
+                    ],
+                }
+                for family in families
+            ],
+            file,
+        )
+    os.replace(temporary, path)
+
+
+def _read(path: str) -> List[MetricFamily]:
+    try:
+        with open(path) as file:
+            families = json.load(file)
+    except FileNotFoundError:
+        return []
+    return [
+        MetricFamily(
+            family["name"],
+            family["type"],
+            family["help"],
+            {
+                (name, tuple(map(tuple, labels))): value
+                for name, labels, value in family["samples"]
+            },
+            family["aggregate"],
+        )
+        for family in families
+    ]
+
+
+def flush() -> None:
+    """flush writes this process's metrics for other processes to read."""
+    if _directory is None:
+        return
+    with _flush_lock:
+        if not _stopped:
+            _write(_snapshot_path(os.getpid()), collect())
+
+
+def stop_flushing() -> None:
+    """stop_flushing flushes this process's metrics for the last time, as it exits."""
+    global _stopped
+    flush()
+    with _flush_lock:
+        _stopped = True
+
+
+def start_flushing() -> None:
+    """start_flushing starts a thread which flushes this process's metrics every
+    METRICS_FLUSH_SECONDS. It must be called after forking, as threads don't survive it.
+    """
+
+    def flush_forever():
+        while True:
+            time.sleep(FLUSH_SECONDS)
+            try:
+                flush()
+            except Exception:
+                logger.exception("Couldn't flush metrics")
+
+    threading.Thread(target=flush_forever, name="metrics", daemon=True).start()
+
+
+def archive(pid: int) -> None:
+    """archive folds the last metrics written by an exited process into the archive. Its
+    gauges are dropped, as they described a process which no longer exists.
+
+    gunicorn calls this from its SIGCHLD handler, so it can be called again while it is
+    archiving, when another worker exits. Taking the lock again would wait for ourselves
+    forever, so those calls just queue the process for the interrupted call to archive.
+    """
+    global _archiving
+    if _directory is None:
+        return
+    _pending_archives.append(pid)
+    while _pending_archives and not _archiving:
+        _archiving = True
+        try:
+            while _pending_archives:
+                _archive(_pending_archives.pop())
+        finally:
+            _archiving = False
+
+
+def _archive(pid: int) -> None:
+    with _locked(exclusive=True):
+        exited = [
+            family
+            for family in _read(_snapshot_path(pid))
+            if family.type != GAUGE or family.aggregate == "max"
+        ]
+        archive_path = os.path.join(_directory, ARCHIVE)
+        _write(archive_path, merge([_read(archive_path), exited]))
+        try:
+            os.remove(_snapshot_path(pid))
+        except FileNotFoundError:
+            pass
+
+
+def collect_all() -> List[MetricFamily]:
+    """collect_all returns the metrics of every process."""
+    if _directory is None:
+        return collect()
+    flush()
+    with _locked(exclusive=False):
+        paths = [
+            os.path.join(_directory, name)
+            for name in sorted(os.listdir(_directory))
+            if name.endswith(".json")
+        ]
+        return merge(map(_read, paths))
+
+
+def serve_metrics():
+    return Response(
+        render(collect_all()), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -0,0 +1,184 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import metrics
+from metrics import (
+    COUNTER,
+    GAUGE,
+    Counter,
+    Histogram,
+    MetricFamily,
+    merge,
+    normalize_statement,
+    render,
+)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_normalize_statement(self):
+        self.assertEqual(
+            normalize_statement(
+                "SELECT id FROM users\n    WHERE username = %(username)s AND id > 5"
+            ),
+            "SELECT id FROM users WHERE username = ? AND id > ?",
+        )
+        self.assertEqual(
+            normalize_statement(
+                "INSERT INTO hashtags (hashtag, bloom_id) VALUES ('a', 1),('it''s', 2)"
+            ),
+            "INSERT INTO hashtags (hashtag, bloom_id) VALUES (...)",
+        )
+        self.assertEqual(
+            normalize_statement("SELECT * FROM blooms WHERE id IN (%s, %s, %s)"),
+            "SELECT * FROM blooms WHERE id IN (...)",
+        )
+        self.assertEqual(
+            normalize_statement("SELECT scrypt_n FROM t1 WHERE x = (%s)"),
+            "SELECT scrypt_n FROM t1 WHERE x = (?)",
+        )
+
+    def test_histogram(self):
+        histogram = Histogram("latency_seconds", "Latency.", ["route"], [0.1, 1])
+        histogram.observe(0.05, "/home")
+        histogram.observe(0.1, "/home")
+        histogram.observe(3, "/home")
+        self.assertEqual(
+            render([histogram.collect()]),
+            "# HELP latency_seconds Latency.\n"
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{route="/home",le="0.1"} 2\n'
+            'latency_seconds_bucket{route="/home",le="1"} 2\n'
+            'latency_seconds_bucket{route="/home",le="+Inf"} 3\n'
+            'latency_seconds_sum{route="/home"} 3.15\n'
+            'latency_seconds_count{route="/home"} 3\n',
+        )
+
+    def test_render_escapes_labels(self):
+        counter = Counter("statements_total", "Statements.", ["statement"])
+        counter.inc('SELECT "a\\b"\n')
+        self.assertIn(
+            'statements_total{statement="SELECT \\"a\\\\b\\"\\n"} 1',
+            render([counter.collect()]),
+        )
+
+    def test_merge(self):
+        def family(aggregate, **samples):
+            return MetricFamily(
+                "x",
+                COUNTER,
+                "X.",
+                {("x", (("n", n),)): value for n, value in samples.items()},
+                aggregate,
+            )
+
+        merged = merge([[family("sum", a=1, b=2)], [family("sum", a=3, c=4)]])
+        self.assertEqual(
+            merged[0].samples,
+            {("x", (("n", "a"),)): 4, ("x", (("n", "b"),)): 2, ("x", (("n", "c"),)): 4},
+        )
+        merged = merge(
+            [[family("max", a=1)], [family("max", a=3)], [family("max", a=2)]]
+        )
+        self.assertEqual(merged[0].samples, {("x", (("n", "a"),)): 3})
+
+    def test_slow_queries_are_logged_without_values(self):
+        class Cursor:
+            rowcount = 3
+
+        original = metrics.SLOW_QUERY_SECONDS
+        metrics.SLOW_QUERY_SECONDS = 0.5
+        try:
+            metrics.observe_query(Cursor(), "SELECT 1 WHERE a = 'b'", 0.1)
+            with self.assertLogs("metrics") as logs:
+                metrics.observe_query(
+                    Cursor(), "SELECT * FROM users WHERE username = 'secret'", 0.7
+                )
+        finally:
+            metrics.SLOW_QUERY_SECONDS = original
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("0.700s (3 rows)", logs.output[0])
+        self.assertIn("SELECT * FROM users WHERE username = ?", logs.output[0])
+        self.assertNotIn("secret", logs.output[0])
+
+    def test_processes_share_metrics(self):
+        def families(requests, in_use):
+            return [
+                MetricFamily(
+                    "requests_total", COUNTER, "R.", {("requests_total", ()): requests}
+                ),
+                MetricFamily("in_use", GAUGE, "U.", {("in_use", ()): in_use}),
+            ]
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch.dict(
+            os.environ, {"METRICS_DIR": directory}
+        ):
+            metrics.prepare_directory()
+            try:
+                with mock.patch("os.getpid", return_value=1), mock.patch(
+                    "metrics.collect", return_value=families(5, 2)
+                ):
+                    metrics.flush()
+                # Another process exits, and only its counters are kept.
+                with mock.patch("os.getpid", return_value=2), mock.patch(
+                    "metrics.collect", return_value=families(3, 1)
+                ):
+                    metrics.flush()
+                metrics.archive(2)
+                self.assertEqual(
+                    sorted(os.listdir(directory)), [".lock", "1.json", "archive.json"]
+                )
+
+                with mock.patch("os.getpid", return_value=1), mock.patch(
+                    "metrics.collect", return_value=families(6, 4)
+                ):
+                    merged = {
+                        family.name: family.samples for family in metrics.collect_all()
+                    }
+            finally:
+                metrics._directory = None
+        self.assertEqual(merged["requests_total"], {("requests_total", ()): 9})
+        self.assertEqual(merged["in_use"], {("in_use", ()): 4})
+
+    def test_archive_while_archiving(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.dict(
+            os.environ, {"METRICS_DIR": directory}
+        ):
+            metrics.prepare_directory()
+            try:
+                for pid in [2, 3]:
+                    with mock.patch("os.getpid", return_value=pid), mock.patch(
+                        "metrics.collect",
+                        return_value=[
+                            MetricFamily(
+                                "requests_total",
+                                COUNTER,
+                                "R.",
+                                {("requests_total", ()): pid},
+                            )
+                        ],
+                    ):
+                        metrics.flush()
+
+                # Process 3 exits while process 2 is being archived.
+                read = metrics._read
+
+                def read_and_interrupt(path):
+                    if path.endswith("2.json"):
+                        metrics.archive(3)
+                    return read(path)
+
+                with mock.patch("metrics._read", side_effect=read_and_interrupt):
+                    metrics.archive(2)
+                self.assertEqual(
+                    sorted(os.listdir(directory)), [".lock", "archive.json"]
+                )
+                archived = metrics._read(os.path.join(directory, "archive.json"))
+            finally:
+                metrics._directory = None
+        self.assertEqual(archived[0].samples, {("requests_total", ()): 5})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+from array import array
+from bisect import bisect_left
+import heapq
+from typing import Dict, Iterable, List, Tuple
+
+# UTF-8 never uses this byte, so it sorts after every continuation of a prefix.
+_AFTER_PREFIX = b"\xff"
+
+
+class _Keys:
+    """_Keys presents the strings of a PrefixIndex as a sequence of bytes, for bisect."""
+
+    def __init__(self, data: bytearray, offsets: array):
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> bytes:
+        return bytes(self._data[self._offsets[index] : self._offsets[index + 1]])
+
+
+class PrefixIndex:
+    """PrefixIndex finds the highest scoring of a large set of strings which start with a
+    prefix.
+
+    The strings are kept sorted in a single UTF-8 buffer (sorting UTF-8 bytes sorts by code
+    point), so millions of them take tens of megabytes rather than the hundreds they would
+    as separate str objects, and the strings starting with a prefix are a range found by
+    binary search. Finding the best in a large range would mean scanning it, so the best
+    max_results of every prefix matching more than scan_limit strings are found when the
+    index is built, and lookups scan at most scan_limit strings.
+    """
+
+    # Prefixes longer than this (in bytes) are scanned however many strings they match,
+    # which bounds how deep building the index recurses. Only strings made to share long
+    # prefixes can make that slow.
+    MAX_PRECOMPUTED_LENGTH = 64
+
+    def __init__(
+        self,
+        items: Iterable[Tuple[str, int]],
+        *,
+        max_results: int,
+        scan_limit: int = 1024,
+    ):
+        """items are the strings and their scores, sorted by code point without repeats
+        (e.g. ORDER BY ... COLLATE "C" in Postgres)."""
+        self.max_results = max_results
+        self.scan_limit = scan_limit
+        self._data = bytearray()
+        self._offsets = array("I", [0])
+        self._scores = array("i")
+        previous = None
+        for string, score in items:
+            encoded = string.encode("utf-8")
+            if previous is not None and encoded <= previous:
+                raise ValueError(
+                    f"Strings must be sorted by code point without repeats: {string!r}"
+                )
+            previous = encoded
+            self._data += encoded
+            self._offsets.append(len(self._data))
+            self._scores.append(score)
+        self._keys = _Keys(self._data, self._offsets)
+        self._best: Dict[bytes, List[int]] = {}
+        self._precompute(b"", 0, len(self))
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def top(self, prefix: str, limit: int) -> List[Tuple[str, int]]:
+        """top returns up to limit (at most max_results) strings starting with prefix and
+        their scores, highest scoring first, ties in code point order."""
+        encoded = prefix.encode("utf-8")
+        indices = self._best.get(encoded)
+        if indices is None:
+            start = bisect_left(self._keys, encoded)
+            end = bisect_left(self._keys, encoded + _AFTER_PREFIX, start)
+            indices = self._scan(start, end)
+        return [
+            (self._keys[index].decode("utf-8"), self._scores[index])
+            for index in indices[:limit]
+        ]
+
+    def _scan(self, start: int, end: int) -> List[int]:
+        # nlargest keeps equal scores in the order they come, i.e. in code point order.
+        return heapq.nlargest(
+            self.max_results, range(start, end), key=self._scores.__getitem__
+        )
+
+    def _precompute(self, prefix: bytes, start: int, end: int) -> List[int]:
+        """_precompute returns the best strings in [start, end), which all start with
+        prefix, and remembers them if there are too many to scan."""
+        if end - start <= self.scan_limit or len(prefix) > self.MAX_PRECOMPUTED_LENGTH:
+            return self._scan(start, end)
+        # The best overall are among the best starting with each longer prefix.
+        candidates = []
+        depth = len(prefix)
+        index = start
+        if self._offsets[index + 1] - self._offsets[index] == depth:
+            # The prefix itself, which sorts first.
+            candidates.append(index)
+            index += 1
+        while index < end:
+            child = prefix + bytes((self._data[self._offsets[index] + depth],))
+            child_end = bisect_left(self._keys, child + _AFTER_PREFIX, index, end)
+            candidates.extend(self._precompute(child, index, child_end))
+            index = child_end
+        candidates.sort()
+        best = heapq.nlargest(
+            self.max_results, candidates, key=self._scores.__getitem__
+        )
+        self._best[prefix] = best
+        return best
@@ -0,0 +1,49 @@
+import unittest
+
+from prefix_index import PrefixIndex
+
+
+class TestPrefixIndex(unittest.TestCase):
+    ITEMS = [
+        ("ant", 5),
+        ("apple", 9),
+        ("applet", 2),
+        ("apply", 9),
+        ("bee", 7),
+        ("café", 3),
+        ("cafés", 4),
+        ("zebra", 1),
+    ]
+
+    def test_top(self):
+        # Small enough to scan, and so small that every prefix is precomputed.
+        for scan_limit in [1024, 1]:
+            with self.subTest(scan_limit=scan_limit):
+                index = PrefixIndex(self.ITEMS, max_results=3, scan_limit=scan_limit)
+                self.assertEqual(
+                    index.top("", 10), [("apple", 9), ("apply", 9), ("bee", 7)]
+                )
+                self.assertEqual(index.top("a", 2), [("apple", 9), ("apply", 9)])
+                self.assertEqual(
+                    index.top("appl", 10), [("apple", 9), ("apply", 9), ("applet", 2)]
+                )
+                self.assertEqual(index.top("apple", 10), [("apple", 9), ("applet", 2)])
+                self.assertEqual(index.top("caf", 10), [("cafés", 4), ("café", 3)])
+                self.assertEqual(index.top("café", 10), [("cafés", 4), ("café", 3)])
+                self.assertEqual(index.top("b", 10), [("bee", 7)])
+                self.assertEqual(index.top("c", 10)[0], ("cafés", 4))
+                self.assertEqual(index.top("zz", 10), [])
+                self.assertEqual(index.top("", 0), [])
+
+    def test_empty(self):
+        self.assertEqual(PrefixIndex([], max_results=3).top("a", 3), [])
+
+    def test_items_must_be_sorted(self):
+        with self.assertRaises(ValueError):
+            PrefixIndex([("b", 1), ("a", 1)], max_results=3)
+        with self.assertRaises(ValueError):
+            PrefixIndex([("a", 1), ("a", 1)], max_results=3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,19 @@
+"""reconcile_counters recomputes the follower, following and bloom counters kept on each
+user, and repairs any which have drifted from the follows and blooms tables.
+
+Run it periodically, e.g. from cron: python3 reconcile_counters.py
+"""
+
+from dotenv import load_dotenv
+
+from data.profiles import reconcile_counters
+
+
+def main():
+    load_dotenv()
+    repaired = reconcile_counters()
+    print(f"Repaired counters for {repaired} users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""refresh_suggestions recomputes every user's follow suggestions from the follow graph.
+
+Suggestions are kept up to date incrementally as people follow each other; run this
+periodically (e.g. nightly from cron) so that scores also pick up changes further away
+in the graph and in who has been active recently: python3 refresh_suggestions.py
+"""
+
+from dotenv import load_dotenv
+
+from data.connection import db_cursor
+from data.suggestions import refresh_suggestions
+
+BATCH_SIZE = 1000
+
+
+def refresh_all_suggestions(*, after_user_id: int = 0) -> None:
+    """refresh_all_suggestions refreshes the suggestions of every user with an id greater than after_user_id."""
+    refreshed = 0
+    last_user_id = after_user_id
+    while True:
+        with db_cursor() as cur:
+            cur.execute(
+                "SELECT id FROM users WHERE id > %s ORDER BY id LIMIT %s",
+                (last_user_id, BATCH_SIZE),
+            )
+            user_ids = [row[0] for row in cur.fetchall()]
+            if not user_ids:
+                break
+            for user_id in user_ids:
+                refresh_suggestions(cur, user_id)
+        refreshed += len(user_ids)
+        last_user_id = user_ids[-1]
+        print(f"Refreshed suggestions for {refreshed} users")
+
+
+def main():
+    load_dotenv()
+    refresh_all_suggestions()
+
+
+if __name__ == "__main__":
+    main()
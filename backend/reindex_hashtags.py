@@ -0,0 +1,59 @@
+"""reindex_hashtags re-extracts every bloom's hashtags, then recounts the hashtag dictionary
+and trends from them.
+
+Run this after changing how hashtags are extracted or normalized (e.g. after migration
+0008, which stored hashtags as they were typed): python3 reindex_hashtags.py
+Blooms are reindexed in batches, each in its own transaction, so the site keeps working
+meanwhile. If it is interrupted, resume it with --after-id <the last id it printed>.
+"""
+
+import argparse
+
+from dotenv import load_dotenv
+
+from data.blooms import reindex_hashtags
+from data.connection import db_cursor
+from data.hashtags import rebuild_hashtag_dictionary
+from data.trending import recount_hashtags
+
+BATCH_SIZE = 1000
+
+
+def reindex_all_hashtags(*, after_bloom_id: int = 0) -> None:
+    """reindex_all_hashtags reindexes the hashtags of every bloom with an id greater than after_bloom_id."""
+    reindexed = 0
+    changed = 0
+    last_bloom_id = after_bloom_id
+    while True:
+        with db_cursor() as cur:
+            cur.execute(
+                "SELECT id, content FROM blooms WHERE id > %s ORDER BY id LIMIT %s",
+                (last_bloom_id, BATCH_SIZE),
+            )
+            batch = cur.fetchall()
+            if not batch:
+                break
+            changed += reindex_hashtags(cur, batch)
+        reindexed += len(batch)
+        last_bloom_id = batch[-1][0]
+        print(
+            f"Reindexed {reindexed} blooms ({changed} changed), up to id {last_bloom_id}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--after-id", type=int, default=0)
+    args = parser.parse_args()
+    load_dotenv()
+    reindex_all_hashtags(after_bloom_id=args.after_id)
+    rebuild_hashtag_dictionary()
+    print("Rebuilt the hashtag dictionary")
+    recount_hashtags()
+    print("Recounted trending hashtags")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""The production server: gunicorn, running the app in several worker processes.
+
+The app is built once in the master process and then forked, so workers start quickly and
+share its memory. Database connections are only opened after forking: each worker has its
+own pool, and never uses a connection its parent opened.
+
+gunicorn handles signals to the master process:
+  * TERM or INT: stop accepting connections, finish in-flight requests (for up to
+    WEB_GRACEFUL_TIMEOUT seconds) and exit.
+  * HUP: start new workers, then gracefully stop the old ones (a rolling restart).
+  * TTIN / TTOU: add or remove a worker.
+Because the app is preloaded, picking up new code needs a new master: send USR2 to start
+one alongside the old one, then QUIT to the old master once the new one is serving.
+"""
+
+import os
+from typing import Any, Callable, Dict
+
+from data.connection import close_pool, reset_pool
+import home_stream
+import metrics
+from flask import Flask
+from gunicorn.app.base import BaseApplication
+
+
+def server_options() -> Dict[str, Any]:
+    """server_options returns gunicorn settings, read from the environment."""
+    threads = int(os.getenv("WEB_THREADS", "4"))
+    return {
+        "bind": f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '3000')}",
+        "workers": int(os.getenv("WEB_WORKERS", str(os.cpu_count() or 1))),
+        # Each worker serves up to this many requests at once, one per thread.
+        "threads": threads,
+        "worker_class": "gthread" if threads > 1 else "sync",
+        "timeout": int(os.getenv("WEB_TIMEOUT", "30")),
+        "graceful_timeout": int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30")),
+        "keepalive": int(os.getenv("WEB_KEEPALIVE", "5")),
+        # Recycle workers after this many requests (0 means never), so that leaks can't
+        # build up; the jitter stops them all restarting at once.
+        "max_requests": int(os.getenv("WEB_MAX_REQUESTS", "0")),
+        "max_requests_jitter": int(os.getenv("WEB_MAX_REQUESTS_JITTER", "0")),
+        "preload_app": True,
+        "accesslog": "-",
+        "on_starting": on_starting,
+        "post_fork": post_fork,
+        "post_worker_init": post_worker_init,
+        "worker_exit": worker_exit,
+        "child_exit": child_exit,
+        "on_exit": on_exit,
+    }
+
+
+def on_starting(server) -> None:
+    metrics.prepare_directory()
+
+
+def post_fork(server, worker) -> None:
+    # The master may have used the database while building the app; don't share its
+    # connections. (data.ids leases each worker its own worker id after a fork by itself.)
+    reset_pool()
+    metrics.start_flushing()
+
+
+def post_worker_init(worker) -> None:
+    # Streams are served by each worker, next to the app it has loaded.
+    home_stream.start(worker.wsgi)
+
+
+def worker_exit(server, worker) -> None:
+    metrics.stop_flushing()
+    close_pool()
+
+
+def child_exit(server, worker) -> None:
+    # Runs in the master once a worker has gone, however it went.
+    metrics.archive(worker.pid)
+
+
+def on_exit(server) -> None:
+    metrics.remove_directory()
+
+
+class Server(BaseApplication):
+    """Server runs the app made by app_factory in gunicorn, with the given settings."""
+
+    def __init__(self, app_factory: Callable[[], Flask], options: Dict[str, Any]):
+        self.app_factory = app_factory
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.app_factory()
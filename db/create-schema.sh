@@ -12,3 +12,5 @@ PGPASSWORD="$POSTGRES_PASSWORD" psql \
   --host "${POSTGRES_HOST:-127.0.0.1}" \
   --port "${POSTGRES_PORT:-5432}" \
   --username "${POSTGRES_USER:-postgres}"
+
+"${SCRIPT_DIR}/migrate.sh"
@@ -0,0 +1,41 @@
+#!/bin/bash
+
+set -euo pipefail
+
+SCRIPT_DIR="$(cd -- "$(dirname -- "${BASH_SOURCE[0]}")" &> /dev/null && pwd)"
+
+source "$SCRIPT_DIR/../backend/.env"
+
+export PGPASSWORD="$POSTGRES_PASSWORD"
+export PGOPTIONS="-c client_min_messages=warning"
+
+psql_command=(
+  psql
+  --no-psqlrc
+  --quiet
+  --set ON_ERROR_STOP=1
+  --dbname "${POSTGRES_DB:-postgres}"
+  --host "${POSTGRES_HOST:-127.0.0.1}"
+  --port "${POSTGRES_PORT:-5432}"
+  --username "${POSTGRES_USER:-postgres}"
+)
+
+"${psql_command[@]}" --command "CREATE TABLE IF NOT EXISTS schema_migrations (
+  version VARCHAR PRIMARY KEY,
+  applied_at TIMESTAMP NOT NULL DEFAULT now()
+)"
+
+for migration in "${SCRIPT_DIR}"/migrations/[0-9]*.sql; do
+  version="$(basename "${migration}" .sql)"
+  applied="$("${psql_command[@]}" --tuples-only --no-align \
+    --command "SELECT 1 FROM schema_migrations WHERE version = '${version}'")"
+  if [[ -n "${applied}" ]]; then
+    continue
+  fi
+  echo "Applying migration ${version}"
+  # The migration and its schema_migrations row are committed together, so a failed
+  # migration leaves nothing behind and will be retried next time.
+  "${psql_command[@]}" --single-transaction \
+    --file "${migration}" \
+    --command "INSERT INTO schema_migrations (version) VALUES ('${version}')"
+done
@@ -0,0 +1,24 @@
+-- Materialized home timelines: one row per bloom a user should see on /home.
+CREATE TABLE IF NOT EXISTS timelines (
+    user_id INT NOT NULL REFERENCES users(id),
+    bloom_id BIGINT NOT NULL REFERENCES blooms(id),
+    send_timestamp TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, bloom_id)
+);
+
+CREATE INDEX IF NOT EXISTS timelines_user_id_send_timestamp_idx ON timelines (user_id, send_timestamp DESC, bloom_id DESC);
+
+-- Users with too many followers to fan their blooms out on write; their blooms are merged in on read.
+CREATE TABLE IF NOT EXISTS celebrities (
+    user_id INT NOT NULL PRIMARY KEY REFERENCES users(id)
+);
+
+-- Backfill timelines for databases which already have blooms.
+INSERT INTO timelines (user_id, bloom_id, send_timestamp)
+SELECT sender_id, id, send_timestamp FROM blooms
+ON CONFLICT DO NOTHING;
+
+INSERT INTO timelines (user_id, bloom_id, send_timestamp)
+SELECT follows.follower, blooms.id, blooms.send_timestamp
+FROM follows INNER JOIN blooms ON blooms.sender_id = follows.followee
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,9 @@
+-- Per-user bloom lists, newest first: get_blooms_for_user, count_blooms_for_user and timeline backfill.
+CREATE INDEX IF NOT EXISTS blooms_sender_id_send_timestamp_idx ON blooms (sender_id, send_timestamp DESC, id DESC);
+
+-- Follower lists and fan-out: get_inverse_followed_usernames and fan_out_bloom.
+-- Lookups by follower are already served by UNIQUE(follower, followee).
+CREATE INDEX IF NOT EXISTS follows_followee_follower_idx ON follows (followee, follower);
+
+-- Lookups by hashtag are served by UNIQUE(hashtag, bloom_id); this serves joins from blooms.
+CREATE INDEX IF NOT EXISTS hashtags_bloom_id_idx ON hashtags (bloom_id);
@@ -0,0 +1,11 @@
+-- Counters maintained by add_bloom and follow, so profiles don't have to count rows.
+-- reconcile_counters.py recomputes them if they ever drift.
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS follower_count INT NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS following_count INT NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS bloom_count INT NOT NULL DEFAULT 0;
+
+UPDATE users SET
+    follower_count = (SELECT COUNT(*) FROM follows WHERE followee = users.id),
+    following_count = (SELECT COUNT(*) FROM follows WHERE follower = users.id),
+    bloom_count = (SELECT COUNT(*) FROM blooms WHERE sender_id = users.id);
@@ -0,0 +1,14 @@
+-- Precomputed "who to follow" suggestions, scored from the follow graph.
+CREATE TABLE IF NOT EXISTS follow_suggestions (
+    user_id INT NOT NULL REFERENCES users(id),
+    suggested_user_id INT NOT NULL REFERENCES users(id),
+    score REAL NOT NULL,
+    PRIMARY KEY (user_id, suggested_user_id)
+);
+
+CREATE INDEX IF NOT EXISTS follow_suggestions_user_id_score_idx ON follow_suggestions (user_id, score DESC);
+
+-- Maintained by add_bloom, so suggestions can favour recently active users.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_bloom_at TIMESTAMP;
+
+UPDATE users SET last_bloom_at = (SELECT MAX(send_timestamp) FROM blooms WHERE sender_id = users.id);
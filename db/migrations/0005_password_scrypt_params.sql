@@ -0,0 +1,6 @@
+-- The scrypt cost parameters each password was hashed with, so the costs for new hashes
+-- can be raised without breaking existing ones. Existing hashes used n=8, r=8, p=1.
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS scrypt_n INT NOT NULL DEFAULT 8,
+    ADD COLUMN IF NOT EXISTS scrypt_r INT NOT NULL DEFAULT 8,
+    ADD COLUMN IF NOT EXISTS scrypt_p INT NOT NULL DEFAULT 1;
@@ -0,0 +1,40 @@
+-- How many blooms used each hashtag in each time bucket, maintained by add_blooms so that
+-- trends can be found without scanning hashtags. There are buckets of each size the trend
+-- windows in backend/data/trending.py use (5 minutes and an hour).
+CREATE TABLE IF NOT EXISTS hashtag_counts (
+    bucket_seconds INT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    hashtag VARCHAR NOT NULL,
+    count INT NOT NULL,
+    PRIMARY KEY (bucket_seconds, bucket_start, hashtag)
+);
+
+-- The top trending hashtags in each window, ranked from hashtag_counts every so often.
+CREATE TABLE IF NOT EXISTS trending_hashtags (
+    trend_window VARCHAR NOT NULL,
+    rank INT NOT NULL,
+    hashtag VARCHAR NOT NULL,
+    score REAL NOT NULL,
+    recent_count INT NOT NULL,
+    expected_count REAL NOT NULL,
+    PRIMARY KEY (trend_window, rank)
+);
+
+CREATE TABLE IF NOT EXISTS trending_refreshes (
+    trend_window VARCHAR PRIMARY KEY,
+    refreshed_at TIMESTAMP NOT NULL
+);
+
+-- Count the last eight days' hashtags, as far back as any trend window looks.
+INSERT INTO hashtag_counts (bucket_seconds, bucket_start, hashtag, count)
+SELECT
+    sizes.bucket_seconds,
+    date_bin(make_interval(secs => sizes.bucket_seconds), blooms.send_timestamp, TIMESTAMP '1970-01-01'),
+    hashtags.hashtag,
+    COUNT(*)
+FROM hashtags
+INNER JOIN blooms ON blooms.id = hashtags.bloom_id
+CROSS JOIN (VALUES (300), (3600)) AS sizes (bucket_seconds)
+WHERE blooms.send_timestamp >= now() - interval '8 days'
+GROUP BY 1, 2, 3
+ON CONFLICT DO NOTHING;
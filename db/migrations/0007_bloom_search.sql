@@ -0,0 +1,15 @@
+-- Full-text search over bloom content: search_blooms. The vector is generated from the
+-- content, so every way of adding blooms (including COPY) keeps it up to date. It uses
+-- the 'simple' configuration, which lowercases words but doesn't stem them or drop stop
+-- words, as blooms are written in many languages, and prefix searches should match what
+-- people actually typed.
+ALTER TABLE blooms ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED;
+
+-- GIN's pending list (fastupdate, on by default) batches index updates, so adding blooms
+-- stays cheap.
+CREATE INDEX IF NOT EXISTS blooms_search_vector_idx ON blooms USING GIN (search_vector);
+
+-- The newest blooms matching a search: searches for common words walk this until they
+-- have found enough matches, rather than fetching every match.
+CREATE INDEX IF NOT EXISTS blooms_send_timestamp_id_idx ON blooms (send_timestamp DESC, id DESC);
@@ -0,0 +1,13 @@
+-- Every distinct hashtag and how many blooms use it, maintained by add_blooms, for
+-- suggesting hashtags as people type them. The "C" collation sorts hashtags by code point,
+-- as the in-memory suggestion index does, so it can be loaded in order from the index.
+CREATE TABLE IF NOT EXISTS hashtag_dictionary (
+    hashtag VARCHAR COLLATE "C" PRIMARY KEY,
+    bloom_count INT NOT NULL
+);
+
+-- Hashtags stored before they were normalized are counted as they are; run
+-- backend/reindex_hashtags.py to normalize them.
+INSERT INTO hashtag_dictionary (hashtag, bloom_count)
+SELECT hashtag, COUNT(*) FROM hashtags GROUP BY hashtag
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,55 @@
+#!/bin/bash
+
+# Runs a streaming replica of the database run.sh runs, which must be running, on
+# REPLICA_PORT (default 5433). Set POSTGRES_REPLICAS=127.0.0.1:5433 in the backend's .env
+# to read from it.
+
+set -euo pipefail
+
+SCRIPT_DIR="$(cd -- "$(dirname -- "${BASH_SOURCE[0]}")" &> /dev/null && pwd)"
+
+PRIMARY_STORE_DIR="${SCRIPT_DIR}/pg_data"
+BACKING_STORE_DIR="${SCRIPT_DIR}/pg_replica_data"
+mkdir -p "${BACKING_STORE_DIR}"
+
+source "$SCRIPT_DIR/../backend/.env"
+
+PRIMARY_PORT="${POSTGRES_PORT:-5432}"
+REPLICA_PORT="${REPLICA_PORT:-5433}"
+
+# Both containers use the host's network, so the replica can reach the primary's port, but
+# the primary only lets local connections replicate by default: let password-authenticated
+# ones replicate too.
+docker run \
+  --rm \
+  --volume "${PRIMARY_STORE_DIR}:/var/lib/postgresql/data" \
+  postgres:17.4 \
+  bash -c 'grep -q "^host replication all all" /var/lib/postgresql/data/pg_hba.conf || echo "host replication all all scram-sha-256" >> /var/lib/postgresql/data/pg_hba.conf'
+docker run \
+  --env PGPASSWORD="${POSTGRES_PASSWORD}" \
+  --network host \
+  --rm \
+  postgres:17.4 \
+  psql --host 127.0.0.1 --port "${PRIMARY_PORT}" --username "${POSTGRES_USER}" --dbname "${POSTGRES_DB}" --command "SELECT pg_reload_conf()"
+
+# Copy the primary's data the first time, with the settings to follow it from then on.
+if [ ! -f "${BACKING_STORE_DIR}/PG_VERSION" ]; then
+  docker run \
+    --env PGPASSWORD="${POSTGRES_PASSWORD}" \
+    --network host \
+    --rm \
+    --volume "${BACKING_STORE_DIR}:/var/lib/postgresql/data" \
+    postgres:17.4 \
+    pg_basebackup --host 127.0.0.1 --port "${PRIMARY_PORT}" --username "${POSTGRES_USER}" \
+      --pgdata /var/lib/postgresql/data --write-recovery-conf --wal-method stream --checkpoint fast
+fi
+
+docker run \
+  --env-file "$SCRIPT_DIR/../backend/.env" \
+  --interactive \
+  --network host \
+  --rm \
+  --tty \
+  --volume "${BACKING_STORE_DIR}:/var/lib/postgresql/data" \
+  postgres:17.4 \
+  -c port="${REPLICA_PORT}"
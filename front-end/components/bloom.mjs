@@ -34,11 +34,16 @@ const createBloom = (template, bloom) => {
   return bloomFrag;
 };
 
+// Hashtags are found as the backend finds them (see extract_hashtags): a # which doesn't
+// follow a letter, mark, digit or underscore, and the letters, marks, digits and
+// underscores after it, starting with a letter, digit or underscore.
+const HASHTAG_PATTERN = /(?<![\p{L}\p{M}\p{N}_])#([\p{L}\p{N}_][\p{L}\p{M}\p{N}_]*)/gu;
+
 function _formatHashtags(text) {
   if (!text) return text;
   return text.replace(
-    /\B#[^#]+/g,
-    (match) => `<a href="/hashtag/${match.slice(1)}">${match}</a>`
+    HASHTAG_PATTERN,
+    (match, hashtag) => `<a href="/hashtag/${hashtag}">${match}</a>`
   );
 }
 
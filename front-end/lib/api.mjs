@@ -64,6 +64,15 @@ async function _apiRequest(endpoint, options = {}) {
   }
 }
 
+// Helper function for making several GET requests at once. Resolves to each request's
+// {status, headers, body}, in the same order
+async function _apiBatch(endpoints) {
+  return _apiRequest("/batch", {
+    method: "POST",
+    body: JSON.stringify(endpoints.map((path) => ({path}))),
+  });
+}
+
 // Local helper to update a profile in the profiles array
 function _updateProfile(username, profileData) {
   const profiles = [...state.profiles];
@@ -91,7 +100,7 @@ async function login(username, password) {
         currentUser: username,
         isLoggedIn: true,
       });
-      await Promise.all([getBlooms(), getProfile(username), getWhoToFollow()]);
+      await _loadHome(username);
     }
 
     return data;
@@ -100,6 +109,23 @@ async function login(username, password) {
   }
 }
 
+// Loads everything the home page shows after logging in, in a single request
+async function _loadHome(username) {
+  const [timeline, profile, whoToFollow] = await _apiBatch([
+    "/home",
+    `/profile/${username}`,
+    "/suggested-follows/3",
+  ]).catch(() => []);
+
+  state.updateState({
+    timelineBlooms: timeline?.status === 200 ? timeline.body : [],
+    whoToFollow: whoToFollow?.status === 200 ? whoToFollow.body : [],
+  });
+  if (profile?.status === 200) {
+    _updateProfile(username, profile.body);
+  }
+}
+
 async function getWhoToFollow() {
   try {
     const usernamesToFollow = await _apiRequest("/suggested-follows/3");